@@ -1,9 +1,17 @@
+import base64
+import datetime
+import json
 from collections import OrderedDict  # requires Python 2.7 or later
 
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
 from django.core.paginator import Paginator
+from django.db.models import F, OrderBy, Q
 from django.utils.functional import cached_property
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
 
 class FasterDjangoPaginator(Paginator):
@@ -27,3 +35,129 @@ class FastPaginationWithoutCount(PageNumberPagination):
                 ]
             )
         )
+
+
+class KeysetPagination(BasePagination):
+    """Pages keyed on the (sort field, id) of the last item of the previous page
+
+    Unlike PageNumberPagination, there is no SELECT COUNT and no OFFSET,
+    so deep pages are as fast as the first one. The queryset is paged by
+    its first ordering field, or the model default ordering, or the id.
+    The ordering can be a field name or F() expression, other expressions
+    are not supported. NULLs of a nullable field go last, unless ordered
+    with nulls_first. The cursor is opaque to clients, who follow the
+    next link
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        ordering = queryset.query.order_by or queryset.model._meta.ordering or ["-id"]
+        self.field, self.descending, nulls_first = self.get_ordering_field(ordering[0])
+        self.nullable = self.is_nullable(queryset.model)
+        self.nulls_first = self.nullable and nulls_first
+        prefix = "-" if self.descending else ""
+        if self.nullable:
+            # explicit, databases differ on where NULLs go
+            order = OrderBy(F(self.field), descending=self.descending, nulls_first=self.nulls_first or None, nulls_last=not self.nulls_first or None)
+        else:
+            order = f"{prefix}{self.field}"
+        queryset = queryset.order_by(order, f"{prefix}id")
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            value, pk = self.decode_cursor(encoded, queryset.model)
+            queryset = queryset.filter(self.get_after_cursor_filter(value, pk))
+
+        # one more item tells whether there is a next page
+        results = list(queryset[: self.page_size + 1])
+        self.page = results[: self.page_size]
+        self.has_next = len(results) > self.page_size
+        return self.page
+
+    def get_ordering_field(self, order):
+        """(field, descending, nulls_first) of an ordering of the queryset"""
+
+        if isinstance(order, str) and order != "?":
+            return order.lstrip("-"), order.startswith("-"), False
+        if isinstance(order, F):
+            return order.name, False, False
+        if isinstance(order, OrderBy) and isinstance(order.expression, F):
+            return order.expression.name, order.descending, bool(order.nulls_first)
+        raise ImproperlyConfigured(f"KeysetPagination can not page a queryset ordered by {order!r}")
+
+    def is_nullable(self, model):
+        try:
+            return model._meta.get_field(self.field).null
+        except FieldDoesNotExist:
+            # an annotation, may be NULL
+            return True
+
+    def get_after_cursor_filter(self, value, pk):
+        """Items after the cursor, in the order of the queryset"""
+
+        lookup = "lt" if self.descending else "gt"
+        if value is None:
+            after = Q(**{f"{self.field}__isnull": True, f"id__{lookup}": pk})
+            if self.nulls_first:
+                after |= Q(**{f"{self.field}__isnull": False})
+            return after
+
+        # comparisons with a value do not match NULLs
+        after = Q(**{f"{self.field}__{lookup}": value}) | Q(**{self.field: value, f"id__{lookup}": pk})
+        if self.nullable and not self.nulls_first:
+            after |= Q(**{f"{self.field}__isnull": True})
+        return after
+
+    def decode_cursor(self, encoded, model):
+        try:
+            field, value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if field != self.field:
+            # the ordering changed
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            value = model._meta.get_field(field).to_python(value)
+        except FieldDoesNotExist:
+            # an annotation, eg the search rank
+            pass
+        return value, pk
+
+    def encode_cursor(self, item):
+        value = getattr(item, self.field)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            # keeps the microseconds, unlike DjangoJSONEncoder
+            value = value.isoformat()
+        cursor = json.dumps([self.field, value, item.id])
+        return base64.urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii")
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", None),
+                    ("results", data),
+                ]
+            )
+        )
+
+
+def get_pagination_class(request, default=None):
+    """KeysetPagination if the client asked for cursor pages, with
+    pagination=cursor, the next links keep asking for it
+    """
+
+    if request.query_params.get("pagination") == "cursor" or request.query_params.get(KeysetPagination.cursor_query_param):
+        return KeysetPagination
+    return default or api_settings.DEFAULT_PAGINATION_CLASS
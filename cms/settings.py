@@ -129,6 +129,15 @@ EXTRA_CSS_PATHS = []
 # per ip address limit, for actions as like/dislike/report
 TIME_TO_ACTION_ANONYMOUS = 10 * 60
 
+# watch/like/dislike actions are buffered in Redis and written to
+# the db in batches, every that many seconds
+USER_ACTIONS_FLUSH_INTERVAL = 30
+
+# recommended media are the ones with the highest trending score, where each
+# watch/like adds its weight, and halves every TRENDING_SCORE_HALF_LIFE seconds
+TRENDING_SCORE_WEIGHTS = {"watch": 1, "like": 5}
+TRENDING_SCORE_HALF_LIFE = 60 * 60 * 24 * 2
+
 # django-allauth settings
 ACCOUNT_SESSION_REMEMBER = True
 ACCOUNT_LOGIN_METHODS = {"username", "email"}
@@ -220,6 +229,8 @@ MASK_IPS_FOR_ACTIONS = True
 # considered as stale...unfortunately v9 seems to not include time
 # some times so raising this high
 RUNNING_STATE_STALE = 60 * 60 * 2
+# seconds between two progress updates of a running encoding
+ENCODING_PROGRESS_UPDATE_INTERVAL = 10
 
 FRIENDLY_TOKEN_LEN = 9
 
@@ -228,10 +239,65 @@ FRIENDLY_TOKEN_LEN = 9
 CHUNKIZE_VIDEO_DURATION = 60 * 5
 # aparently this has to be smaller than VIDEO_CHUNKIZE_DURATION
 VIDEO_CHUNKS_DURATION = 60 * 4
+# chunks are cut on keyframes, into roughly equal number of frames, and their
+# number is a multiple of the workers that encode them (celery long_tasks
+# processes), so that all workers are kept busy
+VIDEO_CHUNKS_WORKERS = 4
+# chunks shorter than this are not worth the overhead of a separate task
+VIDEO_CHUNKS_MIN_DURATION = 30
+
+# encoded chunks are kept in a content addressed cache, keyed on the chunk md5sum,
+# the encode profile and the ffmpeg command, so that re-encodes of unchanged chunks
+# reuse the existing result instead of running ffmpeg again
+USE_CHUNK_ENCODE_CACHE = True
+CHUNK_ENCODE_CACHE_DIR = os.path.join(MEDIA_ROOT, "chunk_encode_cache/")
+# seconds an entry of the cache is kept since it was last used
+CHUNK_ENCODE_CACHE_TTL = 60 * 60 * 24 * 3
+
+# workers can keep a local copy of the original files they process, so that
+# the many tasks of a media that run on the same worker read the original from
+# the shared MEDIA_ROOT once. Entries are keyed on the media uid and md5sum and
+# the least recently used are removed when the size limit is exceeded.
+# The directory should be on a local disk of each worker
+USE_SOURCE_STAGING_CACHE = False
+SOURCE_STAGING_CACHE_DIR = os.path.join(TEMP_DIRECTORY, "mediacms_source_cache/")
+# bytes
+SOURCE_STAGING_CACHE_SIZE = 50 * 1024 * 1024 * 1024
 
 # always get these two, even if upscaling
 MINIMUM_RESOLUTIONS_TO_ENCODE = [144, 240]
 
+# ladder encoding: decode a video once and produce all renditions of the
+# codecs below through a single ffmpeg run (split/scale filter graph),
+# instead of one ffmpeg run per EncodeProfile. A separate Encoding is still
+# kept for each profile. Valid codecs are h264 and vp9
+USE_LADDER_ENCODING = False
+LADDER_ENCODING_CODECS = ["h264"]
+
+# encodes are queued per owner and sent to the workers round robin across
+# owners, so that a bulk upload does not hold back the uploads of others.
+# Owners are users, or "rbac_group" for the first RBAC group of the user
+ENCODE_FAIR_SHARE_BY = "user"
+# encodes sent to the workers and not finished yet, for all workers.
+# None sends all queued encodes in order, otherwise a bit more than
+# the number of celery long_tasks processes keeps them busy
+ENCODE_DISPATCH_MAX_IN_FLIGHT = None
+# queued encodes are also dispatched every that many seconds
+ENCODE_DISPATCH_INTERVAL = 10
+# CPUs of a worker host that encodes may use, all if None. Each encode gets
+# a number of CPUs according to its resolution and codec, ffmpeg runs with
+# as many threads and pinned to them, and encodes that do not fit wait
+ENCODE_CPU_BUDGET = None
+
+# produce a low resolution, ultrafast preset h264 rendition of videos before
+# the regular encodings, so that they are playable and listable within
+# seconds of the upload. It is removed once the regular encodings are ready
+USE_FAST_PREVIEW = False
+FAST_PREVIEW_RESOLUTION = 360
+
+# number of subtitle timestamps returned per media by the transcripts search
+TRANSCRIPT_SEARCH_TIMESTAMPS = 3
+
 # default settings for notifications
 # not all of them are implemented
 
@@ -297,6 +363,7 @@ INSTALLED_APPS = [
     "jazzmin",
     "django.contrib.admin",
     "django.contrib.sites",
+    "django.contrib.postgres",
     "rest_framework",
     "rest_framework.authtoken",
     "imagekit",
@@ -468,6 +535,18 @@ CELERY_BEAT_SCHEDULE = {
         "task": "update_listings_thumbnails",
         "schedule": crontab(minute=2, hour="*/30"),
     },
+    "flush_user_actions": {
+        "task": "flush_user_actions",
+        "schedule": USER_ACTIONS_FLUSH_INTERVAL,
+    },
+    "dispatch_encodes": {
+        "task": "dispatch_encodes",
+        "schedule": ENCODE_DISPATCH_INTERVAL,
+    },
+    "clean_chunk_encode_cache": {
+        "task": "clean_chunk_encode_cache",
+        "schedule": crontab(minute=15, hour=3),
+    },
 }
 # TODO: beat, delete chunks from media root
 # chunks_dir after xx days...(also uploads_dir)
@@ -557,6 +636,10 @@ TINYMCE_DEFAULT_CONFIG = {
     "sandbox_iframes": False,
 }
 
+# widths of the resized renditions (JPEG and WebP) of media thumbnails,
+# served to listings and media pages through srcset
+THUMBNAIL_DERIVATIVE_WIDTHS = [160, 344, 720, 1280]
+
 SPRITE_NUM_SECS = 10
 # number of seconds for sprite image.
 # If you plan to change this, you must also follow the instructions on admins_docs.md
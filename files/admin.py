@@ -7,6 +7,7 @@ from tinymce.widgets import TinyMCE
 
 from rbac.models import RBACGroup
 
+from .methods import get_encoding_backlog
 from .models import (
     Category,
     Comment,
@@ -15,6 +16,7 @@ from .models import (
     Language,
     Media,
     Page,
+    ProcessingTiming,
     Subtitle,
     Tag,
     TinyMCEMedia,
@@ -243,6 +245,20 @@ class EncodingAdmin(admin.ModelAdmin):
     has_file.short_description = "Has file"
 
 
+class ProcessingTimingAdmin(admin.ModelAdmin):
+    list_display = ["stage", "media", "profile", "media_duration", "run_time", "worker", "add_date"]
+    list_filter = ["stage", "profile", "worker"]
+    search_fields = ["media__title"]
+    readonly_fields = ("media", "profile")
+    ordering = ("-add_date",)
+    change_list_template = "admin/files/processingtiming/change_list.html"
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context["backlog"] = get_encoding_backlog()
+        return super().changelist_view(request, extra_context=extra_context)
+
+
 class TranscriptionRequestAdmin(admin.ModelAdmin):
     list_display = ["media", "add_date", "status", "translate_to_english"]
     list_filter = ["status", "translate_to_english", "add_date"]
@@ -289,5 +305,6 @@ admin.site.register(Subtitle, SubtitleAdmin)
 admin.site.register(Language, LanguageAdmin)
 admin.site.register(VideoTrimRequest, VideoTrimRequestAdmin)
 admin.site.register(TranscriptionRequest, TranscriptionRequestAdmin)
+admin.site.register(ProcessingTiming, ProcessingTimingAdmin)
 
 Media._meta.app_config.verbose_name = "Media"
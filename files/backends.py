@@ -1,8 +1,14 @@
 # ffmpeg only backend
 
+import ctypes
+import ctypes.util
+import functools
 import locale
 import logging
-import re
+import os
+import signal
+import sys
+import tempfile
 from subprocess import PIPE, Popen
 
 logger = logging.getLogger(__name__)
@@ -14,9 +20,41 @@ class VideoEncodingError(Exception):
         super(VideoEncodingError, self).__init__(*args, **kwargs)
 
 
-RE_TIMECODE = re.compile(r"time=(\d+:\d+:\d+.\d+)")
 console_encoding = locale.getlocale()[1] or "UTF-8"
 
+# machine readable progress is written by ffmpeg on stdout,
+# as blocks of key=value lines that end with a progress= line
+PROGRESS_OPTIONS = ["-progress", "pipe:1", "-nostats"]
+# bytes of stderr kept as the output of the command
+OUTPUT_TAIL_SIZE = 4000
+# from linux/prctl.h
+PR_SET_PDEATHSIG = 1
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+
+
+libc = _load_libc()
+
+
+def _ffmpeg_preexec(cpus=None):
+    """Runs in the child before exec, everything set here is inherited
+    by all ffmpeg threads
+    """
+
+    # ffmpeg runs in its own session, so it is not killed along with the
+    # worker process group, have it killed when the worker dies instead
+    if libc is not None:
+        libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
 
 class FFmpegBackend(object):
     name = "FFmpeg"
@@ -24,15 +62,19 @@ class FFmpegBackend(object):
     def __init__(self):
         pass
 
-    def _spawn(self, cmd):
+    def _spawn(self, cmd, stderr=PIPE, cpus=None):
         try:
             return Popen(
                 cmd,
                 shell=False,
                 stdin=PIPE,
                 stdout=PIPE,
-                stderr=PIPE,
+                stderr=stderr,
                 close_fds=True,
+                preexec_fn=functools.partial(_ffmpeg_preexec, cpus),
+                # own session and process group, so that it can be killed
+                # by pid along with any children, see kill_ffmpeg_process
+                start_new_session=True,
             )
         except OSError as e:
             raise VideoEncodingError("Error while running ffmpeg", e)
@@ -43,31 +85,48 @@ class FFmpegBackend(object):
         ret["code"] = process.returncode
         return ret
 
-    def encode(self, cmd):
-        process = self._spawn(cmd)
-        buf = output = ""
-        while True:
-            out = process.stderr.read(10)
-
-            if not out:
-                break
+    def _read_output_tail(self, stderr_file):
+        stderr_file.seek(0, os.SEEK_END)
+        size = stderr_file.tell()
+        stderr_file.seek(max(0, size - OUTPUT_TAIL_SIZE))
+        return stderr_file.read().decode(console_encoding, "replace")
+
+    def encode(self, cmd, cpus=None, on_process=None):
+        """Run an ffmpeg command, pinned to cpus if given
+
+        Yields the seconds of media processed so far, once per ffmpeg
+        progress report, and finally the (last part of the) ffmpeg output.
+        on_process is called with the pid of ffmpeg once it is started,
+        and with None once it has exited
+        """
+
+        cmd = [cmd[0], *PROGRESS_OPTIONS, *cmd[1:]]
+        # stderr goes to a file, so that reading the progress pipe
+        # never blocks on a full stderr pipe
+        with tempfile.TemporaryFile() as stderr_file:
+            process = self._spawn(cmd, stderr=stderr_file, cpus=cpus)
+            if on_process:
+                on_process(process.pid)
             try:
-                out = out.decode(console_encoding)
-            except UnicodeDecodeError:
-                out = ""
-            output = output[-500:] + out
-            buf = buf[-500:] + out
-            try:
-                line, buf = buf.split("\r", 1)
-            except BaseException:
-                continue
-
-            progress = RE_TIMECODE.findall(line)
-            if progress:
-                progress = progress[0]
-            yield progress
+                processed_seconds = None
+                # iterating the pipe reads it in buffered blocks, split by line
+                for line in process.stdout:
+                    key, _, value = line.decode(console_encoding, "replace").strip().partition("=")
+                    if key in ("out_time_us", "out_time_ms"):
+                        # both are in microseconds
+                        try:
+                            processed_seconds = int(value) / 1000000
+                        except ValueError:
+                            continue
+                    elif key == "progress" and processed_seconds is not None:
+                        yield processed_seconds
+
+                process_check = self._check_returncode(process)
+            finally:
+                if on_process:
+                    on_process(None)
+            output = self._read_output_tail(stderr_file)
 
-        process_check = self._check_returncode(process)
         if process_check["code"] != 0:
             raise VideoEncodingError(output[-1000:])  # output could be huge
 
@@ -4,20 +4,34 @@
 import hashlib
 import json
 import logging
+import math
 import os
 import random
+import re
 import shutil
 import subprocess
 import tempfile
+import threading
 from fractions import Fraction
 
 import filetype
 from django.conf import settings
+from django.core.cache import cache
+from PIL import Image, ImageOps
 
 CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 
 logger = logging.getLogger(__name__)
 
+# media_file_info results are cached for that long
+MEDIA_FILE_INFO_CACHE_TIMEOUT = 60 * 60 * 24
+MD5_BLOCK_SIZE = 1024 * 1024
+
+# size of each frame of the sprites image, the video player expects these
+SPRITE_WIDTH = 160
+SPRITE_HEIGHT = 90
+# JPEG can't be taller than this, longer sprites are stored as PNG
+JPEG_MAX_DIMENSION = 65500
 
 CRF_ENCODING_NUM_SECONDS = 2  # 0 * 60 # videos with greater duration will get
 # CRF encoding and not two-pass
@@ -97,6 +111,12 @@ EXTENSIONS = {"h264": "mp4", "h265": "mp4", "vp9": "webm"}
 
 VIDEO_PROFILES = {"h264": "main", "h265": "main"}
 
+# relative CPU cost of encoders, per pixel. x265 and libvpx-vp9 (at the
+# speeds used here) are a few times slower than x264
+ENCODE_CODEC_COSTS = {"h264": 1, "h265": 3, "hevc": 3, "vp9": 2}
+# cores kept busy by a 720p 30fps h264 encode, the others scale by pixel rate
+ENCODE_THREADS_720P = 2
+
 
 def get_portal_workflow():
     return settings.PORTAL_WORKFLOW
@@ -232,6 +252,135 @@ def run_command(cmd, cwd=None):
     return ret
 
 
+def md5sum_file(input_file):
+    """md5 of a file, read in blocks"""
+
+    md5 = hashlib.md5()
+    with open(input_file, "rb") as f:
+        for block in iter(lambda: f.read(MD5_BLOCK_SIZE), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_file_md5sum(input_file):
+    """md5 of a file, cached for as long as its size and mtime do not change"""
+
+    try:
+        st = os.stat(input_file)
+    except OSError:
+        return None
+
+    cache_key = "file_md5sum_" + hashlib.md5(f"{input_file}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+    md5sum = cache.get(cache_key)
+    if md5sum is None:
+        try:
+            md5sum = md5sum_file(input_file)
+        except OSError:
+            return None
+        cache.set(cache_key, md5sum, MEDIA_FILE_INFO_CACHE_TIMEOUT)
+    return md5sum
+
+
+def probe_media_file(input_file):
+    """Run a single ffprobe for streams and format of a file
+
+    The file is hashed on a thread while ffprobe runs, so that it is read
+    once by each of them at the same time, and the output of ffprobe is
+    read meanwhile. Returns (ffprobe info, md5sum), info is None if
+    ffprobe failed
+    """
+
+    cmd = [
+        settings.FFPROBE_COMMAND,
+        "-loglevel",
+        "error",
+        "-show_streams",
+        "-show_format",
+        "-of",
+        "json",
+        input_file,
+    ]
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None, ""
+
+    hashed = {"md5sum": ""}
+
+    def hash_file():
+        try:
+            hashed["md5sum"] = md5sum_file(input_file)
+        except OSError:
+            pass
+
+    thread = threading.Thread(target=hash_file)
+    thread.start()
+    stdout, stderr = process.communicate()
+    thread.join()
+    md5sum = hashed["md5sum"]
+    if process.returncode != 0:
+        return None, md5sum
+    try:
+        info = json.loads(stdout.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        return None, md5sum
+    return info, md5sum
+
+
+def get_stream_duration(stream_info, format_info):
+    """Duration of a stream, from the stream, its tags or the format"""
+
+    if "duration" in stream_info.keys():
+        return float(stream_info["duration"])
+    if "tags" in stream_info.keys() and "DURATION" in stream_info["tags"]:
+        duration_str = stream_info["tags"]["DURATION"]
+        try:
+            hms, msec = duration_str.split(".")
+        except ValueError:
+            hms, msec = duration_str.split(",")
+
+        total_dur = sum(int(x) * 60**i for i, x in enumerate(reversed(hms.split(":"))))
+        return total_dur + float("0." + msec)
+    # fallback to format, eg for webm
+    return float(format_info["duration"])
+
+
+def get_stream_bitrate(input_file, stream_info, duration):
+    """Bitrate of a stream in kBit/s
+
+    Streams of some containers (eg mkv/webm) have no bit_rate, there the
+    bitrate is taken from the BPS tag, or else from the size of all the
+    packets of the stream, that needs another ffprobe run
+    """
+
+    if "bit_rate" in stream_info.keys():
+        return round(float(stream_info["bit_rate"]) / 1024.0, 2)
+    for tag, value in stream_info.get("tags", {}).items():
+        if tag.upper().startswith("BPS"):
+            try:
+                return round(float(value) / 1024.0, 2)
+            except ValueError:
+                pass
+
+    if not duration:
+        return 0
+    cmd = [
+        settings.FFPROBE_COMMAND,
+        "-loglevel",
+        "error",
+        "-select_streams",
+        str(stream_info.get("index", stream_info["codec_type"][0])),
+        "-show_entries",
+        "packet=size",
+        "-of",
+        "compact=p=0:nk=1",
+        input_file,
+    ]
+    stdout = run_command(cmd).get("out") or ""
+    stream_size = sum([int(line.replace("|", "")) for line in stdout.split("\n") if line.replace("|", "").isdigit()])
+    return round((stream_size * 8 / 1024.0) / duration, 2)
+
+
 def media_file_info(input_file):
     """
     Get the info about an input file, as determined by ffprobe
@@ -253,56 +402,48 @@ def media_file_info(input_file):
     - `audio_bitrate`: Bitrate of the video stream in kBit/s
 
     Also returns the video and audio info raw from ffprobe.
+
+    Results are cached keyed on the path, size and modification time
+    of the file, so probing the same file again is free
     """
-    ret = {}
 
     if not os.path.isfile(input_file):
-        ret["fail"] = True
-        return ret
+        return {"fail": True}
 
-    video_info = {}
-    audio_info = {}
-    cmd = ["stat", "-c", "%s", input_file]
+    try:
+        st = os.stat(input_file)
+    except OSError:
+        return {"fail": True}
 
-    stdout = run_command(cmd).get("out")
-    if stdout:
-        file_size = int(stdout.strip())
-    else:
-        ret["fail"] = True
+    cache_key = "media_file_info_" + hashlib.md5(f"{input_file}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+    ret = cache.get(cache_key)
+    if ret is not None:
         return ret
 
-    cmd = ["md5sum", input_file]
-    stdout = run_command(cmd).get("out")
-    if stdout:
-        md5sum = stdout.split()[0]
-    else:
-        md5sum = ""
+    ret = probe_media_file_info(input_file, st.st_size)
+    if not ret.get("fail"):
+        cache.set(cache_key, ret, MEDIA_FILE_INFO_CACHE_TIMEOUT)
+    return ret
 
-    cmd = [
-        settings.FFPROBE_COMMAND,
-        "-loglevel",
-        "error",
-        "-show_streams",
-        "-show_entries",
-        "format=format_name",
-        "-of",
-        "json",
-        input_file,
-    ]
-    stdout = run_command(cmd).get("out")
-    try:
-        info = json.loads(stdout)
-    except TypeError:
+
+def probe_media_file_info(input_file, file_size):
+    ret = {}
+    video_info = {}
+    audio_info = {}
+
+    info, md5sum = probe_media_file(input_file)
+    if not info:
         ret["fail"] = True
         return ret
+    format_info = info.get("format", {})
 
     has_video = False
     has_audio = False
-    for stream_info in info["streams"]:
+    for stream_info in info.get("streams", []):
         if stream_info["codec_type"] == "video":
             video_info = stream_info
             has_video = True
-            if info.get("format") and info["format"].get("format_name", "") in [
+            if format_info.get("format_name", "") in [
                 "tty",
                 "image2",
                 "image2pipe",
@@ -320,56 +461,17 @@ def media_file_info(input_file):
         ret["is_video"] = False
         ret["is_audio"] = has_audio
         ret["audio_info"] = audio_info
+        ret["file_size"] = file_size
+        ret["md5sum"] = md5sum
         return ret
 
-    if "duration" in video_info.keys():
-        video_duration = float(video_info["duration"])
-    elif "tags" in video_info.keys() and "DURATION" in video_info["tags"]:
-        duration_str = video_info["tags"]["DURATION"]
-        try:
-            hms, msec = duration_str.split(".")
-        except ValueError:
-            hms, msec = duration_str.split(",")
-
-        total_dur = sum(int(x) * 60**i for i, x in enumerate(reversed(hms.split(":"))))
-        video_duration = total_dur + float("0." + msec)
-    else:
-        # fallback to format, eg for webm
-        cmd = [
-            settings.FFPROBE_COMMAND,
-            "-loglevel",
-            "error",
-            "-show_format",
-            "-of",
-            "json",
-            input_file,
-        ]
-        stdout = run_command(cmd).get("out")
-        format_info = json.loads(stdout)["format"]
-        try:
-            video_duration = float(format_info["duration"])
-        except KeyError:
-            ret["fail"] = True
-            return ret
+    try:
+        video_duration = get_stream_duration(video_info, format_info)
+    except (KeyError, ValueError):
+        ret["fail"] = True
+        return ret
 
-    if "bit_rate" in video_info.keys():
-        video_bitrate = round(float(video_info["bit_rate"]) / 1024.0, 2)
-    else:
-        cmd = [
-            settings.FFPROBE_COMMAND,
-            "-loglevel",
-            "error",
-            "-select_streams",
-            "v",
-            "-show_entries",
-            "packet=size",
-            "-of",
-            "compact=p=0:nk=1",
-            input_file,
-        ]
-        stdout = run_command(cmd).get("out")
-        stream_size = sum([int(line.replace("|", "")) for line in stdout.split("\n") if line != ""])
-        video_bitrate = round((stream_size * 8 / 1024.0) / video_duration, 2)
+    video_bitrate = get_stream_bitrate(input_file, video_info, video_duration)
 
     if "r_frame_rate" in video_info.keys():
         video_frame_rate = video_info["r_frame_rate"].partition("/")
@@ -402,52 +504,11 @@ def media_file_info(input_file):
     }
 
     if has_audio:
-        if "duration" in audio_info.keys():
-            audio_duration = float(audio_info["duration"])
-        elif "tags" in audio_info.keys() and "DURATION" in audio_info["tags"]:
-            duration_str = audio_info["tags"]["DURATION"]
-            try:
-                hms, msec = duration_str.split(".")
-            except ValueError:
-                hms, msec = duration_str.split(",")
-            total_dur = sum(int(x) * 60**i for i, x in enumerate(reversed(hms.split(":"))))
-            audio_duration = total_dur + float("0." + msec)
-        else:
-            # fallback to format, eg for webm
-            cmd = [
-                settings.FFPROBE_COMMAND,
-                "-loglevel",
-                "error",
-                "-show_format",
-                "-of",
-                "json",
-                input_file,
-            ]
-            stdout = run_command(cmd).get("out")
-            format_info = json.loads(stdout)["format"]
-            audio_duration = float(format_info["duration"])
-
-        if "bit_rate" in audio_info.keys():
-            audio_bitrate = round(float(audio_info["bit_rate"]) / 1024.0, 2)
-        else:
-            # fall back to calculating from accumulated frame duration
-            cmd = [
-                settings.FFPROBE_COMMAND,
-                "-loglevel",
-                "error",
-                "-select_streams",
-                "a",
-                "-show_entries",
-                "packet=size",
-                "-of",
-                "compact=p=0:nk=1",
-                input_file,
-            ]
-            stdout = run_command(cmd).get("out")
-            # ffprobe appends a pipe at the end of the output, thus we have to remove it
-            stream_size = sum([int(line.replace("|", "")) for line in stdout.split("\n") if line != ""])
-            audio_bitrate = round((stream_size * 8 / 1024.0) / audio_duration, 2)
-
+        try:
+            audio_duration = get_stream_duration(audio_info, format_info)
+        except (KeyError, ValueError):
+            audio_duration = video_duration
+        audio_bitrate = get_stream_bitrate(input_file, audio_info, audio_duration)
         ret.update(
             {
                 "audio_duration": audio_duration,
@@ -489,6 +550,72 @@ def show_file_size(size):
     return size
 
 
+def normalize_target_fps(target_fps):
+    # avoid very high frame rates
+    while target_fps > 60:
+        target_fps = target_fps / 2
+
+    if target_fps < 1:
+        target_fps = 1
+    return target_fps
+
+
+def get_scale_fps_filters(target_fps, target_height):
+    """Return the scale and fps video filters for a target height/fps"""
+
+    target_width = round(target_height * 16 / 9)
+    scale_filter_opts = [
+        f"if(lt(iw\\,ih)\\,{target_height}\\,{target_width})",  # noqa
+        f"if(lt(iw\\,ih)\\,{target_width}\\,{target_height})",  # noqa
+        "force_original_aspect_ratio=decrease",
+        "force_divisible_by=2",
+        "flags=lanczos",
+    ]
+    scale_filter_str = "scale=" + ":".join(scale_filter_opts)
+
+    fps_str = f"fps=fps={target_fps}"
+    return [scale_filter_str, fps_str]
+
+
+def get_encode_cpus():
+    """CPUs that encodes of this worker may use, at most ENCODE_CPU_BUDGET"""
+
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    budget = getattr(settings, "ENCODE_CPU_BUDGET", None)
+    if budget:
+        cpus = cpus[:budget]
+    return cpus
+
+
+def get_encode_threads(media_info, resolution, codec):
+    """Number of cores an encode of a media to a resolution/codec is worth
+
+    Estimated from the pixel rate of the output and the cost of the
+    encoder, relative to a 720p 30fps h264 encode. Small renditions get a
+    single thread, as ffmpeg threading only adds overhead there. Encodes
+    get at most the CPU budget of the worker, when they are admitted
+    """
+
+    try:
+        media_info = json.loads(media_info)
+    except BaseException:
+        media_info = {}
+
+    if not resolution:
+        return 1
+    try:
+        target_fps = Fraction(int(media_info.get("video_frame_rate_n", 30)), int(media_info.get("video_frame_rate_d", 1)))
+    except (ValueError, ZeroDivisionError):
+        target_fps = 30
+    target_fps = normalize_target_fps(target_fps)
+    pixel_rate = (resolution / 720) ** 2 * (float(target_fps) / 30)
+    cost = pixel_rate * ENCODE_CODEC_COSTS.get(codec, 1)
+    return max(1, math.ceil(cost * ENCODE_THREADS_720P))
+
+
 def get_base_ffmpeg_command(
     input_file,
     output_file,
@@ -505,6 +632,7 @@ def get_base_ffmpeg_command(
     pass_number,
     enc_type,
     chunk,
+    threads=None,
 ):
     """Get the base command for a specific codec, height/rate, and pass
 
@@ -523,33 +651,17 @@ def get_base_ffmpeg_command(
         pass_file {str} -- path to temp pass file
         pass_number {int} -- number of passes
         enc_type {str} -- encoding type (twopass or crf)
+        threads {int} -- number of encoder threads, ffmpeg default if None
     """
 
-    # avoid very high frame rates
-    while target_fps > 60:
-        target_fps = target_fps / 2
-
-    if target_fps < 1:
-        target_fps = 1
+    target_fps = normalize_target_fps(target_fps)
 
     filters = []
 
     if interlaced:
         filters.append("yadif")
 
-    target_width = round(target_height * 16 / 9)
-    scale_filter_opts = [
-        f"if(lt(iw\\,ih)\\,{target_height}\\,{target_width})",  # noqa
-        f"if(lt(iw\\,ih)\\,{target_width}\\,{target_height})",  # noqa
-        "force_original_aspect_ratio=decrease",
-        "force_divisible_by=2",
-        "flags=lanczos",
-    ]
-    scale_filter_str = "scale=" + ":".join(scale_filter_opts)
-    filters.append(scale_filter_str)
-
-    fps_str = f"fps=fps={target_fps}"
-    filters.append(fps_str)
+    filters.extend(get_scale_fps_filters(target_fps, target_height))
 
     filters_str = ",".join(filters)
 
@@ -566,6 +678,9 @@ def get_base_ffmpeg_command(
         "yuv420p",
     ]
 
+    if threads:
+        base_cmd.extend(["-threads", str(threads)])
+
     if enc_type == "twopass":
         base_cmd.extend(["-b:v", str(target_rate) + "k"])
     elif enc_type == "crf":
@@ -694,11 +809,11 @@ def get_base_ffmpeg_command(
     return cmd
 
 
-def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_filename, pass_file, chunk=False):
-    try:
-        media_info = json.loads(media_info)
-    except BaseException:
-        media_info = {}
+def get_encoding_params(media_info, resolution, codec):
+    """Return the encoding parameters for a resolution/codec, given the
+    media_info dict of the input file. Returns None if the input should
+    not be encoded to this resolution/codec
+    """
 
     if codec == "h264":
         encoder = "libx264"
@@ -710,7 +825,7 @@ def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_fi
         encoder = "libvpx-vp9"
         # ext = "webm"
     else:
-        return False
+        return None
 
     target_fps = Fraction(int(media_info.get("video_frame_rate_n", 30)), int(media_info.get("video_frame_rate_d", 1)))
     if target_fps <= 30:
@@ -720,11 +835,11 @@ def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_fi
     if not target_rate:  # INVESTIGATE MORE!
         target_rate = VIDEO_BITRATES[codec][25].get(resolution)
     if not target_rate:
-        return False
+        return None
 
     if media_info.get("video_height") < resolution:
         if resolution not in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
-            return False
+            return None
 
     #    if codec == "h264_baseline":
     #        target_fps = 25
@@ -735,9 +850,29 @@ def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_fi
     else:
         enc_type = "twopass"
 
-    if enc_type == "twopass":
+    return {
+        "encoder": encoder,
+        "audio_encoder": AUDIO_ENCODERS[codec],
+        "target_fps": target_fps,
+        "target_rate": target_rate,
+        "target_rate_audio": AUDIO_BITRATES[codec],
+        "enc_type": enc_type,
+    }
+
+
+def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_filename, pass_file, chunk=False, threads=None):
+    try:
+        media_info = json.loads(media_info)
+    except BaseException:
+        media_info = {}
+
+    params = get_encoding_params(media_info, resolution, codec)
+    if not params:
+        return False
+
+    if params["enc_type"] == "twopass":
         passes = [1, 2]
-    elif enc_type == "crf":
+    elif params["enc_type"] == "crf":
         passes = [2]
 
     interlaced = media_info.get("interlaced")
@@ -750,22 +885,379 @@ def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_fi
                 output_file=output_filename,
                 has_audio=media_info.get("has_audio"),
                 codec=codec,
-                encoder=encoder,
-                audio_encoder=AUDIO_ENCODERS[codec],
-                target_fps=target_fps,
+                encoder=params["encoder"],
+                audio_encoder=params["audio_encoder"],
+                target_fps=params["target_fps"],
                 interlaced=interlaced,
                 target_height=resolution,
-                target_rate=target_rate,
-                target_rate_audio=AUDIO_BITRATES[codec],
+                target_rate=params["target_rate"],
+                target_rate_audio=params["target_rate_audio"],
                 pass_file=pass_file,
                 pass_number=pass_number,
-                enc_type=enc_type,
+                enc_type=params["enc_type"],
                 chunk=chunk,
+                threads=threads,
             )
         )
     return cmds
 
 
+def produce_ladder_ffmpeg_command(media_file, media_info, renditions, chunk=False):
+    """Produce a single ffmpeg command that decodes the input once and
+    encodes it to several renditions, through a split/scale filter graph
+
+    Arguments:
+        media_file {str} -- input file name
+        media_info {str} -- json media_info of the input
+        renditions {list} -- list of dicts with resolution, codec, output_filename
+                             and optionally the number of encoder threads
+
+    Returns the command, or False if any of the renditions cannot be
+    produced by a single pass (CRF) encoding
+    """
+
+    try:
+        media_info = json.loads(media_info)
+    except BaseException:
+        media_info = {}
+
+    if not renditions:
+        return False
+
+    interlaced = media_info.get("interlaced")
+    has_audio = media_info.get("has_audio")
+
+    # decode (and deinterlace) once, then split to one branch per rendition
+    split_outputs = "".join([f"[s{i}]" for i in range(len(renditions))])
+    pre_filters = ["yadif"] if interlaced else []
+    filter_graph = ["[0:v]" + ",".join(pre_filters + [f"split={len(renditions)}{split_outputs}"])]
+
+    outputs = []
+    for i, rendition in enumerate(renditions):
+        params = get_encoding_params(media_info, rendition["resolution"], rendition["codec"])
+        if not params or params["enc_type"] != "crf":
+            return False
+
+        target_fps = normalize_target_fps(params["target_fps"])
+        filter_graph.append(f"[s{i}]" + ",".join(get_scale_fps_filters(target_fps, rendition["resolution"])) + f"[v{i}]")
+
+        cmd = get_base_ffmpeg_command(
+            media_file,
+            output_file=rendition["output_filename"],
+            has_audio=has_audio,
+            codec=rendition["codec"],
+            encoder=params["encoder"],
+            audio_encoder=params["audio_encoder"],
+            target_fps=params["target_fps"],
+            interlaced=False,
+            target_height=rendition["resolution"],
+            target_rate=params["target_rate"],
+            target_rate_audio=params["target_rate_audio"],
+            pass_file="",
+            pass_number=2,
+            enc_type=params["enc_type"],
+            chunk=chunk,
+            threads=rendition.get("threads"),
+        )
+        # keep the output options only: drop the input part of the
+        # command and the per output video filter, that is part
+        # of the filter graph
+        filter_index = cmd.index("-filter:v")
+        output_options = cmd[cmd.index(media_file) + 1 : filter_index] + cmd[filter_index + 2 :]
+
+        outputs.append("-map")
+        outputs.append(f"[v{i}]")
+        if has_audio:
+            outputs.extend(["-map", "0:a:0"])
+        outputs.extend(output_options)
+
+    return [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-i",
+        media_file,
+        "-filter_complex",
+        ";".join(filter_graph),
+        *outputs,
+    ]
+
+
+def get_video_keyframes(media_file):
+    """Read the keyframe index of the first video stream
+
+    Only the packets are read (no decoding), so this is cheap even for long
+    videos. Returns a tuple (keyframes, total_frames), where keyframes is a
+    list of (seconds, frames before the keyframe), with seconds relative to
+    the first packet. Returns None if the index can't be read
+    """
+
+    cmd = [
+        settings.FFPROBE_COMMAND,
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        media_file,
+    ]
+    stdout = run_command(cmd).get("out")
+    if not stdout:
+        return None
+
+    keyframes = []
+    start_time = None
+    total_frames = 0
+    for line in stdout.splitlines():
+        pts_time, _, flags = line.strip().partition(",")
+        try:
+            pts_time = float(pts_time)
+        except ValueError:
+            # N/A pts, still a frame that has to be encoded
+            total_frames += 1
+            continue
+        if start_time is None:
+            start_time = pts_time
+        if "K" in flags:
+            keyframes.append((pts_time - start_time, total_frames))
+        total_frames += 1
+
+    if not keyframes:
+        return None
+    # packets are in decoding order, pts of keyframes are increasing
+    keyframes.sort()
+    return keyframes, total_frames
+
+
+def plan_video_chunks(keyframes, total_frames, duration, workers, chunk_duration, min_chunk_duration):
+    """Plan where to split a video for parallel chunk encoding
+
+    The encoding cost of a chunk is roughly its number of frames, so the
+    video is split on the keyframes closest to equal frame counts. The number
+    of chunks is a multiple of the number of workers, so that every round of
+    chunk encodes keeps all workers busy, while chunks are no longer than
+    chunk_duration (if possible) and no shorter than min_chunk_duration.
+
+    Returns a list of split times (seconds), empty if no split is needed
+    """
+
+    if not keyframes or not total_frames or not duration:
+        return []
+    workers = max(1, workers)
+
+    max_chunks = max(1, int(duration // max(min_chunk_duration, 1)))
+    chunks_number = workers
+    while duration / chunks_number > chunk_duration and chunks_number + workers <= max_chunks:
+        chunks_number += workers
+    chunks_number = min(chunks_number, max_chunks, len(keyframes))
+    if chunks_number <= 1:
+        return []
+
+    split_times = []
+    index = 1
+    for i in range(1, chunks_number):
+        target_frames = total_frames * i / chunks_number
+        # keyframes are sorted, move forward while the next one is closer
+        while index < len(keyframes) - 1 and abs(keyframes[index + 1][1] - target_frames) <= abs(keyframes[index][1] - target_frames):
+            index += 1
+        if index >= len(keyframes):
+            break
+        keyframe_time = keyframes[index][0]
+        if keyframe_time > 0 and (not split_times or keyframe_time > split_times[-1]):
+            split_times.append(keyframe_time)
+        index += 1
+    return split_times
+
+
+def get_ffmpeg_commands_fingerprint(ffmpeg_commands, input_file, output_file, pass_file):
+    """Return a fingerprint of a list of ffmpeg commands
+
+    The input, output and pass files are temporary/random paths, so they
+    are replaced with placeholders. The number of threads depends on the CPUs
+    the encode was admitted with, so it is left out. Two encodings of the same
+    content with the same profile and the same options end up with the same
+    fingerprint
+    """
+
+    normalized = []
+    replacements = {str(input_file): "INPUT", str(output_file): "OUTPUT", str(pass_file): "PASSFILE"}
+    for command in ffmpeg_commands:
+        args = [str(arg) for arg in command]
+        if "-threads" in args:
+            index = args.index("-threads")
+            del args[index : index + 2]
+        normalized.append([replacements.get(arg, arg) for arg in args])
+    return hashlib.md5(json.dumps(normalized).encode("utf-8")).hexdigest()
+
+
+def get_chunk_encode_cache_path(md5sum, profile_id, fingerprint, extension):
+    """Path of an encoded chunk in the chunk encode cache
+    Returns None if the cache is not enabled or the chunk has no md5sum
+    """
+
+    if not getattr(settings, "USE_CHUNK_ENCODE_CACHE", False):
+        return None
+    if not md5sum:
+        return None
+    return os.path.join(settings.CHUNK_ENCODE_CACHE_DIR, f"{md5sum}_{profile_id}_{fingerprint}.{extension}")
+
+
+def store_in_chunk_encode_cache(input_file, cache_path):
+    """Copy an encoded chunk to the chunk encode cache
+    Copy to a temp file first and then rename, so that a concurrent
+    reader never sees a partially written file
+    """
+
+    if not cache_path:
+        return False
+    tf = None
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tf = create_temp_file(suffix=".part", dir=os.path.dirname(cache_path))
+        shutil.copyfile(input_file, tf)
+        os.replace(tf, cache_path)
+    except OSError as e:
+        logger.info(f"Failed to store {input_file} in chunk encode cache: {e}")
+        if tf:
+            rm_file(tf)
+        return False
+    return True
+
+
+def merge_hls_master_playlists(renditions):
+    """Merge the master playlists of single rendition HLS outputs
+
+    renditions is a list of (directory, master playlist content) tuples,
+    as produced by mp4hls for a single file in that directory. Returns the
+    content of a master playlist that references all of them
+    """
+
+    version = None
+    independent_segments = False
+    media_lines = []
+    media_keys = set()
+    stream_lines = []
+    iframe_lines = []
+
+    def prefix_uri(line, directory):
+        # URI="..." attributes of EXT-X-MEDIA and EXT-X-I-FRAME-STREAM-INF
+        return re.sub(r'URI="([^"]+)"', lambda m: f'URI="{directory}/{m.group(1)}"', line)
+
+    for directory, content in renditions:
+        expect_uri = False
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if expect_uri:
+                if not line.startswith("#"):
+                    stream_lines.append(f"{directory}/{line}")
+                    expect_uri = False
+                continue
+            if line.startswith("#EXT-X-VERSION:"):
+                try:
+                    version = max(version or 0, int(line.split(":", 1)[1]))
+                except ValueError:
+                    pass
+            elif line == "#EXT-X-INDEPENDENT-SEGMENTS":
+                independent_segments = True
+            elif line.startswith("#EXT-X-MEDIA:"):
+                # each rendition carries its own copy of the audio/subtitles
+                # renditions, players expect one per (TYPE, GROUP-ID, NAME)
+                attributes = dict(re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(":", 1)[1]))
+                media_key = (attributes.get("TYPE"), attributes.get("GROUP-ID"), attributes.get("NAME"))
+                if media_key not in media_keys:
+                    media_keys.add(media_key)
+                    media_lines.append(prefix_uri(line, directory))
+            elif line.startswith("#EXT-X-STREAM-INF:"):
+                stream_lines.append(line)
+                expect_uri = True
+            elif line.startswith("#EXT-X-I-FRAME-STREAM-INF:"):
+                iframe_lines.append(prefix_uri(line, directory))
+
+    lines = ["#EXTM3U"]
+    if version:
+        lines.append(f"#EXT-X-VERSION:{version}")
+    if independent_segments:
+        lines.append("#EXT-X-INDEPENDENT-SEGMENTS")
+    lines.extend(media_lines)
+    lines.extend(stream_lines)
+    lines.extend(iframe_lines)
+    return "\n".join(lines) + "\n"
+
+
+def stage_source_file(input_file, uid, md5sum):
+    """Return a worker local copy of an original media file
+
+    The copy is made on first use, in the source staging cache. When the
+    cache is disabled, or the file can't be staged, the input file is returned
+    """
+
+    if not getattr(settings, "USE_SOURCE_STAGING_CACHE", False):
+        return input_file
+    if not (uid and md5sum):
+        return input_file
+
+    cache_dir = settings.SOURCE_STAGING_CACHE_DIR
+    extension = os.path.splitext(input_file)[1]
+    staged_file = os.path.join(cache_dir, f"{uid}_{md5sum}{extension}")
+    try:
+        file_size = os.path.getsize(input_file)
+        if file_size > settings.SOURCE_STAGING_CACHE_SIZE:
+            return input_file
+
+        # a file changed in place (eg trimmed) may still have the old md5sum
+        if os.path.exists(staged_file) and os.path.getsize(staged_file) == file_size:
+            # mtime of entries is their last use
+            os.utime(staged_file)
+            return staged_file
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tf = create_temp_file(suffix=".part", dir=cache_dir)
+        try:
+            shutil.copyfile(input_file, tf)
+            os.replace(tf, staged_file)
+        finally:
+            rm_file(tf)
+    except OSError as e:
+        logger.info(f"Failed to stage {input_file}: {e}")
+        return input_file
+
+    evict_source_staging_cache(keep=staged_file)
+    return staged_file
+
+
+def evict_source_staging_cache(keep=None):
+    """Remove least recently used entries of the source staging
+    cache, until it is within SOURCE_STAGING_CACHE_SIZE
+    """
+
+    entries = []
+    with os.scandir(settings.SOURCE_STAGING_CACHE_DIR) as it:
+        for entry in it:
+            # skip files being staged right now
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= settings.SOURCE_STAGING_CACHE_SIZE:
+            break
+        if path == keep:
+            continue
+        # tasks that still read a removed file are not affected
+        rm_file(path)
+        total_size -= size
+    return True
+
+
 def clean_query(query):
     """This is used to clear text in order to comply with SearchQuery
     known exception cases
@@ -816,6 +1308,116 @@ def seconds_to_timestamp(seconds):
     return f"{hours:02d}:{minutes:02d}:{seconds_int:02d}.{milliseconds:03d}"  # noqa
 
 
+def produce_fast_preview_command(media_file, output_file, resolution):
+    """ffmpeg command for a low resolution h264 rendition, encoded as fast
+    as possible, so that a video is playable before its regular encodings
+    """
+
+    return [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-i",
+        media_file,
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        "-filter:v",
+        # scale only, the frame rate of the input is kept
+        get_scale_fps_filters(30, resolution)[0],
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-crf",
+        "28",
+        "-pix_fmt",
+        "yuv420p",
+        "-c:a",
+        "aac",
+        "-b:a",
+        "96k",
+        "-ac",
+        "2",
+        "-movflags",
+        "+faststart",
+        output_file,
+    ]
+
+
+def produce_sprites_command(media_file, output_file, duration, interval, width=SPRITE_WIDTH, height=SPRITE_HEIGHT):
+    """ffmpeg command that produces the sprites image of a video in a single run
+
+    Only keyframes are decoded, one frame every interval seconds is scaled
+    and all frames are tiled on a single column, in one image.
+    Returns the command and the number of frames of the sprites image
+    """
+
+    frames = max(1, math.ceil(duration / interval))
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-skip_frame",
+        "nokey",
+        "-i",
+        media_file,
+        "-an",
+        "-sn",
+        "-vf",
+        f"fps=1/{interval},scale={width}:{height},tile=1x{frames}",
+        "-frames:v",
+        "1",
+        "-update",
+        "1",
+    ]
+    if output_file.endswith(".jpg"):
+        cmd.extend(["-q:v", "4"])
+    cmd.append(output_file)
+    return cmd, frames
+
+
+def produce_sprites_vtt(sprites_url, frames, duration, interval, width=SPRITE_WIDTH, height=SPRITE_HEIGHT):
+    """WebVTT thumbnails track, with the coordinates of each frame on the sprites image"""
+
+    lines = ["WEBVTT", ""]
+    for i in range(frames):
+        start = i * interval
+        if start >= duration:
+            break
+        end = min((i + 1) * interval, duration)
+        lines.append(f"{seconds_to_timestamp(start)} --> {seconds_to_timestamp(end)}")
+        lines.append(f"{sprites_url}#xywh=0,{i * height},{width},{height}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def produce_image_derivatives(input_file, output_prefix, widths):
+    """Produce resized JPEG and WebP renditions of an image, uses Pillow
+
+    Renditions are saved as {output_prefix}_{width}w.{jpg,webp}, only for
+    widths smaller than the image. Returns a dict of format to a dict of
+    width to path, eg {"jpeg": {160: "/path/x_160w.jpg"}, "webp": {...}}
+    """
+
+    ret = {"jpeg": {}, "webp": {}}
+    with Image.open(input_file) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        for width in sorted(widths):
+            if width > im.width:
+                continue
+            height = max(1, round(im.height * width / im.width))
+            resized = im.resize((width, height), Image.LANCZOS)
+            jpeg_file = f"{output_prefix}_{width}w.jpg"
+            resized.save(jpeg_file, "JPEG", quality=80, optimize=True, progressive=True)
+            ret["jpeg"][width] = jpeg_file
+            webp_file = f"{output_prefix}_{width}w.webp"
+            resized.save(webp_file, "WEBP", quality=75, method=4)
+            ret["webp"][width] = webp_file
+    return ret
+
+
 def get_trim_timestamps(media_file_path, timestamps_list, run_ffprobe=False):
     """Process a list of timestamps to align start times with I-frames for better video trimming
 
@@ -1,20 +1,30 @@
 # Kudos to Werner Robitza, AVEQ GmbH, for helping with ffmpeg
 # related content
 
+import heapq
 import itertools
+import json
 import logging
 import os
 import random
 import re
+import signal
+import socket
 import subprocess
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.core.mail import EmailMessage
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
 from django.utils import timezone
+from django_redis import get_redis_connection
 
 from cms import celery_app
 
@@ -23,6 +33,76 @@ from .helpers import mask_ip
 
 logger = logging.getLogger(__name__)
 
+# watch/like/dislike actions are buffered in Redis and written to the db
+# in batches by the flush_user_actions task, other actions by save_user_action
+BUFFERED_USER_ACTIONS = ["watch", "like", "dislike"]
+USER_ACTIONS_KEY_PREFIX = "user_actions"
+USER_ACTIONS_COUNTERS_KEY = f"{USER_ACTIONS_KEY_PREFIX}:counters"
+USER_ACTIONS_STREAM_KEY = f"{USER_ACTIONS_KEY_PREFIX}:stream"
+# safety cap, in case the flusher is not running
+USER_ACTIONS_STREAM_MAXLEN = 1000000
+# like/dislike are once per user, this protects the actions not in the db yet
+USER_ACTIONS_THROTTLE_TTL = 60 * 60
+# Media counters of the buffered actions
+USER_ACTIONS_COUNTER_FIELDS = {"watch": "views", "like": "likes", "dislike": "dislikes"}
+
+# sorted set of media ids by trending score. Scores are stored relative to an
+# epoch, an action at time t adds weight * 2 ** ((t - epoch) / half life), so
+# that older actions count exponentially less without updating every score
+TRENDING_SCORES_KEY = "trending:scores"
+TRENDING_EPOCH_KEY = "trending:epoch"
+# scores are added and rebased by scripts, so that an increment is never
+# computed for an epoch and applied after the scores moved to a new one
+ADD_TRENDING_SCORES_SCRIPT = """
+local now = tonumber(ARGV[1])
+local epoch = tonumber(redis.call("GET", KEYS[2]))
+if not epoch then
+    redis.call("SET", KEYS[2], ARGV[1])
+    epoch = now
+end
+local decay = 2 ^ ((now - epoch) / tonumber(ARGV[2]))
+for i = 3, #ARGV, 2 do
+    redis.call("ZINCRBY", KEYS[1], tonumber(ARGV[i + 1]) * decay, ARGV[i])
+end
+return decay
+"""
+REBASE_TRENDING_SCORES_SCRIPT = """
+local now = tonumber(ARGV[1])
+local epoch = tonumber(redis.call("GET", KEYS[2]))
+if epoch then
+    local factor = 2 ^ (-(now - epoch) / tonumber(ARGV[2]))
+    redis.call("ZUNIONSTORE", KEYS[1], 1, KEYS[1], "WEIGHTS", factor)
+end
+redis.call("SET", KEYS[2], ARGV[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[3])
+return 1
+"""
+
+# encode jobs wait on a sorted set per owner (user or RBAC group) and are
+# dispatched to the workers round robin across owners, by dispatch_encodes
+ENCODE_QUEUE_KEY_PREFIX = "encode_queue"
+ENCODE_QUEUE_OWNERS_KEY = f"{ENCODE_QUEUE_KEY_PREFIX}:owners"
+ENCODE_QUEUE_RING_KEY = f"{ENCODE_QUEUE_KEY_PREFIX}:ring"
+ENCODE_QUEUE_IN_FLIGHT_KEY = f"{ENCODE_QUEUE_KEY_PREFIX}:in_flight"
+# jobs of the first playable renditions score below this, so they are
+# dispatched ahead of the higher renditions of every owner
+ENCODE_QUEUE_FIRST_PLAYABLE_SCORE = 10**10
+
+# CPUs reserved by the running encodes of a worker host, a hash of
+# reservation key to the reserved CPUs and when the reservation expires
+ENCODE_CPUS_KEY_PREFIX = "encode_cpus"
+ENCODE_CPUS_LOCK_TIMEOUT = 10
+
+# the throughput of a stage/profile is estimated from that many latest timings
+THROUGHPUT_SAMPLES = 50
+THROUGHPUT_CACHE_TIMEOUT = 60 * 10
+# seconds of media processed per second, for stages with no timings yet
+DEFAULT_THROUGHPUT = 1.0
+
+# ids whose media_count is recomputed once the transaction commits,
+# see mark_media_counts_dirty
+_media_counts_dirty = threading.local()
+
 
 def get_user_or_session(request):
     """Return a dictionary with user info
@@ -91,6 +171,69 @@ def pre_save_action(media, user, session_key, action, remote_ip):
     return False
 
 
+def record_user_action(user_or_session, media, action):
+    """Append a watch/like/dislike action to the write-behind buffer in Redis
+
+    The action is added to a stream, that the flush_user_actions task writes
+    to the db, and the counters of actions not flushed yet are kept on a hash.
+    Returns False if the action is throttled
+    """
+
+    user_id = user_or_session.get("user_id")
+    session_key = user_or_session.get("user_session")
+    remote_ip = user_or_session.get("remote_ip_addr")
+    if not (user_id or session_key):
+        return False
+
+    # same checks as pre_save_action, on the actions not written to the db yet
+    if action == "watch":
+        ttl = media.duration or settings.TIME_TO_ACTION_ANONYMOUS
+        ip_ttl = max(ttl, settings.TIME_TO_ACTION_ANONYMOUS)
+    else:
+        ttl = USER_ACTIONS_THROTTLE_TTL
+        ip_ttl = settings.TIME_TO_ACTION_ANONYMOUS
+    throttle_key = f"{USER_ACTIONS_KEY_PREFIX}:throttle:{media.id}:{action}"
+    throttle_keys = []
+    if user_id:
+        throttle_keys.append((f"{throttle_key}:user:{user_id}", ttl))
+    else:
+        throttle_keys.append((f"{throttle_key}:session:{session_key}", ttl))
+        if remote_ip:
+            throttle_keys.append((f"{throttle_key}:ip:{remote_ip}", ip_ttl))
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    for key, key_ttl in throttle_keys:
+        pipe.set(key, 1, nx=True, ex=int(key_ttl))
+    if not all(pipe.execute()):
+        return False
+
+    record = {
+        "media_id": media.id,
+        "action": action,
+        "user_id": user_id or "",
+        "session_key": session_key or "",
+        "remote_ip": remote_ip or "",
+    }
+    pipe = redis.pipeline()
+    pipe.hincrby(USER_ACTIONS_COUNTERS_KEY, f"{media.id}:{action}", 1)
+    pipe.xadd(USER_ACTIONS_STREAM_KEY, record, maxlen=USER_ACTIONS_STREAM_MAXLEN, approximate=True)
+    pipe.execute()
+    return True
+
+
+def get_pending_user_action_counts(media):
+    """Counters of the buffered actions of a media, not in the db yet
+
+    Returns a dict of Media counter field to number of actions, that are
+    added to the counters of the media when it is served
+    """
+
+    fields = [f"{media.id}:{action}" for action in USER_ACTIONS_COUNTER_FIELDS]
+    values = get_redis_connection("default").hmget(USER_ACTIONS_COUNTERS_KEY, fields)
+    return {field: int(value) for field, value in zip(USER_ACTIONS_COUNTER_FIELDS.values(), values) if value and int(value) > 0}
+
+
 def is_mediacms_editor(user):
     """Whether user is MediaCMS editor"""
 
@@ -215,16 +358,179 @@ URL: %s
     return True
 
 
+def add_trending_scores(increments):
+    """Add actions to the trending scores of media
+
+    increments is a dict of media id to a dict of action to number of actions
+    """
+
+    args = [time.time(), settings.TRENDING_SCORE_HALF_LIFE]
+    for media_id, actions in increments.items():
+        score = sum(settings.TRENDING_SCORE_WEIGHTS.get(action, 0) * number for action, number in actions.items())
+        if score:
+            args += [media_id, score]
+    if len(args) > 2:
+        redis = get_redis_connection("default")
+        redis.register_script(ADD_TRENDING_SCORES_SCRIPT)(keys=[TRENDING_SCORES_KEY, TRENDING_EPOCH_KEY], args=args)
+    return True
+
+
+def rebase_trending_scores(min_score):
+    """Move the trending scores to the current time as the epoch, so that
+    they don't grow unbounded, and remove media with a lower score
+    """
+
+    redis = get_redis_connection("default")
+    args = [time.time(), settings.TRENDING_SCORE_HALF_LIFE, min_score]
+    redis.register_script(REBASE_TRENDING_SCORES_SCRIPT)(keys=[TRENDING_SCORES_KEY, TRENDING_EPOCH_KEY], args=args)
+    return True
+
+
+def get_trending_media_ids(limit):
+    """Ids of the media with the highest trending score"""
+
+    redis = get_redis_connection("default")
+    return [int(media_id) for media_id in redis.zrevrange(TRENDING_SCORES_KEY, 0, limit - 1)]
+
+
+def get_encode_queue_owner(user):
+    """Owner that the encodes of a user's media are queued for"""
+
+    if settings.ENCODE_FAIR_SHARE_BY == "rbac_group":
+        group_id = user.rbac_memberships.order_by("rbac_group_id").values_list("rbac_group_id", flat=True).first()
+        if group_id:
+            return f"group:{group_id}"
+    return f"user:{user.id}"
+
+
+def get_encode_queue_key(owner):
+    return f"{ENCODE_QUEUE_KEY_PREFIX}:{owner}"
+
+
+def push_encode_job(owner, job, first_playable=False):
+    """Add an encode job to the queue of an owner
+
+    Jobs of an owner are dispatched first playable first, then in order
+    """
+
+    redis = get_redis_connection("default")
+    score = time.time()
+    if not first_playable:
+        score += ENCODE_QUEUE_FIRST_PLAYABLE_SCORE
+    redis.zadd(get_encode_queue_key(owner), {json.dumps(job): score})
+    if redis.sadd(ENCODE_QUEUE_OWNERS_KEY, owner):
+        redis.rpush(ENCODE_QUEUE_RING_KEY, owner)
+    return True
+
+
+def get_encode_queue_depth(owner):
+    """Number of encode jobs waiting to be dispatched for an owner"""
+
+    redis = get_redis_connection("default")
+    return redis.zcard(get_encode_queue_key(owner))
+
+
+def get_encode_cpus_key():
+    return f"{ENCODE_CPUS_KEY_PREFIX}:{socket.gethostname()}"
+
+
+def reserve_encode_cpus(key, threads):
+    """Reserve CPUs of this worker host for an encode
+
+    Returns the list of reserved CPUs, or None if there are not enough free
+    CPUs in the budget of the host. Encodes that want more CPUs than the
+    budget get the whole budget
+    """
+
+    redis = get_redis_connection("default")
+    cpus_key = get_encode_cpus_key()
+    cpus = helpers.get_encode_cpus()
+    with redis.lock(f"{cpus_key}:lock", timeout=ENCODE_CPUS_LOCK_TIMEOUT):
+        now = time.time()
+        used = set()
+        for field, value in redis.hgetall(cpus_key).items():
+            reservation = json.loads(value)
+            if reservation["expires"] < now:
+                # the encode was lost without releasing its CPUs
+                redis.hdel(cpus_key, field)
+                continue
+            used.update(reservation["cpus"])
+
+        free = [cpu for cpu in cpus if cpu not in used]
+        threads = max(1, min(threads, len(cpus)))
+        if len(free) < threads:
+            return None
+        reserved = free[:threads]
+        # encodes are stopped after CELERY_SOFT_TIME_LIMIT
+        reservation = {"cpus": reserved, "expires": now + settings.CELERY_SOFT_TIME_LIMIT + 60}
+        redis.hset(cpus_key, key, json.dumps(reservation))
+    return reserved
+
+
+def release_encode_cpus(key):
+    redis = get_redis_connection("default")
+    redis.hdel(get_encode_cpus_key(), key)
+    return True
+
+
+def mark_media_counts_dirty(users=(), categories=(), tags=()):
+    """Recompute the media_count of users, categories and tags on commit
+
+    Ids are collected for the thread until the transaction commits, so that
+    many media saves in a transaction lead to a single update per model.
+    Outside of a transaction the update runs right away
+    """
+
+    dirty = getattr(_media_counts_dirty, "ids", None)
+    if dirty is None:
+        dirty = _media_counts_dirty.ids = {"users": set(), "categories": set(), "tags": set()}
+    dirty["users"].update(users)
+    dirty["categories"].update(categories)
+    dirty["tags"].update(tags)
+    # callbacks of a rolled back transaction are dropped, so one is added
+    # on every call, the first one to run flushes all ids
+    transaction.on_commit(flush_media_counts)
+    return True
+
+
+def flush_media_counts():
+    dirty = getattr(_media_counts_dirty, "ids", None)
+    if not dirty:
+        return False
+    _media_counts_dirty.ids = None
+    update_media_counts(**dirty)
+    return True
+
+
+def update_media_counts(users=(), categories=(), tags=()):
+    """Set media_count of users, categories and tags, one query per model"""
+
+    from users.models import User
+
+    def count(field, **filters):
+        # count of media per outer row, grouped by the related field
+        media = models.Media.objects.filter(**{field: OuterRef("pk")}, **filters).order_by().values(field)
+        return Coalesce(Subquery(media.annotate(count=Count("id")).values("count")), 0)
+
+    if users:
+        User.objects.filter(id__in=users).update(media_count=count("user", listable=True))
+    # all media of a category count, see Category.update_category_media
+    if categories:
+        models.Category.objects.filter(id__in=categories).update(media_count=count("category"))
+    if tags:
+        models.Tag.objects.filter(id__in=tags).update(media_count=count("tags", state="public", is_reviewed=True))
+    return True
+
+
 def show_recommended_media(request, limit=100):
     """Return a list of recommended media
     used on the index page
     """
 
     basic_query = Q(listable=True)
-    pmi = cache.get("popular_media_ids")
-    # produced by task get_list_of_popular_media and cached
-    if pmi:
-        media = list(models.Media.objects.filter(friendly_token__in=pmi).filter(basic_query).prefetch_related("user")[:limit])
+    trending_ids = get_trending_media_ids(limit)
+    if trending_ids:
+        media = list(models.Media.objects.filter(id__in=trending_ids).filter(basic_query).prefetch_related("user")[:limit])
     else:
         media = list(models.Media.objects.filter(basic_query).order_by("-views", "-likes").prefetch_related("user")[:limit])
     random.shuffle(media)
@@ -446,27 +752,49 @@ def can_transcribe_video(user):
     return False
 
 
-def kill_ffmpeg_process(filepath):
-    """Kill ffmpeg process that is processing a specific file
+def register_ffmpeg_process(encodings, pid):
+    """Record on encodings the ffmpeg process that runs them
+
+    Called by FFmpegBackend.encode, with pid None once ffmpeg has exited
+
+    Args:
+        encodings: Encoding objects run by the ffmpeg process
+        pid: pid of the ffmpeg process, or None
+    """
+    host = socket.gethostname() if pid else ""
+    for encoding in encodings:
+        encoding.ffmpeg_pid = pid
+        encoding.ffmpeg_host = host
+    models.Encoding.objects.filter(id__in=[encoding.id for encoding in encodings]).update(ffmpeg_pid=pid, ffmpeg_host=host)
+    return True
+
+
+def kill_ffmpeg_process(encoding):
+    """Kill the ffmpeg process that is running an encoding
+
+    ffmpeg is started in its own session (see FFmpegBackend._spawn), so its
+    pid is also the id of its process group, which is killed as a whole
 
     Args:
-        filepath: Path to the file being processed by ffmpeg
+        encoding: Encoding object, with the pid recorded by register_ffmpeg_process
 
     Returns:
-        bool: True if the lookup ran, False if input was unusable
+        bool: True if the process was killed, False otherwise
     """
-    if not filepath or not isinstance(filepath, str):
+    pid = getattr(encoding, "ffmpeg_pid", None)
+    if not pid:
+        return False
+    if encoding.ffmpeg_host != socket.gethostname():
+        logger.info(f"Cannot kill ffmpeg process {pid} of encoding {encoding.id}, it runs on {encoding.ffmpeg_host}")
         return False
     try:
-        ps = subprocess.run(["ps", "aux"], stdout=subprocess.PIPE, check=False)
+        # a pid that has been reused would not lead its own session
+        if os.getsid(pid) != pid:
+            return False
+        os.killpg(pid, signal.SIGKILL)
     except OSError:
+        # process has exited meanwhile
         return False
-    for line in ps.stdout.decode("utf-8", "replace").splitlines():
-        if "ffmpeg" not in line or filepath not in line or "grep" in line:
-            continue
-        parts = line.split()
-        if len(parts) > 1 and parts[1].isdigit():
-            subprocess.run(["kill", "-9", parts[1]], check=False)
     return True
 
 
@@ -547,11 +875,21 @@ def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)"):
             poster_name = helpers.get_file_name(original_media.uploaded_poster.path)
             new_media.uploaded_poster.save(poster_name, File(f))
 
+    if original_media.thumbnail_derivatives:
+        new_media.produce_thumbnail_derivatives()
+
     if original_media.sprites:
         with open(original_media.sprites.path, 'rb') as f:
             sprites_name = helpers.get_file_name(original_media.sprites.path)
             new_media.sprites.save(sprites_name, File(f))
 
+    if original_media.sprites_vtt and new_media.sprites:
+        # the track points to the sprites file, point it to the copy
+        with open(original_media.sprites_vtt.path, 'r') as f:
+            vtt = f.read().replace(original_media.sprites_url, new_media.sprites_url)
+        vtt_name = helpers.get_file_name(original_media.sprites_vtt.path)
+        new_media.sprites_vtt.save(vtt_name, ContentFile(vtt.encode("utf-8")))
+
     if original_media.hls_file and os.path.exists(original_media.hls_file):
         p = os.path.dirname(original_media.hls_file)
         if os.path.exists(p):
@@ -641,6 +979,134 @@ def list_tasks():
     return ret
 
 
+def get_throughput_model():
+    """Seconds of media processed per wall clock second
+
+    Returns a dict of (stage, profile id) to throughput, estimated from the
+    latest ProcessingTiming objects of each stage/profile. Profile id is None
+    for the stages that are not per profile, and for the average of a stage
+    """
+
+    model = cache.get("throughput_model")
+    if model is not None:
+        return model
+
+    timings = (
+        models.ProcessingTiming.objects.filter(run_time__gt=0, media_duration__gt=0)
+        .annotate(row_number=Window(RowNumber(), partition_by=[F("stage"), F("profile_id")], order_by=F("add_date").desc()))
+        .filter(row_number__lte=THROUGHPUT_SAMPLES)
+        .values_list("stage", "profile_id", "media_duration", "run_time")
+    )
+    totals = {}
+    for stage, profile_id, media_duration, run_time in timings:
+        keys = [(stage, profile_id)]
+        if profile_id is not None:
+            keys.append((stage, None))
+        for key in keys:
+            total = totals.setdefault(key, [0, 0])
+            total[0] += media_duration
+            total[1] += run_time
+
+    model = {key: media_duration / run_time for key, (media_duration, run_time) in totals.items()}
+    cache.set("throughput_model", model, timeout=THROUGHPUT_CACHE_TIMEOUT)
+    return model
+
+
+def estimate_run_time(model, stage, profile_id, media_duration):
+    throughput = model.get((stage, profile_id)) or model.get((stage, None)) or DEFAULT_THROUGHPUT
+    return media_duration / throughput
+
+
+def get_encoding_backlog():
+    """Expected ready time of the media that are being encoded,
+    and the backlog of the workers
+
+    Encodes are assumed to run in order, running ones first, on
+    ENCODE_DISPATCH_MAX_IN_FLIGHT parallel slots, or as many as the running
+    encodes if it is not set. A media is ready when its
+    last encode, and the chunks concatenation and HLS packaging after it,
+    are done
+    """
+
+    model = get_throughput_model()
+    encodings = models.Encoding.objects.filter(status__in=["pending", "running"]).values(
+        "status",
+        "add_date",
+        "progress",
+        "chunk",
+        "chunks_info",
+        "profile_id",
+        "profile__extension",
+        "profile__codec",
+        "media_id",
+        "media__friendly_token",
+        "media__title",
+        "media__duration",
+    )
+    encodings = sorted(encodings, key=lambda e: (e["status"] != "running", e["add_date"]))
+
+    chunks_number = {}
+    parallel_encodes = settings.ENCODE_DISPATCH_MAX_IN_FLIGHT or sum(1 for encoding in encodings if encoding["status"] == "running")
+    slots = [0.0] * max(1, parallel_encodes)
+    media = {}
+    backlog_media_seconds = 0
+    backlog_seconds = 0
+    for encoding in encodings:
+        duration = encoding["media__duration"] or 0
+        if encoding["chunk"]:
+            if encoding["chunks_info"] not in chunks_number:
+                try:
+                    chunks_number[encoding["chunks_info"]] = max(1, len(json.loads(encoding["chunks_info"])))
+                except (TypeError, ValueError):
+                    chunks_number[encoding["chunks_info"]] = 1
+            duration = duration / chunks_number[encoding["chunks_info"]]
+        media_seconds = duration * (100 - encoding["progress"]) / 100
+        run_time = estimate_run_time(model, "encode", encoding["profile_id"], media_seconds)
+        backlog_media_seconds += media_seconds
+        backlog_seconds += run_time
+
+        # next free slot
+        end = heapq.heappop(slots) + run_time
+        heapq.heappush(slots, end)
+
+        item = media.setdefault(
+            encoding["media_id"],
+            {"friendly_token": encoding["media__friendly_token"], "title": encoding["media__title"], "ready_in": 0, "after_encode": {}},
+        )
+        item["ready_in"] = max(item["ready_in"], end)
+        # stages that run on a profile once all its encodes are done
+        after_encode = 0
+        if encoding["chunk"]:
+            after_encode += estimate_run_time(model, "concat", encoding["profile_id"], encoding["media__duration"] or 0)
+        if encoding["profile__extension"] == "mp4" and encoding["profile__codec"] == "h264":
+            after_encode += estimate_run_time(model, "hls", encoding["profile_id"], encoding["media__duration"] or 0)
+        item["after_encode"][encoding["profile_id"]] = after_encode
+
+    now = timezone.now()
+    ret = {
+        "backlog_media_hours": round(backlog_media_seconds / 3600, 2),
+        "backlog_encode_hours": round(backlog_seconds / 3600, 2),
+        "parallel_encodes": len(slots),
+        "media": [],
+        "throughput": [],
+    }
+    for item in media.values():
+        ready_in = item["ready_in"] + sum(item["after_encode"].values())
+        ret["media"].append(
+            {
+                "friendly_token": item["friendly_token"],
+                "title": item["title"],
+                "expected_ready": now + timedelta(seconds=ready_in),
+            }
+        )
+    ret["media"].sort(key=lambda m: m["expected_ready"])
+
+    profiles = dict(models.EncodeProfile.objects.values_list("id", "name"))
+    for (stage, profile_id), throughput in sorted(model.items(), key=lambda i: (i[0][0], i[0][1] or 0)):
+        ret["throughput"].append({"stage": stage, "profile": profiles.get(profile_id, ""), "throughput": round(throughput, 2)})
+    return ret
+
+
 def handle_video_chapters(media, chapters):
     video_chapter = models.VideoChapterData.objects.filter(media=media).first()
     if video_chapter:
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:39
+
+from django.db import migrations, models
+
+import files.models.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0018_embedmediacourse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='sprites_vtt',
+            field=models.FileField(blank=True, help_text='WebVTT thumbnails track with the position of each frame on the sprites file', max_length=500, upload_to=files.models.utils.original_thumbnail_file_path),
+        ),
+    ]
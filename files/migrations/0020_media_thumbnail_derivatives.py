@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0019_media_sprites_vtt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='thumbnail_derivatives',
+            field=models.JSONField(blank=True, default=dict, help_text='resized JPEG/WebP renditions of the thumbnail, automatically produced'),
+        ),
+    ]
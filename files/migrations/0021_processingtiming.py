@@ -0,0 +1,30 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0020_media_thumbnail_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingTiming',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('add_date', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('media_duration', models.FloatField(default=0, help_text='seconds of media processed')),
+                ('run_time', models.FloatField(default=0, help_text='wall clock seconds')),
+                ('stage', models.CharField(choices=[('probe', 'Probe'), ('chunk', 'Chunk'), ('encode', 'Encode'), ('concat', 'Concat'), ('hls', 'HLS'), ('sprites', 'Sprites')], db_index=True, max_length=20)),
+                ('worker', models.CharField(blank=True, max_length=100)),
+                ('media', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='processing_timings', to='files.media')),
+                ('profile', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='files.encodeprofile')),
+            ],
+            options={
+                'ordering': ['-add_date'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0021_processingtiming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='fast_preview_file_path',
+            field=models.CharField(blank=True, help_text='low resolution h264 rendition, played until the regular encodings are ready, path in filesystem', max_length=500),
+        ),
+    ]
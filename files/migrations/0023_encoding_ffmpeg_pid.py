@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 22:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0022_media_fast_preview_file_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encoding',
+            name='ffmpeg_host',
+            field=models.CharField(blank=True, help_text='host of the running ffmpeg process', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='ffmpeg_pid',
+            field=models.PositiveIntegerField(blank=True, null=True, help_text='pid of the running ffmpeg process'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0023_encoding_ffmpeg_pid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subtitle',
+            name='text',
+            field=models.TextField(blank=True, help_text='plain text of the subtitles, used for search'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:10
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0024_subtitle_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubtitleCue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.FloatField(help_text='start time in seconds')),
+                ('end', models.FloatField(help_text='end time in seconds')),
+                ('text', models.TextField()),
+                ('search', django.contrib.postgres.search.SearchVectorField(null=True)),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subtitle_cues', to='files.media')),
+                ('subtitle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cues', to='files.subtitle')),
+            ],
+            options={
+                'ordering': ['start'],
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['search'], name='files_subti_search_048a0a_gin')],
+            },
+        ),
+    ]
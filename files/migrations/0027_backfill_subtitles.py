@@ -0,0 +1,52 @@
+import pysubs2
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+from files.models.subtitle import SUBTITLE_CUES_BATCH_SIZE, clean_subtitle_text
+
+
+def read_subtitle_events(subtitle):
+    try:
+        return list(pysubs2.load(subtitle.subtitle_file.path, encoding="utf-8"))
+    except Exception:
+        # missing or not a valid subtitles file
+        return []
+
+
+def backfill_subtitles(apps, schema_editor):
+    """Store the text and the cues of the subtitles uploaded before they
+    were kept on the db, otherwise they are left out of the media search
+    vectors and of the transcripts search
+    """
+
+    Subtitle = apps.get_model("files", "Subtitle")
+    SubtitleCue = apps.get_model("files", "SubtitleCue")
+    subtitles = Subtitle.objects.exclude(subtitle_file="").filter(text="") | Subtitle.objects.exclude(subtitle_file="").filter(cues__isnull=True)
+    for subtitle in subtitles.distinct().iterator():
+        events = read_subtitle_events(subtitle)
+        if not subtitle.text:
+            text = clean_subtitle_text(" ".join([event.text for event in events]))
+            if text:
+                Subtitle.objects.filter(id=subtitle.id).update(text=text)
+
+        if SubtitleCue.objects.filter(subtitle_id=subtitle.id).exists():
+            continue
+        cues = []
+        for event in events:
+            text = " ".join(event.plaintext.split())
+            if text:
+                cues.append(SubtitleCue(subtitle_id=subtitle.id, media_id=subtitle.media_id, start=event.start / 1000, end=event.end / 1000, text=text))
+        if cues:
+            SubtitleCue.objects.bulk_create(cues, batch_size=SUBTITLE_CUES_BATCH_SIZE)
+            SubtitleCue.objects.filter(subtitle_id=subtitle.id).update(search=SearchVector("text", config="simple"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0026_title_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_subtitles, migrations.RunPython.noop),
+    ]
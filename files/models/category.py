@@ -1,4 +1,6 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
+from django.db.models.functions import Upper
 from django.urls import reverse
 from django.utils.html import strip_tags
 from imagekit.models import ProcessedImageField
@@ -134,6 +136,10 @@ class Tag(models.Model):
 
     class Meta:
         ordering = ["title"]
+        indexes = [
+            # search autocomplete, icontains is UPPER(title) LIKE
+            GinIndex(OpClass(Upper("title"), name="gin_trgm_ops"), name="files_tag_title_trgm"),
+        ]
 
     def get_absolute_url(self):
         return f"{reverse('search')}?t={self.title}"
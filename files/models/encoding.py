@@ -1,9 +1,9 @@
 import json
-import tempfile
+import os
+import socket
+import time
 
-from django.conf import settings
-from django.core.files import File
-from django.db import models
+from django.db import DatabaseError, models, transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
@@ -13,6 +13,7 @@ from .utils import (
     ENCODE_EXTENSIONS,
     ENCODE_RESOLUTIONS,
     MEDIA_ENCODING_STATUS,
+    PROCESSING_STAGES,
     encoding_media_file_path,
 )
 
@@ -56,6 +57,10 @@ class Encoding(models.Model):
 
     logs = models.TextField(blank=True)
 
+    ffmpeg_host = models.CharField(max_length=100, blank=True, help_text="host of the running ffmpeg process")
+
+    ffmpeg_pid = models.PositiveIntegerField(blank=True, null=True, help_text="pid of the running ffmpeg process")
+
     md5sum = models.CharField(max_length=50, blank=True, null=True)
 
     media = models.ForeignKey("Media", on_delete=models.CASCADE, related_name="encodings")
@@ -82,6 +87,16 @@ class Encoding(models.Model):
 
     worker = models.CharField(max_length=100, blank=True)
 
+    def __init__(self, *args, **kwargs):
+        super(Encoding, self).__init__(*args, **kwargs)
+        # keep track of the stored status, thus know
+        # when a chunk becomes ready on saves
+        self.__original_status = self.status
+
+    @property
+    def status_changed(self):
+        return self.status != self.__original_status
+
     @property
     def media_encoding_url(self):
         if self.media_file:
@@ -95,28 +110,35 @@ class Encoding(models.Model):
         return None
 
     def save(self, *args, **kwargs):
-        if self.media_file:
-            cmd = ["stat", "-c", "%s", self.media_file.path]
-            stdout = helpers.run_command(cmd).get("out")
-            if stdout:
-                size = int(stdout.strip())
+        update_fields = kwargs.get("update_fields")
+        # size and md5sum only change along with the files, skip them
+        # on the frequent saves of status, progress etc
+        if self.media_file and (update_fields is None or "media_file" in update_fields):
+            size = self.get_file_size()
+            if size:
                 self.size = helpers.show_file_size(size)
-        if self.chunk_file_path and not self.md5sum:
-            cmd = ["md5sum", self.chunk_file_path]
-            stdout = helpers.run_command(cmd).get("out")
-            if stdout:
-                md5sum = stdout.strip().split()[0]
-                self.md5sum = md5sum
+                if update_fields is not None:
+                    kwargs["update_fields"] = {*update_fields, "size"}
+        if self.chunk_file_path and not self.md5sum and (update_fields is None or "chunk_file_path" in update_fields):
+            self.md5sum = helpers.get_file_md5sum(self.chunk_file_path)
+            if self.md5sum and update_fields is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "md5sum"}
 
         super(Encoding, self).save(*args, **kwargs)
+        self.__original_status = self.status
+
+    def get_file_size(self):
+        """Size of the encoding file in bytes, None if it does not exist"""
+        try:
+            return os.path.getsize(self.media_file.path)
+        except OSError:
+            return None
 
     def update_size_without_save(self):
         """Update the size of an encoding without saving to avoid calling signals"""
         if self.media_file:
-            cmd = ["stat", "-c", "%s", self.media_file.path]
-            stdout = helpers.run_command(cmd).get("out")
-            if stdout:
-                size = int(stdout.strip())
+            size = self.get_file_size()
+            if size:
                 size = helpers.show_file_size(size)
                 Encoding.objects.filter(pk=self.pk).update(size=size)
                 return True
@@ -136,6 +158,55 @@ class Encoding(models.Model):
         return f"{self.profile.name}-{self.media.title}"
 
 
+class ProcessingTiming(models.Model):
+    """Run time of a processing stage of a media
+
+    The throughput of each stage/profile, seconds of media processed
+    per second, is estimated from these
+    """
+
+    add_date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    media = models.ForeignKey("Media", on_delete=models.SET_NULL, null=True, blank=True, related_name="processing_timings")
+
+    media_duration = models.FloatField(default=0, help_text="seconds of media processed")
+
+    profile = models.ForeignKey(EncodeProfile, on_delete=models.SET_NULL, null=True, blank=True)
+
+    run_time = models.FloatField(default=0, help_text="wall clock seconds")
+
+    stage = models.CharField(max_length=20, choices=PROCESSING_STAGES, db_index=True)
+
+    worker = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        ordering = ["-add_date"]
+
+    def __str__(self):
+        return f"{self.stage}-{self.run_time:.1f}s"
+
+    @classmethod
+    def record(cls, stage, started, media=None, profile=None, media_duration=None, run_time=None):
+        """Keep the run time of a stage that started at time.monotonic() started"""
+
+        if run_time is None:
+            run_time = time.monotonic() - started
+        if media_duration is None:
+            media_duration = media.duration if media else 0
+        try:
+            return cls.objects.create(
+                stage=stage,
+                media=media,
+                profile=profile,
+                media_duration=media_duration or 0,
+                run_time=run_time,
+                worker=socket.gethostname(),
+            )
+        except DatabaseError:
+            # eg media was deleted meanwhile
+            return None
+
+
 @receiver(post_save, sender=Encoding)
 def encoding_file_save(sender, instance, created, **kwargs):
     """Performs actions on encoding file delete
@@ -144,12 +215,13 @@ def encoding_file_save(sender, instance, created, **kwargs):
     concatenate chunks, create final encoding file and delete chunks
     """
 
-    if instance.chunk and instance.status == "success":
-        # a chunk got completed
+    if instance.chunk and instance.status == "success" and instance.status_changed:
+        # a chunk got completed. Other saves of a ready chunk, eg of its logs,
+        # don't start the assembly again
 
-        # check if all chunks are OK
-        # then concatenate to new Encoding - and remove chunks
-        # this should run only once!
+        # check if all chunks are OK, with a single query. Concatenation
+        # of the chunks to the final encoding happens on task
+        # assemble_encoding_chunks, that makes sure this is run only once
         if instance.media_file:
             try:
                 orig_chunks = json.loads(instance.chunks_info).keys()
@@ -157,103 +229,22 @@ def encoding_file_save(sender, instance, created, **kwargs):
                 instance.delete()
                 return False
 
-            chunks = Encoding.objects.filter(
-                media=instance.media,
-                profile=instance.profile,
-                chunks_info=instance.chunks_info,
-                chunk=True,
-            ).order_by("add_date")
-
-            complete = True
-
-            # perform validation, make sure everything is there
-            for chunk in orig_chunks:
-                if not chunks.filter(chunk_file_path=chunk):
-                    complete = False
-                    break
-
-            for chunk in chunks:
-                if not (chunk.media_file and chunk.media_file.path):
-                    complete = False
-                    break
-
-            if complete:
-                # concatenate chunks and create final encoding file
-                chunks_paths = [f.media_file.path for f in chunks]
-
-                with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
-                    seg_file = helpers.create_temp_file(suffix=".txt", dir=temp_dir)
-                    tf = helpers.create_temp_file(suffix=f".{instance.profile.extension}", dir=temp_dir)
-                    with open(seg_file, "w") as ff:
-                        for f in chunks_paths:
-                            ff.write(f"file {f}\n")
-                    cmd = [
-                        settings.FFMPEG_COMMAND,
-                        "-y",
-                        "-f",
-                        "concat",
-                        "-safe",
-                        "0",
-                        "-i",
-                        seg_file,
-                        "-c",
-                        "copy",
-                        "-pix_fmt",
-                        "yuv420p",
-                        "-movflags",
-                        "faststart",
-                        tf,
-                    ]
-                    stdout = helpers.run_command(cmd)
-
-                    encoding = Encoding(
-                        media=instance.media,
-                        profile=instance.profile,
-                        status="success",
-                        progress=100,
-                    )
-                    all_logs = "\n".join([st.logs for st in chunks])
-                    encoding.logs = f"{chunks_paths}\n{stdout}\n{all_logs}"
-                    workers = list(set([st.worker for st in chunks]))
-                    encoding.worker = json.dumps({"workers": workers})
-
-                    start_date = min([st.add_date for st in chunks])
-                    end_date = max([st.update_date for st in chunks])
-                    encoding.total_run_time = (end_date - start_date).seconds
-                    encoding.save()
-
-                    with open(tf, "rb") as f:
-                        myfile = File(f)
-                        output_name = f"{helpers.get_file_name(instance.media.media_file.path)}.{instance.profile.extension}"
-                        encoding.media_file.save(content=myfile, name=output_name)
-
-                    # encoding is saved, deleting chunks
-                    # and any other encoding that might exist
-                    # first perform one last validation
-                    # to avoid that this is run twice
-                    if (
-                        len(orig_chunks)
-                        == Encoding.objects.filter(  # noqa
-                            media=instance.media,
-                            profile=instance.profile,
-                            chunks_info=instance.chunks_info,
-                        ).count()
-                    ):
-                        # if two chunks are finished at the same time, this
-                        # will be changed
-                        who = Encoding.objects.filter(media=encoding.media, profile=encoding.profile).exclude(id=encoding.id)
-                        who.delete()
-                    else:
-                        encoding.delete()
-                    if not Encoding.objects.filter(chunks_info=instance.chunks_info):
-                        # TODO: in case of remote workers, files should be deleted
-                        # example
-                        # for worker in workers:
-                        #    for chunk in json.loads(instance.chunks_info).keys():
-                        #        remove_media_file.delay(media_file=chunk)
-                        for chunk in json.loads(instance.chunks_info).keys():
-                            helpers.rm_file(chunk)
-                    instance.media.post_encode_actions(encoding=instance, action="add")
+            completed = (
+                Encoding.objects.filter(
+                    media=instance.media,
+                    profile=instance.profile,
+                    chunks_info=instance.chunks_info,
+                    chunk=True,
+                    status="success",
+                )
+                .exclude(media_file="")
+                .count()
+            )
+
+            if completed >= len(orig_chunks):
+                from .. import tasks
+
+                transaction.on_commit(lambda encoding_id=instance.id: tasks.assemble_encoding_chunks.delay(encoding_id))
 
     elif instance.chunk and instance.status == "fail":
         encoding = Encoding(media=instance.media, profile=instance.profile, status="fail", progress=100)
@@ -3,15 +3,18 @@ import json
 import logging
 import os
 import random
+import time
 import uuid
+from urllib.parse import quote
 
 import m3u8
 from django.conf import settings
-from django.contrib.postgres.indexes import GinIndex
-from django.contrib.postgres.search import SearchVectorField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.files import File
 from django.db import models, transaction
-from django.db.models import Func, Value
+from django.db.models import Value
+from django.db.models.functions import Upper
 from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.urls import reverse
@@ -22,7 +25,7 @@ from imagekit.processors import ResizeToFit
 
 from .. import helpers
 from ..stop_words import STOP_WORDS
-from .encoding import EncodeProfile, Encoding
+from .encoding import EncodeProfile, Encoding, ProcessingTiming
 from .subtitle import TranscriptionRequest
 from .utils import (
     ENCODE_RESOLUTIONS_KEYS,
@@ -36,6 +39,12 @@ from .video_data import VideoTrimRequest
 
 logger = logging.getLogger(__name__)
 
+# saves that touch none of these fields leave the media_count of the user,
+# categories and tags unchanged
+MEDIA_COUNT_FIELDS = {"user", "state", "listable", "is_reviewed"}
+# fields of the media itself that are part of the search vector
+SEARCH_VECTOR_FIELDS = {"friendly_token", "title", "description", "user"}
+
 
 class Media(models.Model):
     """The most important model for MediaCMS"""
@@ -114,6 +123,12 @@ class Media(models.Model):
         help_text="preview gif for videos, path in filesystem",
     )
 
+    fast_preview_file_path = models.CharField(
+        max_length=500,
+        blank=True,
+        help_text="low resolution h264 rendition, played until the regular encodings are ready, path in filesystem",
+    )
+
     poster = ProcessedImageField(
         upload_to=original_thumbnail_file_path,
         processors=[ResizeToFit(width=720, height=None)],
@@ -151,6 +166,13 @@ class Media(models.Model):
         help_text="sprites file, only for videos, displayed on the video player",
     )
 
+    sprites_vtt = models.FileField(
+        upload_to=original_thumbnail_file_path,
+        blank=True,
+        max_length=500,
+        help_text="WebVTT thumbnails track with the position of each frame on the sprites file",
+    )
+
     state = models.CharField(
         max_length=20,
         choices=MEDIA_STATES,
@@ -173,6 +195,12 @@ class Media(models.Model):
         help_text="media extracted small thumbnail, shown on listings",
     )
 
+    thumbnail_derivatives = models.JSONField(
+        blank=True,
+        default=dict,
+        help_text="resized JPEG/WebP renditions of the thumbnail, automatically produced",
+    )
+
     thumbnail_time = models.FloatField(blank=True, null=True, help_text="Time on video that a thumbnail will be taken")
 
     uid = models.UUIDField(unique=True, default=uuid.uuid4, help_text="A unique identifier for the Media")
@@ -219,7 +247,9 @@ class Media(models.Model):
         indexes = [
             # TODO: check with pgdash.io or other tool what index need be
             # removed
-            GinIndex(fields=["search"])
+            GinIndex(fields=["search"]),
+            # search autocomplete, icontains is UPPER(title) LIKE
+            GinIndex(OpClass(Upper("title"), name="gin_trgm_ops"), name="files_media_title_trgm"),
         ]
 
     def __str__(self):
@@ -315,6 +345,7 @@ class Media(models.Model):
                 myfile = File(f)
                 thumbnail_name = helpers.get_file_name(self.uploaded_poster.path)
                 self.uploaded_thumbnail.save(content=myfile, name=thumbnail_name)
+            self.produce_thumbnail_derivatives()
 
     def transcribe_function(self):
         to_transcribe = False
@@ -347,27 +378,34 @@ class Media(models.Model):
         """
         Update SearchVector field of SearchModel using raw SQL
         search field is used to store SearchVector
+
+        Text is weighted by where it comes from, title A, tags B,
+        description and uploader C, subtitles D
         """
 
-        # first get anything interesting out of the media
-        # that needs to be search able
+        def prepare(*items):
+            text = " ".join([item for item in items if item])
+            text = " ".join([token for token in text.lower().split(" ") if token not in STOP_WORDS])
+            return helpers.clean_query(text)
 
-        a_tags = ""
+        tags = ""
         if self.id:
-            a_tags = " ".join([tag.title for tag in self.tags.all()])
+            tags = " ".join([tag.title for tag in self.tags.all()])
 
-        items = [self.friendly_token, self.title, self.user.username, self.user.email, self.user.name, self.description, a_tags]
+        subtitles = [subtitle.text for subtitle in self.subtitles.all()]
 
-        for subtitle in self.subtitles.all():
-            items.append(subtitle.subtitle_text)
-
-        items = [item for item in items if item]
-        text = " ".join(items)
-        text = " ".join([token for token in text.lower().split(" ") if token not in STOP_WORDS])
-
-        text = helpers.clean_query(text)
+        weighted_texts = [
+            (prepare(self.title), "A"),
+            (prepare(tags), "B"),
+            (prepare(self.description, self.friendly_token, self.user.username, self.user.email, self.user.name), "C"),
+            (prepare(*subtitles), "D"),
+        ]
+        search = None
+        for text, weight in weighted_texts:
+            vector = SearchVector(Value(text), config="simple", weight=weight)
+            search = vector if search is None else search + vector
 
-        Media.objects.filter(id=self.id).update(search=Func(Value('simple'), Value(text), function='to_tsvector'))
+        Media.objects.filter(id=self.id).update(search=search)
 
         return True
 
@@ -394,6 +432,8 @@ class Media(models.Model):
                 self.produce_sprite_from_video()
             else:
                 self.produce_sprite_from_video()
+                if settings.USE_FAST_PREVIEW:
+                    self.produce_fast_preview()
                 self.encode()
         elif self.media_type == "image":
             self.set_thumbnail(force=True)
@@ -418,6 +458,7 @@ class Media(models.Model):
         if self.media_type in ["image", "pdf"]:
             self.encoding_status = "success"
         else:
+            started = time.monotonic()
             ret = helpers.media_file_info(self.media_file.path)
 
             if ret.get("fail"):
@@ -454,6 +495,9 @@ class Media(models.Model):
                 self.duration = int(float(ret.get("audio_info", {}).get("duration", 0)))
                 self.encoding_status = "success"
 
+            if not ret.get("fail") and self.pk:
+                ProcessingTiming.record("probe", started, media=self)
+
         if save:
             self.save(
                 update_fields=[
@@ -487,6 +531,7 @@ class Media(models.Model):
                     self.thumbnail.save(content=myfile, name=thumbnail_name, save=False)
                     self.poster.save(content=myfile, name=thumbnail_name, save=False)
                     self.save(update_fields=["thumbnail", "poster"])
+                self.produce_thumbnail_derivatives()
 
         return True
 
@@ -509,7 +554,7 @@ class Media(models.Model):
             "-ss",
             str(thumbnail_time),  # -ss need to be firt here otherwise time taken is huge
             "-i",
-            self.media_file.path,
+            helpers.stage_source_file(self.media_file.path, self.uid.hex, self.md5sum),
             "-vframes",
             "1",
             "-y",
@@ -526,9 +571,20 @@ class Media(models.Model):
                 self.thumbnail.save(content=myfile, name=thumbnail_name, save=False)
                 self.poster.save(content=myfile, name=thumbnail_name, save=False)
                 self.save(update_fields=["thumbnail", "poster"])
+            self.produce_thumbnail_derivatives()
         helpers.rm_file(tf)
         return True
 
+    def produce_thumbnail_derivatives(self):
+        """Start a task that will produce resized renditions
+        of the thumbnail, to be served through srcset
+        """
+
+        from .. import tasks
+
+        transaction.on_commit(lambda token=self.friendly_token: tasks.produce_thumbnail_derivatives.delay(token))
+        return True
+
     def produce_sprite_from_video(self):
         """Start a task that will produce a sprite file
         To be used on the video player
@@ -538,9 +594,28 @@ class Media(models.Model):
 
         # Defer until the surrounding transaction commits so the worker can
         # actually find the Media row. Runs immediately if not in a tx.
-        transaction.on_commit(lambda token=self.friendly_token: tasks.produce_sprite_from_video.delay(token))
+        transaction.on_commit(lambda token=self.friendly_token: tasks.enqueue_coalesced(tasks.produce_sprite_from_video, token))
+        return True
+
+    def produce_fast_preview(self):
+        """Start a task that will produce a low resolution rendition
+        fast, so that the video is playable before the regular encodings
+        """
+
+        from .. import tasks
+
+        transaction.on_commit(lambda token=self.friendly_token: tasks.produce_fast_preview.delay(token))
         return True
 
+    @property
+    def fast_preview_resolution(self):
+        """FAST_PREVIEW_RESOLUTION, or the closest lower resolution for smaller videos"""
+
+        resolution = settings.FAST_PREVIEW_RESOLUTION
+        if self.video_height:
+            resolution = min(resolution, self.video_height)
+        return max([r for r in ENCODE_RESOLUTIONS_KEYS if r <= resolution], default=min(ENCODE_RESOLUTIONS_KEYS))
+
     def encode(self, profiles=[], force=True, chunkize=True):
         """Start video encoding tasks
         Create a task per EncodeProfile object, after checking height
@@ -561,31 +636,34 @@ class Media(models.Model):
                     profiles.remove(profile)
                     encoding = Encoding(media=self, profile=profile)
                     encoding.save()
-                    tasks.encode_media.apply_async(
-                        args=[self.friendly_token, profile.id, encoding.id],
-                        kwargs={"force": force},
-                        priority=0,
-                    )
+                    tasks.enqueue_encode(self, tasks.encode_media, [self.friendly_token, profile.id, encoding.id], {"force": force}, [encoding.id], [profile])
             profiles = [p.id for p in profiles]
             tasks.chunkize_media.delay(self.friendly_token, profiles, force=force)
         else:
+            to_profiles = []
             for profile in profiles:
                 if profile.extension != "gif":
                     if self.video_height and self.video_height < profile.resolution:
                         if profile.resolution not in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
                             continue
+                to_profiles.append(profile)
+
+            # profiles that can be encoded from a single decode of the file
+            ladder_profiles, to_profiles = tasks.split_ladder_profiles(to_profiles)
+            if ladder_profiles:
+                encoding_ids = []
+                for profile in ladder_profiles:
+                    encoding = Encoding(media=self, profile=profile)
+                    encoding.save()
+                    encoding_ids.append(encoding.id)
+                tasks.enqueue_encode(self, tasks.encode_media_ladder, [self.friendly_token, encoding_ids], {"force": force}, encoding_ids, ladder_profiles)
+
+            for profile in to_profiles:
                 encoding = Encoding(media=self, profile=profile)
                 encoding.save()
-                if profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
-                    priority = 9
-                else:
-                    priority = 0
-                tasks.encode_media.apply_async(
-                    args=[self.friendly_token, profile.id, encoding.id],
-                    kwargs={"force": force},
-                    priority=priority,
-                )
+                tasks.enqueue_encode(self, tasks.encode_media, [self.friendly_token, profile.id, encoding.id], {"force": force}, [encoding.id], [profile])
 
+        transaction.on_commit(tasks.dispatch_encodes.delay)
         return True
 
     def post_encode_actions(self, encoding=None, action=None):
@@ -593,6 +671,23 @@ class Media(models.Model):
         whether it has failed or succeeded
         """
 
+        update_fields = ["encoding_status", "listable", "preview_file_path"]
+
+        # the fast preview is stored by its own task, possibly after this
+        # instance was loaded, so it is not saved unless cleared here.
+        # Not refresh_from_db, that loads a deferred Media and __init__
+        # reads its fields
+        self.fast_preview_file_path = Media.objects.filter(id=self.id).values_list("fast_preview_file_path", flat=True).first() or ""
+        if self.fast_preview_file_path:
+            # the fast preview is replaced once a regular encoding of at least
+            # its resolution is ready, or all regular encodings have run
+            encodings = self.encodings.filter(profile__extension__in=["mp4", "webm"]).values_list("status", "profile__resolution", "chunk")
+            replaced = any(status == "success" and resolution >= self.fast_preview_resolution and not chunk for status, resolution, chunk in encodings)
+            if replaced or not any(status in ["pending", "running"] for status, _, _ in encodings):
+                helpers.rm_file(self.fast_preview_file_path)
+                self.fast_preview_file_path = ""
+                update_fields.append("fast_preview_file_path")
+
         self.set_encoding_status()
 
         # set a preview url
@@ -603,17 +698,17 @@ class Media(models.Model):
                 else:
                     self.preview_file_path = encoding.media_file.path
 
-        self.save(update_fields=["encoding_status", "listable", "preview_file_path"])
+        self.save(update_fields=update_fields)
 
         if encoding and encoding.status == "success" and encoding.profile.codec == "h264" and action == "add" and not encoding.chunk:
             from .. import tasks
 
-            tasks.create_hls.delay(self.friendly_token)
+            tasks.enqueue_coalesced(tasks.create_hls, self.friendly_token)
 
             # TODO: ideally would ensure this is run only at the end when the last encoding is done...
             vt_request = VideoTrimRequest.objects.filter(media=self, status="running").first()
             if vt_request:
-                tasks.post_trim_action.delay(self.friendly_token)
+                tasks.enqueue_coalesced(tasks.post_trim_action, self.friendly_token)
                 vt_request.status = "success"
                 vt_request.save(update_fields=["status"])
         return True
@@ -625,10 +720,13 @@ class Media(models.Model):
         mp4_statuses = set(encoding.status for encoding in self.encodings.filter(profile__extension="mp4", chunk=False))
         webm_statuses = set(encoding.status for encoding in self.encodings.filter(profile__extension="webm", chunk=False))
 
-        if not mp4_statuses and not webm_statuses:
-            encoding_status = "pending"
-        elif "success" in mp4_statuses or "success" in webm_statuses:
+        if "success" in mp4_statuses or "success" in webm_statuses:
             encoding_status = "success"
+        elif self.fast_preview_file_path:
+            # playable through the fast preview
+            encoding_status = "success"
+        elif not mp4_statuses and not webm_statuses:
+            encoding_status = "pending"
         elif "running" in mp4_statuses or "running" in webm_statuses:
             encoding_status = "running"
         else:
@@ -689,6 +787,14 @@ class Media(models.Model):
             resolution = encoding.profile.resolution
             ret[resolution][encoding.profile.codec] = enc
 
+        if self.fast_preview_file_path and ret[self.fast_preview_resolution].get("h264", {}).get("status") != "success":
+            ret[self.fast_preview_resolution]["h264"] = {
+                "title": "fast preview",
+                "url": helpers.url_from_path(self.fast_preview_file_path),
+                "progress": 100,
+                "status": "success",
+            }
+
         # TODO: the following code is untested/needs optimization
 
         # if a file is broken in chunks and they are being
@@ -763,6 +869,34 @@ class Media(models.Model):
             return helpers.url_from_path("userlogos/poster_audio.jpg")
         return None
 
+    @property
+    def thumbnail_renditions(self):
+        """Returns the resized renditions of the thumbnail per format,
+        as a dict of width to url, by increasing width
+        """
+
+        ret = {}
+        for image_format, files in (self.thumbnail_derivatives or {}).items():
+            # quoted, spaces and commas separate srcset candidates
+            ret[image_format] = {int(width): f"{settings.MEDIA_URL}{quote(files[width])}" for width in sorted(files.keys(), key=int)}
+        return ret
+
+    def get_thumbnail_srcset(self, build_url=None):
+        """Returns the resized renditions of the thumbnail per format,
+        as srcset values. build_url can make the urls absolute
+        """
+
+        ret = {}
+        for image_format, renditions in self.thumbnail_renditions.items():
+            ret[image_format] = ", ".join(f"{build_url(url) if build_url else url} {width}w" for width, url in renditions.items())
+        return ret
+
+    @property
+    def thumbnail_srcset(self):
+        """Property used on serializers"""
+
+        return self.get_thumbnail_srcset()
+
     @property
     def poster_url(self):
         """Property used on serializers
@@ -838,6 +972,16 @@ class Media(models.Model):
             return helpers.url_from_path(self.sprites.path)
         return None
 
+    @property
+    def sprites_vtt_url(self):
+        """Property used on serializers
+        Returns WebVTT thumbnails track url
+        """
+
+        if self.sprites_vtt:
+            return helpers.url_from_path(self.sprites_vtt.path)
+        return None
+
     @property
     def preview_url(self):
         """Property used on serializers
@@ -1026,36 +1170,34 @@ def media_save(sender, instance, created, **kwargs):
     if not instance.friendly_token:
         return False
 
-    if created:
-        from ..methods import notify_users
+    from ..methods import mark_media_counts_dirty, notify_users
 
+    if created:
         instance.media_init()
         notify_users(friendly_token=instance.friendly_token, action="media_added")
 
-    instance.user.update_user_media()
-    if instance.category.all():
-        # this won't catch when a category
-        # is removed from a media, which is what we want...
-        for category in instance.category.all():
-            category.update_category_media()
+    # one field saves, eg of encoding_status or sprites, skip the counts
+    update_fields = kwargs.get("update_fields")
+    if update_fields is None or not MEDIA_COUNT_FIELDS.isdisjoint(update_fields):
+        mark_media_counts_dirty(
+            users=[instance.user_id],
+            categories=instance.category.values_list("id", flat=True),
+            tags=instance.tags.values_list("id", flat=True),
+        )
 
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            tag.update_tag_media()
-
-    instance.update_search_vector()
+    if update_fields is None or not SEARCH_VECTOR_FIELDS.isdisjoint(update_fields):
+        instance.update_search_vector()
 
 
 @receiver(pre_delete, sender=Media)
 def media_file_pre_delete(sender, instance, **kwargs):
-    if instance.category.all():
-        for category in instance.category.all():
-            instance.category.remove(category)
-            category.update_category_media()
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            instance.tags.remove(tag)
-            tag.update_tag_media()
+    from ..methods import mark_media_counts_dirty
+
+    categories = list(instance.category.values_list("id", flat=True))
+    tags = list(instance.tags.values_list("id", flat=True))
+    instance.category.clear()
+    instance.tags.clear()
+    mark_media_counts_dirty(categories=categories, tags=tags)
 
 
 @receiver(post_delete, sender=Media)
@@ -1076,11 +1218,20 @@ def media_file_delete(sender, instance, **kwargs):
         helpers.rm_file(instance.uploaded_poster.path)
     if instance.sprites:
         helpers.rm_file(instance.sprites.path)
+    if instance.sprites_vtt:
+        helpers.rm_file(instance.sprites_vtt.path)
+    if instance.fast_preview_file_path:
+        helpers.rm_file(instance.fast_preview_file_path)
+    for files in (instance.thumbnail_derivatives or {}).values():
+        for path in files.values():
+            helpers.rm_file(os.path.join(settings.MEDIA_ROOT, path))
     if instance.hls_file:
         p = os.path.dirname(instance.hls_file)
         helpers.rm_dir(p)
 
-    instance.user.update_user_media()
+    from ..methods import mark_media_counts_dirty
+
+    mark_media_counts_dirty(users=[instance.user_id])
 
     # remove extra zombie thumbnails
     if instance.thumbnail:
@@ -1091,10 +1242,17 @@ def media_file_delete(sender, instance, **kwargs):
 
 
 @receiver(m2m_changed, sender=Media.category.through)
-def media_m2m(sender, instance, **kwargs):
-    if instance.category.all():
-        for category in instance.category.all():
-            category.update_category_media()
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            tag.update_tag_media()
+def media_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    from ..methods import mark_media_counts_dirty
+
+    if not action.startswith("post_"):
+        return
+    if reverse:
+        # category.media.add(...) etc
+        mark_media_counts_dirty(categories=[instance.id])
+        return
+    # pk_set has the categories that were removed
+    mark_media_counts_dirty(
+        categories=[*instance.category.values_list("id", flat=True), *(pk_set or ())],
+        tags=instance.tags.values_list("id", flat=True),
+    )
@@ -3,6 +3,8 @@ import tempfile
 
 import pysubs2
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -11,6 +13,16 @@ from django.urls import reverse
 from .. import helpers
 from .utils import MEDIA_ENCODING_STATUS, subtitles_file_path
 
+SUBTITLE_CUES_BATCH_SIZE = 1000
+
+
+def clean_subtitle_text(text):
+    text = text.replace("\\N", " ")
+    text = text.replace("-", " ")
+    text = text.replace(".", " ")
+    text = text.replace("  ", " ")
+    return text
+
 
 class Language(models.Model):
     """Language model
@@ -44,6 +56,8 @@ class Subtitle(models.Model):
 
     user = models.ForeignKey("users.User", on_delete=models.CASCADE)
 
+    text = models.TextField(blank=True, help_text="plain text of the subtitles, used for search")
+
     class Meta:
         verbose_name = "Caption"
         verbose_name_plural = "Captions"
@@ -55,6 +69,39 @@ class Subtitle(models.Model):
     def get_absolute_url(self):
         return f"{reverse('edit_subtitle')}?id={self.id}"
 
+    def parse(self):
+        """Read the text and the cues of the subtitles file
+
+        Cues are kept until store_cues is called, since they
+        need the subtitle to be saved
+        """
+        try:
+            events = list(pysubs2.load(self.subtitle_file.path, encoding="utf-8"))
+        except Exception:
+            # not a valid subtitles file
+            events = []
+        self.text = clean_subtitle_text(" ".join([event.text for event in events]))
+        self.parsed_cues = []
+        for event in events:
+            text = " ".join(event.plaintext.split())
+            if text:
+                self.parsed_cues.append(SubtitleCue(start=event.start / 1000, end=event.end / 1000, text=text))
+        return True
+
+    def store_cues(self):
+        """Replace the cues of the subtitle with the ones read by parse"""
+        cues = getattr(self, "parsed_cues", None)
+        if cues is None:
+            return False
+        self.parsed_cues = None
+        SubtitleCue.objects.filter(subtitle=self).delete()
+        for cue in cues:
+            cue.subtitle = self
+            cue.media_id = self.media_id
+        SubtitleCue.objects.bulk_create(cues, batch_size=SUBTITLE_CUES_BATCH_SIZE)
+        SubtitleCue.objects.filter(subtitle=self).update(search=SearchVector("text", config="simple"))
+        return True
+
     @property
     def url(self):
         return self.get_absolute_url()
@@ -79,13 +126,33 @@ class Subtitle(models.Model):
     @property
     def subtitle_text(self):
         sub = pysubs2.load(self.subtitle_file.path, encoding="utf-8")
-        text = ' '.join([line.text for line in sub])
-        text = text.replace("\\N", " ")
-        text = text.replace("-", " ")
-        text = text.replace(".", " ")
-        text = text.replace("  ", " ")
+        return clean_subtitle_text(' '.join([line.text for line in sub]))
+
+
+class SubtitleCue(models.Model):
+    """A cue of a subtitle, so that search can point to
+    the time of a media where the text is said
+    """
 
-        return text
+    subtitle = models.ForeignKey(Subtitle, on_delete=models.CASCADE, related_name="cues")
+
+    # same as subtitle.media, avoids a join when searching
+    media = models.ForeignKey("Media", on_delete=models.CASCADE, related_name="subtitle_cues")
+
+    start = models.FloatField(help_text="start time in seconds")
+
+    end = models.FloatField(help_text="end time in seconds")
+
+    text = models.TextField()
+
+    search = SearchVectorField(null=True)
+
+    class Meta:
+        ordering = ["start"]
+        indexes = [GinIndex(fields=["search"])]
+
+    def __str__(self):
+        return f"{self.subtitle}-{self.start}"
 
 
 class TranscriptionRequest(models.Model):
@@ -105,10 +172,13 @@ class TranscriptionRequest(models.Model):
 
 
 @receiver(post_save, sender=Subtitle)
-def subtitle_save(sender, instance, created, **kwargs):
+def subtitle_save(sender, instance, created, update_fields=None, **kwargs):
     from .. import tasks
 
-    tasks.update_search_vector.apply_async(
-        args=[instance.media.friendly_token],
-        countdown=10,
-    )
+    # parse the file once here, instead of on every search vector update.
+    # The file is only stored by save, so this can't happen before it
+    if instance.subtitle_file and (update_fields is None or "subtitle_file" in update_fields):
+        instance.parse()
+        Subtitle.objects.filter(id=instance.id).update(text=instance.text)
+    instance.store_cues()
+    tasks.enqueue_coalesced(tasks.update_search_vector, instance.media.friendly_token)
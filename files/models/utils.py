@@ -13,6 +13,17 @@ MEDIA_ENCODING_STATUS = (
     ("success", "Success"),
 )
 
+# processing stages that their run time is kept for,
+# to estimate when media will be ready
+PROCESSING_STAGES = (
+    ("probe", "Probe"),
+    ("chunk", "Chunk"),
+    ("encode", "Encode"),
+    ("concat", "Concat"),
+    ("hls", "HLS"),
+    ("sprites", "Sprites"),
+)
+
 # the media state of a Media object
 # this is set by default according to the portal workflow
 MEDIA_STATES = (
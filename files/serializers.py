@@ -13,6 +13,7 @@ class MediaSerializer(serializers.ModelSerializer):
     url = serializers.SerializerMethodField()
     api_url = serializers.SerializerMethodField()
     thumbnail_url = serializers.SerializerMethodField()
+    thumbnail_srcset = serializers.SerializerMethodField()
     author_profile = serializers.SerializerMethodField()
     author_thumbnail = serializers.SerializerMethodField()
 
@@ -28,6 +29,9 @@ class MediaSerializer(serializers.ModelSerializer):
         else:
             return None
 
+    def get_thumbnail_srcset(self, obj):
+        return obj.get_thumbnail_srcset(build_url=self.context["request"].build_absolute_uri)
+
     def get_author_profile(self, obj):
         return self.context["request"].build_absolute_uri(obj.author_profile())
 
@@ -65,6 +69,7 @@ class MediaSerializer(serializers.ModelSerializer):
             "state",
             "duration",
             "thumbnail_url",
+            "thumbnail_srcset",
             "is_reviewed",
             "preview_url",
             "author_name",
@@ -163,10 +168,12 @@ class SingleMediaSerializer(CategoriesInfoMixin, serializers.ModelSerializer):
             "is_shared",
             "duration",
             "thumbnail_url",
+            "thumbnail_srcset",
             "poster_url",
             "thumbnail_time",
             "url",
             "sprites_url",
+            "sprites_vtt_url",
             "preview_url",
             "author_name",
             "author_profile",
@@ -214,6 +221,7 @@ class MediaSearchSerializer(CategoriesInfoMixin, serializers.ModelSerializer):
             "author_name",
             "author_profile",
             "thumbnail_url",
+            "thumbnail_srcset",
             "add_date",
             "views",
             "description",
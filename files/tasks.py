@@ -1,8 +1,11 @@
+import functools
 import json
+import math
 import os
 import re
 import shutil
 import tempfile
+import time
 from datetime import datetime, timedelta
 
 from celery import Task
@@ -14,8 +17,12 @@ from celery.utils.log import get_task_logger
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
-from django.db import DatabaseError
-from django.db.models import Q
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django_redis import get_redis_connection
 
 from actions.models import USER_MEDIA_ACTIONS, MediaAction
 from users.models import User
@@ -23,24 +30,57 @@ from users.models import User
 from .backends import FFmpegBackend
 from .exceptions import VideoEncodingError
 from .helpers import (
-    calculate_seconds,
+    JPEG_MAX_DIMENSION,
+    SPRITE_HEIGHT,
     create_temp_file,
+    get_chunk_encode_cache_path,
+    get_encode_threads,
+    get_ffmpeg_commands_fingerprint,
     get_file_name,
     get_file_type,
     get_trim_timestamps,
+    get_video_keyframes,
+    md5sum_file,
     media_file_info,
+    merge_hls_master_playlists,
+    plan_video_chunks,
+    produce_fast_preview_command,
     produce_ffmpeg_commands,
     produce_friendly_token,
+    produce_image_derivatives,
+    produce_ladder_ffmpeg_command,
+    produce_sprites_command,
+    produce_sprites_vtt,
     rm_file,
     run_command,
+    show_file_size,
+    stage_source_file,
+    store_in_chunk_encode_cache,
     trim_video_method,
+    url_from_path,
 )
 from .methods import (
+    ENCODE_QUEUE_FIRST_PLAYABLE_SCORE,
+    ENCODE_QUEUE_IN_FLIGHT_KEY,
+    ENCODE_QUEUE_OWNERS_KEY,
+    ENCODE_QUEUE_RING_KEY,
+    TRENDING_SCORES_KEY,
+    USER_ACTIONS_COUNTER_FIELDS,
+    USER_ACTIONS_COUNTERS_KEY,
+    USER_ACTIONS_STREAM_KEY,
+    add_trending_scores,
     copy_video,
+    get_encode_queue_key,
+    get_encode_queue_owner,
     kill_ffmpeg_process,
     list_tasks,
     notify_users,
     pre_save_action,
+    push_encode_job,
+    rebase_trending_scores,
+    register_ffmpeg_process,
+    release_encode_cpus,
+    reserve_encode_cpus,
 )
 from .models import (
     Category,
@@ -48,12 +88,14 @@ from .models import (
     Encoding,
     Language,
     Media,
+    ProcessingTiming,
     Rating,
     Subtitle,
     Tag,
     TranscriptionRequest,
     VideoTrimRequest,
 )
+from .models.utils import original_thumbnail_file_path
 
 logger = get_task_logger(__name__)
 
@@ -65,6 +107,93 @@ ERRORS_LIST = [
     "Unable to find a suitable output format for",
 ]
 
+USER_ACTIONS_FLUSH_BATCH = 10000
+USER_ACTIONS_FLUSH_LOCK_TIMEOUT = 60 * 10
+# decreases the pending counters by the flushed actions, and removes the
+# counters that reach zero, so that the hash only holds media with pending
+# actions. Atomic, so that actions recorded meanwhile are not lost
+DECREASE_PENDING_COUNTERS_SCRIPT = """
+local n = #ARGV / 2
+for i = 1, n do
+    if redis.call("HINCRBY", KEYS[1], ARGV[i], -tonumber(ARGV[n + i])) <= 0 then
+        redis.call("HDEL", KEYS[1], ARGV[i])
+    end
+end
+return n
+"""
+
+# top media per category/tag fetched at once, when picking listings thumbnails
+LISTINGS_THUMBNAIL_CANDIDATES = 5
+
+# media with a lower trending score (at the current epoch) are removed
+TRENDING_SCORE_MIN = 0.01
+
+# triggers of a per media task within this many seconds get coalesced
+COALESCE_DELAY = 10
+# a pending key outlives a task that was lost before it started
+COALESCE_PENDING_TIMEOUT = 60 * 30
+COALESCE_SUPPRESSED_KEY_PREFIX = "coalesce_suppressed"
+
+HLS_LOCK_TIMEOUT = 60 * 60
+
+ENCODE_DISPATCH_LOCK_TIMEOUT = 60 * 5
+# dispatched encodes whose Encoding is still pending after this many seconds
+# are considered lost, same as the broker visibility timeout
+ENCODE_IN_FLIGHT_TIMEOUT = 60 * 60 * 24
+# encodes that do not fit in the CPU budget of a worker are tried again after
+ENCODE_ADMISSION_RETRY_DELAY = 30
+
+
+def get_coalesce_key(task_name, friendly_token):
+    return f"coalesce_pending:{task_name}:{friendly_token}"
+
+
+def enqueue_coalesced(task, friendly_token, countdown=COALESCE_DELAY):
+    """Schedule a per media task, unless one is already pending for the media
+
+    Triggers that arrive before the pending task starts are dropped, since
+    that task will see their changes. The task has to call clear_coalesced
+    when it starts. Dropped triggers are counted per task name
+    """
+
+    if cache.add(get_coalesce_key(task.name, friendly_token), 1, timeout=COALESCE_PENDING_TIMEOUT):
+        task.apply_async(args=[friendly_token], countdown=countdown)
+        return True
+
+    counter_key = f"{COALESCE_SUPPRESSED_KEY_PREFIX}:{task.name}"
+    cache.add(counter_key, 0, timeout=None)
+    try:
+        cache.incr(counter_key)
+    except ValueError:
+        # evicted in between
+        pass
+    return False
+
+
+def clear_coalesced(task, friendly_token):
+    """Let triggers from now on schedule a new run of the task"""
+
+    cache.delete(get_coalesce_key(task.name, friendly_token))
+
+
+def get_coalesce_suppressed_count(task_name):
+    return cache.get(f"{COALESCE_SUPPRESSED_KEY_PREFIX}:{task_name}", 0)
+
+
+def save_encodings_progress(encoding_ids, processed_seconds, duration):
+    """Store the progress of running encodings with a single UPDATE,
+    without calling signals
+
+    Returns the number of encodings updated, 0 means they don't exist anymore
+    """
+
+    progress = 0
+    if duration:
+        progress = min(int(processed_seconds * 100 / duration), 100)
+    updated = Encoding.objects.filter(id__in=encoding_ids).update(progress=progress, update_date=timezone.now())
+    logger.info(f"Saved progress {progress} for encodings {encoding_ids}")
+    return updated
+
 
 def handle_pending_running_encodings(media):
     """Handle pending and running encodings for a media object.
@@ -84,10 +213,7 @@ def handle_pending_running_encodings(media):
     encodings = media.encodings.exclude(status="success")
     deleted = False
     for encoding in encodings:
-        if encoding.temp_file:
-            kill_ffmpeg_process(encoding.temp_file)
-        if encoding.chunk_file_path:
-            kill_ffmpeg_process(encoding.chunk_file_path)
+        kill_ffmpeg_process(encoding)
         deleted = True
         encoding.delete()
 
@@ -141,17 +267,49 @@ def chunkize_media(self, friendly_token, profiles, force=True):
     file_format = f"{random_prefix}_{file_name}"
     chunks_file_name = f"%02d_{file_format}"
     chunks_file_name += ".mkv"
+
+    started = time.monotonic()
+    split_times = []
+    source_path = stage_source_file(media.media_file.path, media.uid.hex, media.md5sum)
+    keyframes_index = get_video_keyframes(source_path)
+    if keyframes_index:
+        keyframes, total_frames = keyframes_index
+        split_times = plan_video_chunks(
+            keyframes,
+            total_frames,
+            media.duration,
+            workers=settings.VIDEO_CHUNKS_WORKERS,
+            chunk_duration=settings.VIDEO_CHUNKS_DURATION,
+            min_chunk_duration=settings.VIDEO_CHUNKS_MIN_DURATION,
+        )
+    if split_times:
+        # the segment muxer cuts on the first keyframe after each time,
+        # so go slightly before the planned keyframe
+        segment_options = ["-segment_times", ",".join(f"{max(t - 0.001, 0):.3f}" for t in split_times)]
+    else:
+        segment_options = ["-segment_time", str(settings.VIDEO_CHUNKS_DURATION)]
+    logger.info(f"Splitting {friendly_token} with {segment_options}")
+
     cmd = [
         settings.FFMPEG_COMMAND,
         "-y",
         "-i",
-        media.media_file.path,
+        source_path,
         "-c",
         "copy",
+        # no random segment/track UIDs or metadata, so that the same input
+        # gives the same chunks and the chunk encode cache can hit
+        "-fflags",
+        "+bitexact",
+        "-flags:v",
+        "+bitexact",
+        "-flags:a",
+        "+bitexact",
+        "-map_metadata",
+        "-1",
         "-f",
         "segment",
-        "-segment_time",
-        str(settings.VIDEO_CHUNKS_DURATION),
+        *segment_options,
         chunks_file_name,
     ]
     chunks = []
@@ -171,18 +329,17 @@ def chunkize_media(self, friendly_token, profiles, force=True):
                     continue
             encoding = Encoding(media=media, profile=profile)
             encoding.save()
-            encode_media.delay(friendly_token, profile.id, encoding.id, force=force)
+            enqueue_encode(media, encode_media, [friendly_token, profile.id, encoding.id], {"force": force}, [encoding.id], [profile])
+        dispatch_encodes.delay()
         return False
 
     chunks = [os.path.join(cwd, ch) for ch in chunks]
+    ProcessingTiming.record("chunk", started, media=media)
     to_profiles = []
     chunks_dict = {}
     # calculate once md5sums
     for chunk in chunks:
-        cmd = ["md5sum", chunk]
-        stdout = run_command(cmd).get("out")
-        md5sum = stdout.strip().split()[0]
-        chunks_dict[chunk] = md5sum
+        chunks_dict[chunk] = md5sum_file(chunk)
 
     for profile in profiles:
         if media.video_height and media.video_height < profile.resolution:
@@ -190,6 +347,31 @@ def chunkize_media(self, friendly_token, profiles, force=True):
                 continue
         to_profiles.append(profile)
 
+    ladder_profiles, to_profiles_single = split_ladder_profiles(to_profiles)
+    if ladder_profiles:
+        for chunk in chunks:
+            encoding_ids = []
+            for profile in ladder_profiles:
+                encoding = Encoding(
+                    media=media,
+                    profile=profile,
+                    chunk_file_path=chunk,
+                    chunk=True,
+                    chunks_info=json.dumps(chunks_dict),
+                    md5sum=chunks_dict[chunk],
+                )
+                encoding.save()
+                encoding_ids.append(encoding.id)
+            enqueue_encode(
+                media,
+                encode_media_ladder,
+                [friendly_token, encoding_ids],
+                {"force": force, "chunk": True, "chunk_file_path": chunk},
+                encoding_ids,
+                ladder_profiles,
+            )
+
+    for profile in to_profiles_single:
         for chunk in chunks:
             encoding = Encoding(
                 media=media,
@@ -201,21 +383,28 @@ def chunkize_media(self, friendly_token, profiles, force=True):
             )
 
             encoding.save()
-            if profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
-                priority = 0
-            else:
-                priority = 9
-            encode_media.apply_async(
-                args=[friendly_token, profile.id, encoding.id],
-                kwargs={"force": force, "chunk": True, "chunk_file_path": chunk},
-                priority=priority,
+            enqueue_encode(
+                media,
+                encode_media,
+                [friendly_token, profile.id, encoding.id],
+                {"force": force, "chunk": True, "chunk_file_path": chunk},
+                [encoding.id],
+                [profile],
             )
 
+    dispatch_encodes.delay()
     logger.info(f"got {len(chunks)} chunks and will encode to {to_profiles} profiles")
     return True
 
 
 class EncodingTask(Task):
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        if getattr(self, "cpus_reservation", None):
+            release_encode_cpus(self.cpus_reservation)
+            self.cpus_reservation = None
+        # a worker is free, send it the next encode job
+        dispatch_encodes.delay()
+
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         # mainly used to run some post failure steps
         # we get here if a task is revoked
@@ -223,15 +412,181 @@ class EncodingTask(Task):
             if hasattr(self, "encoding"):
                 self.encoding.status = "fail"
                 self.encoding.save(update_fields=["status"])
-                kill_ffmpeg_process(self.encoding.temp_file)
-                kill_ffmpeg_process(self.encoding.chunk_file_path)
+                kill_ffmpeg_process(self.encoding)
                 if hasattr(self.encoding, "media"):
                     self.encoding.media.post_encode_actions()
+            if hasattr(self, "encodings"):
+                # encode_media_ladder, a single ffmpeg process for all encodings
+                for encoding in self.encodings:
+                    encoding.status = "fail"
+                    encoding.save(update_fields=["status"])
+                    kill_ffmpeg_process(encoding)
+                if self.encodings:
+                    self.encodings[0].media.post_encode_actions()
         except BaseException:
             pass
         return False
 
 
+def is_first_playable(profiles):
+    """Whether an encode produces only the renditions that make a media playable
+
+    These are the minimum resolutions, and the gif preview which is cheap
+    """
+
+    return all(profile.extension == "gif" or profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE for profile in profiles)
+
+
+def enqueue_encode(media, task, args, kwargs, encoding_ids, profiles):
+    """Queue an encode_media or encode_media_ladder task for dispatch_encodes
+
+    Jobs are queued per owner of the media, the caller starts
+    dispatch_encodes once it has queued all its jobs
+    """
+
+    first_playable = is_first_playable(profiles)
+    job = {
+        "task": task.name,
+        "args": args,
+        "kwargs": kwargs,
+        "encoding_ids": encoding_ids,
+        # with the Redis broker 0 is the highest priority
+        "priority": 0 if first_playable else 9,
+    }
+    return push_encode_job(get_encode_queue_owner(media.user), job, first_playable=first_playable)
+
+
+def get_encodes_in_flight(redis):
+    """Number of dispatched encodes that have not finished yet"""
+
+    in_flight = {int(encoding_id): float(dispatched) for encoding_id, dispatched in redis.hgetall(ENCODE_QUEUE_IN_FLIGHT_KEY).items()}
+    if not in_flight:
+        return 0
+
+    min_dispatched = time.time() - ENCODE_IN_FLIGHT_TIMEOUT
+    running = set(Encoding.objects.filter(id__in=in_flight.keys(), status__in=["pending", "running"]).values_list("id", flat=True))
+    running = {encoding_id for encoding_id in running if in_flight[encoding_id] > min_dispatched}
+    finished = [encoding_id for encoding_id in in_flight if encoding_id not in running]
+    if finished:
+        redis.hdel(ENCODE_QUEUE_IN_FLIGHT_KEY, *finished)
+    return len(running)
+
+
+def pop_encode_job(redis, owner, max_score):
+    key = get_encode_queue_key(owner)
+    jobs = redis.zrangebyscore(key, "-inf", max_score, start=0, num=1)
+    if not jobs:
+        return None
+    # only dispatch_encodes removes jobs, under its lock
+    redis.zrem(key, jobs[0])
+    return json.loads(jobs[0])
+
+
+def remove_empty_encode_queue_owners(redis):
+    for owner in redis.smembers(ENCODE_QUEUE_OWNERS_KEY):
+        owner = owner.decode()
+        if redis.zcard(get_encode_queue_key(owner)):
+            continue
+        redis.srem(ENCODE_QUEUE_OWNERS_KEY, owner)
+        redis.lrem(ENCODE_QUEUE_RING_KEY, 0, owner)
+        # a job may have been pushed in between
+        if redis.zcard(get_encode_queue_key(owner)) and redis.sadd(ENCODE_QUEUE_OWNERS_KEY, owner):
+            redis.rpush(ENCODE_QUEUE_RING_KEY, owner)
+
+
+@task(name="dispatch_encodes", queue="short_tasks")
+def dispatch_encodes():
+    """Send queued encode jobs to the workers
+
+    Owners are served round robin, and the first playable renditions of
+    all owners go before any higher rendition. If ENCODE_DISPATCH_MAX_IN_FLIGHT
+    is set, only that many encodes are sent at a time, so that a bulk upload
+    of one user waits on its own queue instead of the workers queue
+    """
+
+    lock_key = "dispatch_encodes_lock"
+    if not cache.add(lock_key, 1, timeout=ENCODE_DISPATCH_LOCK_TIMEOUT):
+        return False
+
+    encode_tasks = {encode_media.name: encode_media, encode_media_ladder.name: encode_media_ladder}
+    try:
+        redis = get_redis_connection("default")
+        max_in_flight = settings.ENCODE_DISPATCH_MAX_IN_FLIGHT
+        slots = max_in_flight - get_encodes_in_flight(redis) if max_in_flight else float("inf")
+        dispatched = 0
+        for max_score in (ENCODE_QUEUE_FIRST_PLAYABLE_SCORE, "+inf"):
+            while dispatched < slots:
+                served = False
+                for owner in redis.lrange(ENCODE_QUEUE_RING_KEY, 0, -1):
+                    owner = owner.decode()
+                    job = pop_encode_job(redis, owner, max_score)
+                    if not job:
+                        continue
+                    # served owners go to the back of the ring
+                    redis.lrem(ENCODE_QUEUE_RING_KEY, 1, owner)
+                    redis.rpush(ENCODE_QUEUE_RING_KEY, owner)
+                    if max_in_flight:
+                        redis.hset(ENCODE_QUEUE_IN_FLIGHT_KEY, job["encoding_ids"][0], time.time())
+                    encode_tasks[job["task"]].apply_async(args=job["args"], kwargs=job["kwargs"], priority=job["priority"])
+                    dispatched += 1
+                    served = True
+                    if dispatched >= slots:
+                        break
+                if not served:
+                    break
+        remove_empty_encode_queue_owners(redis)
+    finally:
+        cache.delete(lock_key)
+
+    if dispatched:
+        logger.info(f"dispatched {dispatched} encodes")
+    return True
+
+
+def admit_encode(task, key, threads):
+    """Reserve CPUs of the worker host for an encode task
+
+    Returns the reserved CPUs. If the CPU budget of the host is in use,
+    the task is sent again with a delay, possibly to another host, and
+    None is returned
+    """
+
+    cpus = reserve_encode_cpus(key, threads)
+    if cpus is None:
+        logger.info(f"No CPUs for encode {key} that needs {threads}, trying again in {ENCODE_ADMISSION_RETRY_DELAY} seconds")
+        # it has already waited its turn on dispatch_encodes
+        task.apply_async(args=task.request.args, kwargs=task.request.kwargs, countdown=ENCODE_ADMISSION_RETRY_DELAY, priority=0)
+        return None
+    # released on after_return
+    task.cpus_reservation = key
+    return cpus
+
+
+def split_ladder_profiles(profiles):
+    """Split a list of EncodeProfile objects to the ones that can be encoded
+    on a single ffmpeg run (ladder encoding) and the rest
+
+    The minimum resolutions are left out of the ladder, so that they are
+    encoded on their own and dispatched before the higher resolutions
+    """
+
+    if not getattr(settings, "USE_LADDER_ENCODING", False):
+        return [], list(profiles)
+
+    ladder_codecs = getattr(settings, "LADDER_ENCODING_CODECS", ["h264"])
+    ladder_profiles, other_profiles = [], []
+    for profile in profiles:
+        if profile.extension != "gif" and profile.codec in ladder_codecs and profile.resolution not in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
+            ladder_profiles.append(profile)
+        else:
+            other_profiles.append(profile)
+
+    # a ladder of one rendition is a regular encoding
+    if len(ladder_profiles) < 2:
+        return [], list(profiles)
+    return ladder_profiles, other_profiles
+
+
 @task(
     name="encode_media",
     base=EncodingTask,
@@ -307,12 +662,24 @@ def encode_media(
             except BaseException:
                 encoding = Encoding(media=media, profile=profile, status="running")
 
+    threads = 1
+    if profile.extension != "gif":
+        threads = get_encode_threads(media.media_info, profile.resolution, profile.codec)
+    cpus = admit_encode(self, f"encoding_{encoding_id}", threads)
+    if cpus is None:
+        return False
+
     if task_id:
         encoding.task_id = task_id
     encoding.worker = "localhost"
     encoding.retries = self.request.retries
     encoding.save()
 
+    source_path = media.media_file.path
+    if not chunk:
+        # chunks are local to where they were produced, only the original is staged
+        source_path = stage_source_file(media.media_file.path, media.uid.hex, media.md5sum)
+
     if profile.extension == "gif":
         tf = create_temp_file(suffix=".gif")
         # -ss 5 start from 5 second. -t 25 until 25 sec
@@ -322,7 +689,7 @@ def encode_media(
             "-ss",
             "3",
             "-i",
-            media.media_file.path,
+            source_path,
             "-hide_banner",
             "-vf",
             "scale=344:-1:flags=lanczos,fps=1",
@@ -346,7 +713,7 @@ def encode_media(
     if chunk:
         original_media_path = chunk_file_path
     else:
-        original_media_path = media.media_file.path
+        original_media_path = source_path
 
     # if not media.duration:
     #    encoding.status = "fail"
@@ -364,6 +731,7 @@ def encode_media(
             output_filename=tf,
             pass_file=tfpass,
             chunk=chunk,
+            threads=len(cpus),
         )
         if not ffmpeg_commands:
             encoding.status = "fail"
@@ -375,36 +743,54 @@ def encode_media(
 
         encoding.save(update_fields=["temp_file", "commands", "task_id"])
 
+        cache_path = None
+        if chunk:
+            # chunks are content addressed, an unchanged chunk encoded with the
+            # same profile and the same command has already been produced
+            fingerprint = get_ffmpeg_commands_fingerprint(ffmpeg_commands, original_media_path, tf, tfpass)
+            cache_path = get_chunk_encode_cache_path(encoding.md5sum, profile.id, fingerprint, profile.extension)
+            if cache_path and os.path.exists(cache_path) and os.path.getsize(cache_path) != 0:
+                logger.info(f"Reusing cached encoded chunk {cache_path} for {friendly_token}/{profile_id}/{encoding_id}")
+                # bump mtime, the cache is cleaned based on last use
+                os.utime(cache_path, None)
+                encoding.logs = f"Reused encoded chunk from cache {cache_path}"
+                encoding.progress = 100
+                encoding.status = "success"
+                with open(cache_path, "rb") as f:
+                    myfile = File(f)
+                    output_name = f"{get_file_name(original_media_path)}.{profile.extension}"
+                    encoding.media_file.save(content=myfile, name=output_name)
+                return True
+
         # binding these, so they are available on on_failure
         self.encoding = encoding
         self.media = media
+        started = time.monotonic()
         # can be one-pass or two-pass
         for ffmpeg_command in ffmpeg_commands:
             ffmpeg_command = [str(s) for s in ffmpeg_command]
             encoding_backend = FFmpegBackend()
             try:
-                encoding_command = encoding_backend.encode(ffmpeg_command)
-                duration, n_times = 0, 0
+                encoding_command = encoding_backend.encode(ffmpeg_command, cpus=cpus, on_process=functools.partial(register_ffmpeg_process, [encoding]))
+                progress_saved_at = 0
                 output = ""
                 while encoding_command:
                     try:
                         # TODO: understand an eternal loop
                         # eg h265 with mv4 file issue, and stop with error
-                        output = next(encoding_command)
-                        duration = calculate_seconds(output)
-                        if duration:
-                            percent = duration * 100 / media.duration
-                            if n_times % 60 == 0:
-                                encoding.progress = percent
-                                encoding.save(update_fields=["progress", "update_date"])
-                                logger.info(f"Saved {round(percent, 2)}")
-                            n_times += 1
+                        progress = next(encoding_command)
+                        if isinstance(progress, str):
+                            # the final ffmpeg output
+                            output = progress
+                        elif time.monotonic() - progress_saved_at >= settings.ENCODING_PROGRESS_UPDATE_INTERVAL:
+                            progress_saved_at = time.monotonic()
+                            if not save_encodings_progress([encoding.id], progress, media.duration):
+                                raise DatabaseError("Encoding does not exist")
                     except DatabaseError:
                         # primary reason for this is that the encoding has been deleted, because
                         # the media file was deleted, or also that there was a trim video request
                         # so it would be redundant to let it complete the encoding
-                        kill_ffmpeg_process(encoding.temp_file)
-                        kill_ffmpeg_process(encoding.chunk_file_path)
+                        kill_ffmpeg_process(encoding)
                         return False
 
                     except StopIteration:
@@ -419,8 +805,7 @@ def encode_media(
                     output = e.message
                 except AttributeError:
                     output = ""
-                kill_ffmpeg_process(encoding.temp_file)
-                kill_ffmpeg_process(encoding.chunk_file_path)
+                kill_ffmpeg_process(encoding)
                 encoding.logs = output
                 encoding.status = "fail"
                 try:
@@ -447,6 +832,10 @@ def encode_media(
             if ret.get("is_video") or ret.get("is_audio"):
                 encoding.status = "success"
                 success = True
+                ProcessingTiming.record("encode", started, media=media, profile=profile, media_duration=ret.get("video_duration") or ret.get("audio_duration"))
+
+                if cache_path:
+                    store_in_chunk_encode_cache(tf, cache_path)
 
                 with open(tf, "rb") as f:
                     myfile = File(f)
@@ -464,6 +853,295 @@ def encode_media(
         return success
 
 
+@task(
+    name="encode_media_ladder",
+    base=EncodingTask,
+    bind=True,
+    queue="long_tasks",
+    soft_time_limit=settings.CELERY_SOFT_TIME_LIMIT,
+)
+def encode_media_ladder(
+    self,
+    friendly_token,
+    encoding_ids,
+    force=True,
+    chunk=False,
+    chunk_file_path="",
+):
+    """Encode a media to several profiles with a single ffmpeg run
+
+    The input is decoded once and split to one scale branch per profile,
+    while a separate Encoding is kept for each profile
+    """
+
+    logger.info(f"encode_media_ladder for {friendly_token}/{encoding_ids}/{force}/{chunk}")
+    try:
+        media = Media.objects.get(friendly_token=friendly_token)
+    except BaseException:
+        Encoding.objects.filter(id__in=encoding_ids).delete()
+        return False
+
+    encodings = list(Encoding.objects.filter(id__in=encoding_ids).select_related("profile"))
+    if not encodings:
+        logger.info(f"Exiting for {friendly_token}/{encoding_ids} since encoding ids not found")
+        return False
+
+    threads = {encoding.id: get_encode_threads(media.media_info, encoding.profile.resolution, encoding.profile.codec) for encoding in encodings}
+    cpus = admit_encode(self, f"encoding_{encoding_ids[0]}", sum(threads.values()))
+    if cpus is None:
+        return False
+
+    for encoding in encodings:
+        if chunk:
+            duplicates = Encoding.objects.filter(media=media, profile=encoding.profile, chunk=True, chunk_file_path=chunk_file_path).exclude(id=encoding.id)
+        else:
+            duplicates = Encoding.objects.filter(media=media, profile=encoding.profile).exclude(id=encoding.id)
+        duplicates.delete()
+        encoding.status = "running"
+        if self.request.id:
+            encoding.task_id = self.request.id
+        encoding.worker = "localhost"
+        encoding.retries = self.request.retries
+        encoding.save()
+
+    if chunk:
+        original_media_path = chunk_file_path
+    else:
+        original_media_path = stage_source_file(media.media_file.path, media.uid.hex, media.md5sum)
+
+    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
+        renditions = []
+        for encoding in encodings:
+            tf = create_temp_file(suffix=f".{encoding.profile.extension}", dir=temp_dir)
+            encoding.temp_file = tf
+            renditions.append(
+                {
+                    "resolution": encoding.profile.resolution,
+                    "codec": encoding.profile.codec,
+                    "output_filename": tf,
+                    "threads": threads[encoding.id],
+                }
+            )
+
+        ffmpeg_command = produce_ladder_ffmpeg_command(original_media_path, media.media_info, renditions, chunk=chunk)
+        if not ffmpeg_command:
+            # cannot be encoded as a ladder, eg very short videos need two-pass encoding.
+            # Fall back to one encode_media task per profile
+            for encoding in encodings:
+                encoding.status = "pending"
+                encoding.save(update_fields=["status"])
+                enqueue_encode(
+                    media,
+                    encode_media,
+                    [friendly_token, encoding.profile.id, encoding.id],
+                    {"force": force, "chunk": chunk, "chunk_file_path": chunk_file_path},
+                    [encoding.id],
+                    [encoding.profile],
+                )
+            return False
+
+        for encoding in encodings:
+            encoding.commands = str([ffmpeg_command])
+            encoding.save(update_fields=["temp_file", "commands", "task_id"])
+
+        # binding these, so they are available on on_failure
+        self.encodings = encodings
+        self.media = media
+
+        ffmpeg_command = [str(s) for s in ffmpeg_command]
+        encoding_backend = FFmpegBackend()
+        output = ""
+        started = time.monotonic()
+        try:
+            encoding_command = encoding_backend.encode(ffmpeg_command, cpus=cpus, on_process=functools.partial(register_ffmpeg_process, encodings))
+            progress_saved_at = 0
+            while encoding_command:
+                try:
+                    progress = next(encoding_command)
+                    if isinstance(progress, str):
+                        output = progress
+                    elif time.monotonic() - progress_saved_at >= settings.ENCODING_PROGRESS_UPDATE_INTERVAL:
+                        progress_saved_at = time.monotonic()
+                        if not save_encodings_progress(encoding_ids, progress, media.duration):
+                            # all encodings were deleted, eg media was deleted
+                            for encoding in encodings:
+                                kill_ffmpeg_process(encoding)
+                            return False
+                except StopIteration:
+                    break
+        except Exception as e:
+            try:
+                output = e.message
+            except AttributeError:
+                output = ""
+            for encoding in encodings:
+                kill_ffmpeg_process(encoding)
+                encoding.logs = output
+                encoding.status = "fail"
+                try:
+                    encoding.save(update_fields=["status", "logs"])
+                except DatabaseError:
+                    return False
+            raise_exception = True
+            for error_msg in ERRORS_LIST:
+                if error_msg.lower() in output.lower():
+                    raise_exception = False
+            if raise_exception:
+                raise self.retry(exc=e, countdown=5, max_retries=1)
+            return False
+
+        # the run time of the single ffmpeg run is shared by the renditions
+        run_time = (time.monotonic() - started) / len(encodings)
+        success = False
+        for encoding in encodings:
+            encoding.logs = output
+            encoding.progress = 100
+            encoding.status = "fail"
+            tf = encoding.temp_file
+            if os.path.exists(tf) and os.path.getsize(tf) != 0:
+                ret = media_file_info(tf)
+                if ret.get("is_video") or ret.get("is_audio"):
+                    encoding.status = "success"
+                    success = True
+                    ProcessingTiming.record(
+                        "encode",
+                        started,
+                        media=media,
+                        profile=encoding.profile,
+                        media_duration=ret.get("video_duration") or ret.get("audio_duration"),
+                        run_time=run_time,
+                    )
+                    with open(tf, "rb") as f:
+                        myfile = File(f)
+                        output_name = f"{get_file_name(original_media_path)}.{encoding.profile.extension}"
+                        encoding.media_file.save(content=myfile, name=output_name)
+                    encoding.total_run_time = (encoding.update_date - encoding.add_date).seconds
+            try:
+                encoding.save(update_fields=["status", "logs", "progress", "total_run_time"])
+            except BaseException:
+                pass
+
+        return success
+
+
+@task(name="assemble_encoding_chunks", queue="chunk_assembly", soft_time_limit=60 * 60)
+def assemble_encoding_chunks(encoding_id):
+    """Concatenate the encoded chunks of a media/profile to the final encoding
+
+    Gets called when the last chunk is encoded, with the id of any chunk
+    Encoding. Concurrent calls for the same media/profile are serialized
+    through a row lock on the chunk Encodings, held only while the first
+    call claims the chunks, so concatenation happens exactly once
+    """
+
+    chunk_encoding = Encoding.objects.filter(id=encoding_id, chunk=True).select_related("media", "profile").first()
+    if not chunk_encoding:
+        # chunks have been assembled already
+        return False
+
+    media = chunk_encoding.media
+    profile = chunk_encoding.profile
+    chunks_info = chunk_encoding.chunks_info
+    try:
+        orig_chunks = list(json.loads(chunks_info).keys())
+    except BaseException:
+        return False
+
+    started = time.monotonic()
+    with transaction.atomic():
+        chunks = list(
+            Encoding.objects.select_for_update().filter(
+                media=media,
+                profile=profile,
+                chunks_info=chunks_info,
+                chunk=True,
+            )
+        )
+        completed = {chunk.chunk_file_path: chunk for chunk in chunks if chunk.status == "success" and chunk.media_file}
+        if any(orig_chunk not in completed for orig_chunk in orig_chunks):
+            # not complete, or already claimed by a concurrent run
+            logger.info(f"chunks of {media.friendly_token}/{profile.id} not complete, not assembling")
+            return False
+
+        # chunks_info keeps the chunks in the order they were produced
+        ordered_chunks = [completed[orig_chunk] for orig_chunk in orig_chunks]
+        # claim the chunks, so that the row locks are only held for this
+        # check and not during the concatenation. Update avoids signals
+        chunk_ids = [chunk.id for chunk in ordered_chunks]
+        Encoding.objects.filter(id__in=chunk_ids).update(status="running")
+
+    chunks_paths = [chunk.media_file.path for chunk in ordered_chunks]
+    try:
+        with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
+            seg_file = create_temp_file(suffix=".txt", dir=temp_dir)
+            tf = create_temp_file(suffix=f".{profile.extension}", dir=temp_dir)
+            with open(seg_file, "w") as ff:
+                for f in chunks_paths:
+                    ff.write(f"file {f}\n")
+            cmd = [
+                settings.FFMPEG_COMMAND,
+                "-y",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                seg_file,
+                "-c",
+                "copy",
+                "-pix_fmt",
+                "yuv420p",
+                "-movflags",
+                "faststart",
+                tf,
+            ]
+            stdout = run_command(cmd)
+
+            encoding = Encoding(
+                media=media,
+                profile=profile,
+                status="success",
+                progress=100,
+            )
+            all_logs = "\n".join([st.logs for st in ordered_chunks])
+            encoding.logs = f"{chunks_paths}\n{stdout}\n{all_logs}"
+            workers = list(set([st.worker for st in ordered_chunks]))
+            encoding.worker = json.dumps({"workers": workers})
+
+            start_date = min([st.add_date for st in ordered_chunks])
+            end_date = max([st.update_date for st in ordered_chunks])
+            encoding.total_run_time = (end_date - start_date).seconds
+
+            with open(tf, "rb") as f:
+                myfile = File(f)
+                output_name = f"{get_file_name(media.media_file.path)}.{profile.extension}"
+                encoding.media_file.save(content=myfile, name=output_name, save=False)
+            encoding.size = show_file_size(os.path.getsize(encoding.media_file.path))
+    except BaseException:
+        # give the chunks back, for a next run
+        Encoding.objects.filter(id__in=chunk_ids).update(status="success")
+        raise
+
+    with transaction.atomic():
+        # any other encoding of the profile is replaced by this one
+        Encoding.objects.filter(media=media, profile=profile).delete()
+        # avoid calling signals, post encode actions are performed
+        # explicitly once the transaction is committed
+        Encoding.objects.bulk_create([encoding])
+    ProcessingTiming.record("concat", started, media=media, profile=profile)
+
+    if not Encoding.objects.filter(chunks_info=chunks_info).exists():
+        # all profiles are done with the chunks
+        # TODO: in case of remote workers, files should be deleted
+        for orig_chunk in orig_chunks:
+            rm_file(orig_chunk)
+
+    encoding = Encoding.objects.filter(media=media, profile=profile, chunk=False).order_by("-id").first()
+    if encoding:
+        media.post_encode_actions(encoding=encoding, action="add")
+    return True
+
+
 @task(name="whisper_transcribe", queue="long_tasks", soft_time_limit=60 * 60 * 2)
 def whisper_transcribe(friendly_token, translate_to_english=False):
     try:
@@ -527,6 +1205,7 @@ def whisper_transcribe(friendly_token, translate_to_english=False):
 
 @task(name="update_search_vector", queue="short_tasks")
 def update_search_vector(friendly_token):
+    clear_coalesced(update_search_vector, friendly_token)
     try:
         media = Media.objects.get(friendly_token=friendly_token)
         media.update_search_vector()
@@ -536,45 +1215,144 @@ def update_search_vector(friendly_token):
     return True
 
 
+@task(name="produce_thumbnail_derivatives", queue="short_tasks")
+def produce_thumbnail_derivatives(friendly_token):
+    """Produce resized JPEG/WebP renditions of the thumbnail of a media
+
+    The source is the largest image available, the uploaded poster,
+    the original file for images, or else the poster
+    """
+
+    try:
+        media = Media.objects.get(friendly_token=friendly_token)
+    except BaseException:
+        logger.info(f"failed to get media with friendly_token {friendly_token}")
+        return False
+
+    if media.uploaded_poster:
+        source = media.uploaded_poster.path
+    elif media.media_type == "image":
+        source = media.media_file.path
+    elif media.poster:
+        source = media.poster.path
+    else:
+        return False
+
+    # placed next to the thumbnails, with new names every time,
+    # so that cached renditions are not served
+    output_prefix = os.path.join(settings.MEDIA_ROOT, original_thumbnail_file_path(media, f"{media.uid.hex}.{produce_friendly_token()}"))
+    os.makedirs(os.path.dirname(output_prefix), exist_ok=True)
+
+    try:
+        derivatives = produce_image_derivatives(source, output_prefix, settings.THUMBNAIL_DERIVATIVE_WIDTHS)
+    except (OSError, ValueError) as e:
+        logger.info(f"failed to produce thumbnail derivatives for {friendly_token}: {e}")
+        return False
+
+    thumbnail_derivatives = {}
+    for image_format, files in derivatives.items():
+        thumbnail_derivatives[image_format] = {str(width): path.replace(settings.MEDIA_ROOT, "") for width, path in files.items()}
+
+    old_derivatives = media.thumbnail_derivatives or {}
+    # avoid saving the whole object, this may run while media is edited
+    Media.objects.filter(pk=media.pk).update(thumbnail_derivatives=thumbnail_derivatives)
+    for files in old_derivatives.values():
+        for path in files.values():
+            rm_file(os.path.join(settings.MEDIA_ROOT, path))
+    return True
+
+
+# on short_tasks, so that it does not wait for the encodes of other media
+@task(name="produce_fast_preview", queue="short_tasks")
+def produce_fast_preview(friendly_token):
+    """Produce a low resolution h264 rendition of a video, as fast as possible
+
+    The video is playable and listable with it until its regular encodings
+    are ready, then it is removed on post_encode_actions
+    """
+
+    try:
+        media = Media.objects.get(friendly_token=friendly_token)
+    except BaseException:
+        logger.info(f"failed to get media with friendly_token {friendly_token}")
+        return False
+
+    regular_encodings = media.encodings.filter(status="success", chunk=False, profile__extension__in=["mp4", "webm"])
+    if media.media_type != "video" or regular_encodings.exists():
+        return False
+
+    started = time.monotonic()
+    source_path = stage_source_file(media.media_file.path, media.uid.hex, media.md5sum)
+    output_path = os.path.join(settings.MEDIA_ROOT, settings.MEDIA_ENCODING_DIR, "fast_preview", media.user.username, f"{media.uid.hex}.mp4")
+    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as tmpdirname:
+        tf = os.path.join(tmpdirname, "preview.mp4")
+        run_command(produce_fast_preview_command(source_path, tf, media.fast_preview_resolution))
+        if not (os.path.exists(tf) and os.path.getsize(tf) != 0 and media_file_info(tf).get("is_video")):
+            logger.info(f"failed to produce fast preview for {friendly_token}")
+            return False
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        shutil.move(tf, output_path)
+
+    if regular_encodings.exists():
+        # encoded meanwhile
+        rm_file(output_path)
+        return False
+
+    media.fast_preview_file_path = output_path
+    media.set_encoding_status()
+    media.save(update_fields=["fast_preview_file_path", "encoding_status", "listable"])
+    logger.info(f"produced fast preview for {friendly_token} in {time.monotonic() - started:.1f} seconds")
+    return True
+
+
 @task(name="produce_sprite_from_video", queue="long_tasks")
 def produce_sprite_from_video(friendly_token):
     """Produces a sprites file for a video, uses ffmpeg"""
 
+    clear_coalesced(produce_sprite_from_video, friendly_token)
     try:
         media = Media.objects.get(friendly_token=friendly_token)
     except BaseException:
         logger.info(f"failed to get media with friendly_token {friendly_token}")
         return False
 
+    started = time.monotonic()
     with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as tmpdirname:
         try:
-            tmpdir_image_files = tmpdirname + "/img%03d.jpg"
-            output_name = tmpdirname + "/sprites.jpg"
-
-            fps = getattr(settings, 'SPRITE_NUM_SECS', 10)
-            ffmpeg_cmd = [settings.FFMPEG_COMMAND, "-i", media.media_file.path, "-f", "image2", "-vf", f"fps=1/{fps}, scale=160:90", tmpdir_image_files]  # noqa
+            interval = getattr(settings, 'SPRITE_NUM_SECS', 10)
+            duration = media.duration or 0
+            extension = "jpg"
+            if math.ceil(duration / interval) * SPRITE_HEIGHT > JPEG_MAX_DIMENSION:
+                extension = "png"
+            output_name = tmpdirname + f"/sprites.{extension}"
+
+            source_path = stage_source_file(media.media_file.path, media.uid.hex, media.md5sum)
+            ffmpeg_cmd, frames = produce_sprites_command(source_path, output_name, duration, interval)
             run_command(ffmpeg_cmd)
-            image_files = [f for f in os.listdir(tmpdirname) if f.startswith("img") and f.endswith(".jpg")]
-            image_files = sorted(image_files, key=lambda x: int(re.search(r'\d+', x).group()))
-            image_files = [os.path.join(tmpdirname, f) for f in image_files]
-            cmd_convert = ["convert", *image_files, "-append", output_name]  # image files, unpacked into the list
-            ret = run_command(cmd_convert)  # noqa
 
             if os.path.exists(output_name) and get_file_type(output_name) == "image":
                 with open(output_name, "rb") as f:
                     myfile = File(f)
                     # SOS: avoid race condition, since this runs for a long time and will replace any other media changes on the meanwhile!!!
-                    media.sprites.save(content=myfile, name=get_file_name(media.media_file.path) + "sprites.jpg", save=False)
-                    media.save(update_fields=["sprites"])
+                    media.sprites.save(content=myfile, name=get_file_name(media.media_file.path) + f"sprites.{extension}", save=False)
+                vtt = produce_sprites_vtt(url_from_path(media.sprites.path), frames, duration, interval)
+                media.sprites_vtt.save(content=ContentFile(vtt.encode("utf-8")), name=get_file_name(media.media_file.path) + "sprites.vtt", save=False)
+                media.save(update_fields=["sprites", "sprites_vtt"])
+                ProcessingTiming.record("sprites", started, media=media)
 
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception(f"failed to produce sprites for media {friendly_token}")
     return True
 
 
 @task(name="create_hls", queue="long_tasks")
 def create_hls(friendly_token):
-    """Creates HLS file for media, uses Bento4 mp4hls command"""
+    """Creates HLS files for media, uses Bento4 mp4hls command
+
+    Each rendition is packaged once on its own directory, and master.m3u8
+    is rewritten to reference all of them. Renditions whose mp4 file has
+    not changed since they were packaged are not touched
+    """
 
     if not hasattr(settings, "MP4HLS_COMMAND"):
         logger.info("Bento4 mp4hls command is missing from configuration")
@@ -584,41 +1362,94 @@ def create_hls(friendly_token):
         logger.info("Bento4 mp4hls command is missing")
         return False
 
+    lock_key = f"create_hls_lock_{friendly_token}"
+    if not cache.add(lock_key, 1, timeout=HLS_LOCK_TIMEOUT):
+        # another worker is packaging this media, run again when it is done
+        create_hls.apply_async(args=[friendly_token], countdown=COALESCE_DELAY)
+        return False
+
+    try:
+        # triggers from now on need a new run
+        clear_coalesced(create_hls, friendly_token)
+        return package_hls(friendly_token)
+    finally:
+        cache.delete(lock_key)
+
+
+def package_hls(friendly_token):
     try:
         media = Media.objects.get(friendly_token=friendly_token)
     except BaseException:
         logger.info(f"failed to get media with friendly_token {friendly_token}")
         return False
 
-    p = media.uid.hex
-    output_dir = os.path.join(settings.HLS_DIR, p)
-    encodings = media.encodings.filter(profile__extension="mp4", status="success", chunk=False, profile__codec="h264")
+    output_dir = os.path.join(settings.HLS_DIR, media.uid.hex)
+    encodings = media.encodings.filter(profile__extension="mp4", status="success", chunk=False, profile__codec="h264").select_related("profile").order_by("profile__resolution")
+    encodings = [encoding for encoding in encodings if encoding.media_file and os.path.exists(encoding.media_file.path)]
+    if not encodings:
+        return True
 
-    if encodings:
-        existing_output_dir = None
-        if os.path.exists(output_dir):
-            existing_output_dir = output_dir
-            output_dir = os.path.join(settings.HLS_DIR, p + produce_friendly_token())
-        files = [f.media_file.path for f in encodings if f.media_file]
-        cmd = [settings.MP4HLS_COMMAND, '--segment-duration=4', f'--output-dir={output_dir}', *files]
-        run_command(cmd)
-
-        if existing_output_dir:
-            # override content with -T !
-            cmd = ["cp", "-rT", output_dir, existing_output_dir]
+    os.makedirs(output_dir, exist_ok=True)
+    renditions = []
+    for encoding in encodings:
+        rendition_dir = f"{encoding.profile.resolution}p_{encoding.profile.id}"
+        rendition_path = os.path.join(output_dir, rendition_dir)
+        st = os.stat(encoding.media_file.path)
+        source = f"{encoding.media_file.name}:{st.st_size}:{st.st_mtime_ns}"
+
+        source_file = os.path.join(rendition_path, "source")
+        packaged_source = None
+        if os.path.exists(source_file):
+            with open(source_file) as f:
+                packaged_source = f.read()
+
+        if packaged_source != source:
+            # package in a temp dir next to it and swap it in
+            started = time.monotonic()
+            temp_path = os.path.join(output_dir, f".{rendition_dir}_{produce_friendly_token()}")
+            cmd = [settings.MP4HLS_COMMAND, "--segment-duration=4", f"--output-dir={temp_path}", encoding.media_file.path]
             run_command(cmd)
+            if not os.path.exists(os.path.join(temp_path, "master.m3u8")):
+                logger.info(f"failed to package {encoding.media_file.path} to HLS")
+                shutil.rmtree(temp_path, ignore_errors=True)
+                continue
+            with open(os.path.join(temp_path, "source"), "w") as f:
+                f.write(source)
+            old_path = None
+            if os.path.exists(rendition_path):
+                old_path = f"{temp_path}_old"
+                os.rename(rendition_path, old_path)
+            os.rename(temp_path, rendition_path)
+            if old_path:
+                shutil.rmtree(old_path, ignore_errors=True)
+            ProcessingTiming.record("hls", started, media=media, profile=encoding.profile)
+
+        with open(os.path.join(rendition_path, "master.m3u8")) as f:
+            renditions.append((rendition_dir, f.read()))
+
+    if not renditions:
+        return False
 
-            try:
-                shutil.rmtree(output_dir)
-            except:  # noqa
-                # this was breaking in some cases where it was already deleted
-                # because create_hls was running multiple times
-                pass
-            output_dir = existing_output_dir
-        pp = os.path.join(output_dir, "master.m3u8")
-        if os.path.exists(pp):
-            if media.hls_file != pp:
-                Media.objects.filter(pk=media.pk).update(hls_file=pp)
+    pp = os.path.join(output_dir, "master.m3u8")
+    temp_master = f"{pp}.{produce_friendly_token()}"
+    with open(temp_master, "w") as f:
+        f.write(merge_hls_master_playlists(renditions))
+    os.replace(temp_master, pp)
+
+    # renditions of removed encodings, or output of older versions
+    rendition_dirs = [rendition_dir for rendition_dir, _ in renditions]
+    for entry in os.listdir(output_dir):
+        # no other run for this media, so temp dirs left here are from failed runs
+        if entry in rendition_dirs or entry == "master.m3u8":
+            continue
+        entry_path = os.path.join(output_dir, entry)
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+        else:
+            rm_file(entry_path)
+
+    if media.hls_file != pp:
+        Media.objects.filter(pk=media.pk).update(hls_file=pp)
     return True
 
 
@@ -858,73 +1689,212 @@ def save_user_action(user_or_session, friendly_token=None, action="watch", extra
     return True
 
 
+@task(name="flush_user_actions", queue="short_tasks")
+def flush_user_actions():
+    """Write the watch/like/dislike actions buffered in Redis to the db
+
+    MediaActions are created with bulk_create and the counters of all media
+    are updated with a single F() based UPDATE
+    """
+
+    lock_key = "flush_user_actions_lock"
+    if not cache.add(lock_key, 1, timeout=USER_ACTIONS_FLUSH_LOCK_TIMEOUT):
+        return False
+    try:
+        return flush_user_actions_batch()
+    finally:
+        cache.delete(lock_key)
+
+
+def flush_user_actions_batch():
+    redis = get_redis_connection("default")
+    entries = redis.xrange(USER_ACTIONS_STREAM_KEY, "-", "+", count=USER_ACTIONS_FLUSH_BATCH)
+    if not entries:
+        return True
+
+    records = []
+    for _, fields in entries:
+        record = {key.decode("utf-8"): value.decode("utf-8") for key, value in fields.items()}
+        records.append(
+            {
+                "media_id": int(record["media_id"]),
+                "action": record["action"],
+                "user_id": int(record["user_id"]) if record["user_id"] else None,
+                "session_key": record["session_key"] or None,
+                "remote_ip": record["remote_ip"] or None,
+            }
+        )
+    # what the pending counters have to be decreased by, once flushed
+    pending = {}
+    for r in records:
+        field = f"{r['media_id']}:{r['action']}"
+        pending[field] = pending.get(field, 0) + 1
+
+    media_ids = set(Media.objects.filter(id__in=set(r["media_id"] for r in records)).values_list("id", flat=True))
+    user_ids = set(User.objects.filter(id__in=set(r["user_id"] for r in records if r["user_id"])).values_list("id", flat=True))
+    records = [r for r in records if r["media_id"] in media_ids and (r["user_id"] is None or r["user_id"] in user_ids)]
+
+    # like/dislike are once per user or session
+    query = Q()
+    for r in records:
+        if r["action"] in ["like", "dislike"]:
+            actor = Q(user_id=r["user_id"]) if r["user_id"] else Q(session_key=r["session_key"])
+            query |= Q(media_id=r["media_id"], action=r["action"]) & actor
+    done = set()
+    if query:
+        for media_id, action, user_id, session_key in MediaAction.objects.filter(query).values_list("media_id", "action", "user_id", "session_key"):
+            done.add((media_id, action, user_id or session_key))
+    actions = []
+    for r in records:
+        if r["action"] in ["like", "dislike"]:
+            key = (r["media_id"], r["action"], r["user_id"] or r["session_key"])
+            if key in done:
+                continue
+            done.add(key)
+        actions.append(r)
+
+    # only the last watch of a user or session is kept
+    query = Q()
+    increments = {}
+    for r in actions:
+        if r["action"] == "watch":
+            actor = Q(user_id=r["user_id"]) if r["user_id"] else Q(session_key=r["session_key"])
+            query |= Q(media_id=r["media_id"], action="watch") & actor
+        media_actions = increments.setdefault(r["media_id"], {})
+        media_actions[r["action"]] = media_actions.get(r["action"], 0) + 1
+
+    with transaction.atomic():
+        if query:
+            MediaAction.objects.filter(query).delete()
+        MediaAction.objects.bulk_create(
+            [
+                MediaAction(
+                    user_id=r["user_id"],
+                    session_key=r["session_key"],
+                    media_id=r["media_id"],
+                    action=r["action"],
+                    remote_ip=r["remote_ip"],
+                )
+                for r in actions
+            ],
+            batch_size=1000,
+        )
+        if increments:
+            # single UPDATE for all media, avoids post_save signals
+            updates = {}
+            for action, field in USER_ACTIONS_COUNTER_FIELDS.items():
+                whens = [When(id=media_id, then=Value(media_actions[action])) for media_id, media_actions in increments.items() if action in media_actions]
+                if whens:
+                    updates[field] = F(field) + Case(*whens, default=Value(0), output_field=IntegerField())
+            Media.objects.filter(id__in=increments.keys()).update(**updates)
+
+    add_trending_scores(increments)
+
+    redis.xdel(USER_ACTIONS_STREAM_KEY, *[entry_id for entry_id, _ in entries])
+    fields = list(pending.keys())
+    redis.register_script(DECREASE_PENDING_COUNTERS_SCRIPT)(keys=[USER_ACTIONS_COUNTERS_KEY], args=fields + [pending[field] for field in fields])
+    logger.info(f"Flushed {len(actions)} user actions for {len(increments)} media")
+
+    if len(entries) == USER_ACTIONS_FLUSH_BATCH:
+        # more to flush
+        flush_user_actions.delay()
+    return True
+
+
 @task(name="get_list_of_popular_media", queue="long_tasks")
 def get_list_of_popular_media():
-    """Experimental task for preparing media listing
-    for index page / recommended section
-    calculate and return the top 50 popular media, based on two rules
-    X = the top 25 videos that have the most views during the last week
-    Y = the most recent 25 videos that have been liked over the last 6 months
+    """Maintain the trending scores of media, that the index page /
+    recommended section read the top media from
+
+    Scores are updated as actions are flushed. Here they are rebased to
+    a new epoch, so that they don't grow unbounded, and media with
+    negligible scores are removed
     """
 
-    valid_media_x = {}
-    valid_media_y = {}
-    basic_query = Q(listable=True)
-    media_x = Media.objects.filter(basic_query).values("friendly_token")
+    redis = get_redis_connection("default")
+    if not redis.exists(TRENDING_SCORES_KEY):
+        # seed from the actions of the last week
+        period = timezone.now() - timedelta(days=7)
+        increments = {}
+        for media_id, action, number in MediaAction.objects.filter(action_date__gte=period, action__in=settings.TRENDING_SCORE_WEIGHTS.keys()).values_list("media_id", "action").annotate(number=Count("id")).order_by():
+            increments.setdefault(media_id, {})[action] = number
+        add_trending_scores(increments)
 
-    period_x = datetime.now() - timedelta(days=7)
-    period_y = datetime.now() - timedelta(days=30 * 6)
+    rebase_trending_scores(TRENDING_SCORE_MIN)
+    logger.info("rebased trending scores")
 
-    for media in media_x:
-        ft = media["friendly_token"]
-        num = MediaAction.objects.filter(action_date__gte=period_x, action="watch", media__friendly_token=ft).count()
-        if num:
-            valid_media_x[ft] = num
-        num = MediaAction.objects.filter(action_date__gte=period_y, action="like", media__friendly_token=ft).count()
-        if num:
-            valid_media_y[ft] = num
+    return True
 
-    x = sorted(valid_media_x.items(), key=lambda kv: kv[1], reverse=True)[:25]
-    y = sorted(valid_media_y.items(), key=lambda kv: kv[1], reverse=True)[:25]
 
-    media_ids = [a[0] for a in x]
-    media_ids.extend([a[0] for a in y])
-    media_ids = list(set(media_ids))
-    cache.set("popular_media_ids", media_ids, 60 * 60 * 12)
-    logger.info("saved popular media ids")
+def get_listings_thumbnails(model, field):
+    """Pick the listings thumbnail of every object of a model
 
-    return True
+    Each object gets the thumbnail of its most viewed public media, that
+    has not been picked by a previous object. Candidates are the top media
+    of every object, ranked with a window function in a single query. If all
+    candidates of an object are taken, more are fetched for these objects only.
+    Returns a dict of object id to media id
+    """
+
+    through = Media._meta.get_field(field).remote_field.through
+    object_field = f"{model._meta.model_name}_id"
+    object_ids = list(model.objects.values_list("id", flat=True))
+
+    picked = {}
+    used_media = set()
+    pending = object_ids
+    candidates_number = LISTINGS_THUMBNAIL_CANDIDATES
+    while pending:
+        qs = through.objects.filter(media__state="public", media__is_reviewed=True)
+        if len(pending) < len(object_ids):
+            qs = qs.filter(**{f"{object_field}__in": pending})
+        qs = (
+            qs.annotate(
+                row_number=Window(
+                    expression=RowNumber(),
+                    partition_by=[F(object_field)],
+                    order_by=[F("media__views").desc(), F("media_id").desc()],
+                )
+            )
+            .filter(row_number__lte=candidates_number)
+            .values_list(object_field, "media_id", "row_number")
+        )
+        candidates = {}
+        for object_id, media_id, row_number in qs:
+            candidates.setdefault(object_id, []).append((row_number, media_id))
+
+        unresolved = []
+        for object_id in pending:
+            object_candidates = sorted(candidates.get(object_id, []))
+            media_id = next((media_id for _, media_id in object_candidates if media_id not in used_media), None)
+            if media_id:
+                picked[object_id] = media_id
+                used_media.add(media_id)
+            elif len(object_candidates) == candidates_number:
+                # there may be more media for this object
+                unresolved.append(object_id)
+        # rare, objects with all top candidates taken by earlier objects
+        pending = unresolved
+        candidates_number *= 4
+    return picked
 
 
 @task(name="update_listings_thumbnails", queue="long_tasks")
 def update_listings_thumbnails():
     """Populate listings_thumbnail field for models"""
 
-    # Categories
-    used_media = []
-    saved = 0
-    qs = Category.objects.filter()
-    for object in qs:
-        media = Media.objects.exclude(friendly_token__in=used_media).filter(category=object, state="public", is_reviewed=True).order_by("-views").first()
-        if media:
-            object.listings_thumbnail = media.thumbnail_url
-            object.save(update_fields=["listings_thumbnail"])
-            used_media.append(media.friendly_token)
-            saved += 1
-    logger.info(f"updated {saved} categories")
-
-    # Tags
-    used_media = []
-    saved = 0
-    qs = Tag.objects.filter()
-    for object in qs:
-        media = Media.objects.exclude(friendly_token__in=used_media).filter(tags=object, state="public", is_reviewed=True).order_by("-views").first()
-        if media:
-            object.listings_thumbnail = media.thumbnail_url
-            object.save(update_fields=["listings_thumbnail"])
-            used_media.append(media.friendly_token)
-            saved += 1
-    logger.info(f"updated {saved} tags")
+    for model, field in [(Category, "category"), (Tag, "tags")]:
+        picked = get_listings_thumbnails(model, field)
+        media = Media.objects.filter(id__in=set(picked.values()))
+        thumbnails = {m.id: m.thumbnail_url for m in media}
+
+        objects = []
+        for object_id, listings_thumbnail in model.objects.filter(id__in=picked.keys()).values_list("id", "listings_thumbnail"):
+            thumbnail_url = thumbnails.get(picked[object_id])
+            if thumbnail_url and thumbnail_url != listings_thumbnail:
+                objects.append(model(id=object_id, listings_thumbnail=thumbnail_url))
+        model.objects.bulk_update(objects, ["listings_thumbnail"], batch_size=1000)
+        logger.info(f"updated {len(objects)} {model._meta.verbose_name_plural}")
 
     return True
 
@@ -944,8 +1914,7 @@ def task_sent_handler(sender=None, headers=None, body=None, **kwargs):
             encoding = Encoding.objects.get(task_id=uid)
             encoding.delete()
             logger.info("deleted the Encoding object")
-            if encoding.temp_file:
-                kill_ffmpeg_process(encoding.temp_file)
+            kill_ffmpeg_process(encoding)
 
     except BaseException:
         pass
@@ -953,6 +1922,28 @@ def task_sent_handler(sender=None, headers=None, body=None, **kwargs):
     return True
 
 
+@task(name="clean_chunk_encode_cache", queue="short_tasks")
+def clean_chunk_encode_cache():
+    """Remove entries of the chunk encode cache not used for CHUNK_ENCODE_CACHE_TTL seconds"""
+
+    cache_dir = getattr(settings, "CHUNK_ENCODE_CACHE_DIR", None)
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return False
+
+    now = datetime.now().timestamp()
+    removed = 0
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > settings.CHUNK_ENCODE_CACHE_TTL:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info(f"removed {removed} entries from the chunk encode cache")
+    return True
+
+
 @task(name="remove_media_file", base=Task, queue="long_tasks")
 def remove_media_file(media_file=None):
     rm_file(media_file)
@@ -980,6 +1971,7 @@ def post_trim_action(friendly_token):
         bool: True if successful, False otherwise
     """
     logger.info(f"Post trim action for {friendly_token}")
+    clear_coalesced(post_trim_action, friendly_token)
     try:
         media = Media.objects.get(friendly_token=friendly_token)
     except Media.DoesNotExist:
@@ -997,8 +1989,8 @@ def post_trim_action(friendly_token):
             update_encoding_size(encoding.id)
 
         media.produce_thumbnails_from_video()
-        produce_sprite_from_video.delay(friendly_token)
-        create_hls.delay(friendly_token)
+        enqueue_coalesced(produce_sprite_from_video, friendly_token)
+        enqueue_coalesced(create_hls, friendly_token)
 
     vt_request = VideoTrimRequest.objects.filter(media=media, status="running").first()
     if vt_request:
@@ -1065,7 +2057,7 @@ def video_trim_task(self, trim_request_id):
                 encoding.delete()
 
         pre_trim_video_actions(target_media)
-        post_trim_action.delay(target_media.friendly_token)
+        enqueue_coalesced(post_trim_action, target_media.friendly_token)
 
     else:
         for i, timestamp in enumerate(timestamps_encodings, start=1):
@@ -1087,7 +2079,7 @@ def video_trim_task(self, trim_request_id):
                     encoding.delete()
 
             pre_trim_video_actions(target_media)
-            post_trim_action.delay(target_media.friendly_token)
+            enqueue_coalesced(post_trim_action, target_media.friendly_token)
 
         # set as completed the initial trim_request
         trim_request.status = "success"
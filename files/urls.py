@@ -62,6 +62,8 @@ urlpatterns = [
         name="api_get_media",
     ),
     re_path(r"^api/v1/search$", views.MediaSearch.as_view()),
+    re_path(r"^api/v1/search/autocomplete$", views.SearchAutocomplete.as_view()),
+    re_path(r"^api/v1/search/transcripts$", views.TranscriptSearch.as_view()),
     re_path(
         rf"^api/v1/media/{friendly_token}/share$",
         views.media_share,
@@ -100,6 +102,7 @@ urlpatterns = [
     re_path(r"^api/v1/user/action/(?P<action>[\w]*)$", views.UserActions.as_view()),
     # ADMIN VIEWS
     re_path(r"^api/v1/encode_profiles/$", views.EncodeProfileList.as_view()),
+    re_path(r"^api/v1/encoding_backlog$", views.EncodingBacklog.as_view()),
     re_path(r"^api/v1/manage_media$", management_views.MediaList.as_view()),
     re_path(r"^api/v1/manage_comments$", management_views.CommentList.as_view()),
     re_path(r"^api/v1/manage_users$", management_views.UserList.as_view()),
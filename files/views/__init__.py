@@ -3,12 +3,14 @@
 from .auth import custom_login_view, saml_metadata  # noqa: F401
 from .categories import CategoryList, CategoryListContributor, TagList  # noqa: F401
 from .comments import CommentDetail, CommentList  # noqa: F401
-from .encoding import EncodeProfileList  # noqa: F401
+from .encoding import EncodeProfileList, EncodingBacklog  # noqa: F401
 from .media import MediaActions  # noqa: F401
 from .media import MediaBulkUserActions  # noqa: F401
 from .media import MediaDetail  # noqa: F401
 from .media import MediaList  # noqa: F401
 from .media import MediaSearch  # noqa: F401
+from .media import SearchAutocomplete  # noqa: F401
+from .media import TranscriptSearch  # noqa: F401
 from .media import media_share  # noqa: F401
 from .media_auth import media_auth  # noqa: F401
 from .pages import about  # noqa: F401
@@ -2,9 +2,10 @@ from django.conf import settings
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
+from cms.custom_pagination import get_pagination_class
+
 from ..methods import is_mediacms_editor
 from ..models import Category, Tag
 from ..serializers import CategorySerializer, TagSerializer
@@ -81,7 +82,7 @@ class TagList(APIView):
     )
     def get(self, request, format=None):
         tags = Tag.objects.filter().order_by("-media_count")
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+        pagination_class = get_pagination_class(request)
         paginator = pagination_class()
         page = paginator.paginate_queryset(tags, request)
         serializer = TagSerializer(page, many=True, context={"request": request})
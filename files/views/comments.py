@@ -11,9 +11,9 @@ from rest_framework.parsers import (
     MultiPartParser,
 )
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
+from cms.custom_pagination import get_pagination_class
 from cms.permissions import IsAuthorizedToAdd, IsAuthorizedToAddComment
 from users.models import User
 
@@ -43,7 +43,7 @@ class CommentList(APIView):
         },
     )
     def get(self, request, format=None):
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+        pagination_class = get_pagination_class(request)
         paginator = pagination_class()
         comments = Comment.objects.filter(media__state="public").order_by("-add_date")
         comments = comments.prefetch_related("user")
@@ -101,7 +101,7 @@ class CommentDetail(APIView):
         if isinstance(media, Response):
             return media
         comments = media.comments.filter().prefetch_related("user").order_by("-add_date")
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+        pagination_class = get_pagination_class(request)
         paginator = pagination_class()
         page = paginator.paginate_queryset(comments, request)
         serializer = CommentSerializer(page, many=True, context={"request": request})
@@ -1,7 +1,9 @@
 from drf_yasg.utils import swagger_auto_schema
+from rest_framework import permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from ..methods import get_encoding_backlog
 from ..models import EncodeProfile
 from ..serializers import EncodeProfileSerializer
 
@@ -20,3 +22,18 @@ class EncodeProfileList(APIView):
         profiles = EncodeProfile.objects.all()
         serializer = EncodeProfileSerializer(profiles, many=True, context={"request": request})
         return Response(serializer.data)
+
+
+class EncodingBacklog(APIView):
+    """Expected ready time of media being encoded, and the backlog of the workers"""
+
+    swagger_schema = None
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        ret = get_encoding_backlog()
+        friendly_token = request.GET.get("media")
+        if friendly_token:
+            ret["media"] = [m for m in ret["media"] if m["friendly_token"] == friendly_token]
+        return Response(ret)
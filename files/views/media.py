@@ -1,8 +1,22 @@
+import hashlib
 from datetime import datetime, timedelta
 
 from django.conf import settings
-from django.contrib.postgres.search import SearchQuery
-from django.db.models import Count, F, Prefetch, Q, prefetch_related_objects
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    Count,
+    Exists,
+    F,
+    FloatField,
+    OuterRef,
+    Prefetch,
+    Q,
+    Window,
+    prefetch_related_objects,
+)
+from django.db.models.functions import Cast, RowNumber
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
@@ -18,20 +32,26 @@ from rest_framework.parsers import (
     MultiPartParser,
 )
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
 from actions.models import MediaAction
-from cms.custom_pagination import FastPaginationWithoutCount
+from cms.custom_pagination import (
+    FastPaginationWithoutCount,
+    KeysetPagination,
+    get_pagination_class,
+)
 from cms.permissions import IsAuthorizedToAdd, IsUserOrEditor
 from users.models import User
 
 from .. import helpers
 from ..methods import (
+    BUFFERED_USER_ACTIONS,
     change_media_owner,
     copy_media,
+    get_pending_user_action_counts,
     get_user_or_session,
     is_mediacms_editor,
+    record_user_action,
     show_recommended_media,
     show_related_media,
     update_user_ratings,
@@ -45,12 +65,65 @@ from ..models import (
     MediaPermission,
     Playlist,
     PlaylistMedia,
+    SubtitleCue,
     Tag,
 )
 from ..serializers import MediaSearchSerializer, MediaSerializer, SingleMediaSerializer
 from ..stop_words import STOP_WORDS
 from ..tasks import save_user_action
 
+# upper limit of the timestamps returned per media by TranscriptSearch
+TRANSCRIPT_SEARCH_MAX_TIMESTAMPS = 10
+
+# suggestions of each kind (media titles, tags) returned by SearchAutocomplete
+SEARCH_AUTOCOMPLETE_LIMIT = 10
+# trigram indexes are of no use for shorter queries
+SEARCH_AUTOCOMPLETE_MIN_LENGTH = 3
+SEARCH_AUTOCOMPLETE_MAX_LENGTH = 100
+# suggestions for anonymous users are cached for that many seconds
+SEARCH_AUTOCOMPLETE_CACHE_TIMEOUT = 60
+
+
+def get_autocomplete_suggestions(request, query):
+    """Media and tag titles that contain query, to complete a search
+
+    Media titles that start with query come first. The title lookups are
+    served by the trigram indexes on the titles, and suggestions for
+    anonymous users, which are the same for all of them, are cached
+    """
+
+    query = " ".join(query.lower().split())[:SEARCH_AUTOCOMPLETE_MAX_LENGTH]
+    if len(query) < SEARCH_AUTOCOMPLETE_MIN_LENGTH:
+        return []
+
+    cache_key = None
+    if not request.user.is_authenticated:
+        cache_key = "search_autocomplete:" + hashlib.md5(query.encode("utf-8")).hexdigest()
+        suggestions = cache.get(cache_key)
+        if suggestions is not None:
+            return suggestions
+
+    if is_mediacms_editor(request.user):
+        basic_query = Q()
+    elif request.user.is_authenticated:
+        basic_query = Q(listable=True) | Q(permissions__user=request.user) | Q(user=request.user)
+        if getattr(settings, 'USE_RBAC', False):
+            rbac_categories = request.user.get_rbac_categories_as_member()
+            basic_query |= Q(category__in=rbac_categories)
+    else:
+        basic_query = Q(listable=True)
+
+    # no DISTINCT, that would have to sort all matches, duplicates are removed here
+    titles = Media.objects.filter(basic_query, title__icontains=query).order_by("-views").values_list("title", flat=True)[: SEARCH_AUTOCOMPLETE_LIMIT * 2]
+    titles = sorted(dict.fromkeys(titles), key=lambda title: not title.lower().startswith(query))[:SEARCH_AUTOCOMPLETE_LIMIT]
+    tags = Tag.objects.filter(title__icontains=query, media_count__gt=0).order_by("-media_count").values_list("title", flat=True)[:SEARCH_AUTOCOMPLETE_LIMIT]
+
+    suggestions = [{"title": title, "type": "media"} for title in titles]
+    suggestions += [{"title": title, "type": "tag"} for title in tags]
+    if cache_key:
+        cache.set(cache_key, suggestions, SEARCH_AUTOCOMPLETE_CACHE_TIMEOUT)
+    return suggestions
+
 
 class MediaList(APIView):
     """Media listings views"""
@@ -160,7 +233,7 @@ class MediaList(APIView):
 
         already_sorted = False
         include_sharing_info = False
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+        pagination_class = get_pagination_class(request)
 
         if show_param == "recommended":
             pagination_class = FastPaginationWithoutCount
@@ -266,7 +339,9 @@ class MediaList(APIView):
         if not already_sorted:
             media = media.order_by(f"{ordering}{sort_by}")
 
-        media = media[:1000]
+        if pagination_class is not KeysetPagination:
+            # bounds the COUNT and OFFSET of page numbers
+            media = media[:1000]
 
         paginator = pagination_class()
 
@@ -506,14 +581,16 @@ class MediaBulkUserActions(APIView):
                 if state == "public":
                     return Response({"detail": "You are not allowed to set media to public state"}, status=status.HTTP_400_BAD_REQUEST)
 
-            for m in media:
-                m.state = state
-                if m.state == "public" and m.encoding_status == "success" and m.is_reviewed is True:
-                    m.listable = True
-                else:
-                    m.listable = False
+            # media counts are updated once, on commit
+            with transaction.atomic():
+                for m in media:
+                    m.state = state
+                    if m.state == "public" and m.encoding_status == "success" and m.is_reviewed is True:
+                        m.listable = True
+                    else:
+                        m.listable = False
 
-                m.save(update_fields=["state", "listable"])
+                    m.save(update_fields=["state", "listable"])
 
             remove_sharing = request.data.get('remove_sharing', False)
 
@@ -680,11 +757,12 @@ class MediaBulkUserActions(APIView):
                 return Response({"detail": "No matching categories found or access denied"}, status=status.HTTP_400_BAD_REQUEST)
 
             added_count = 0
-            for category in categories:
-                for m in media:
-                    if not m.category.filter(uid=category.uid).exists():
-                        m.category.add(category)
-                        added_count += 1
+            with transaction.atomic():
+                for category in categories:
+                    for m in media:
+                        if not m.category.filter(uid=category.uid).exists():
+                            m.category.add(category)
+                            added_count += 1
 
             return Response({"detail": f"Added {added_count} media items to {categories.count()} categories"})
 
@@ -871,6 +949,10 @@ class MediaDetail(APIView):
         related_media = related_media_serializer.data
         ret = serializer.data
 
+        # views/likes/dislikes not written to the db yet
+        for field, value in get_pending_user_action_counts(media).items():
+            ret[field] += value
+
         # update rattings info with user specific ratings
         # eg user has already rated for this media
         # this only affects user rating and only if enabled
@@ -1071,12 +1153,15 @@ class MediaActions(APIView):
                 )
         if action:
             user_or_session = get_user_or_session(request)
-            save_user_action.delay(
-                user_or_session,
-                friendly_token=media.friendly_token,
-                action=action,
-                extra_info=extra,
-            )
+            if action in BUFFERED_USER_ACTIONS:
+                record_user_action(user_or_session, media, action)
+            else:
+                save_user_action.delay(
+                    user_or_session,
+                    friendly_token=media.friendly_token,
+                    action=action,
+                    extra_info=extra,
+                )
 
             return Response({"detail": "action received"}, status=status.HTTP_201_CREATED)
         else:
@@ -1137,6 +1222,9 @@ class MediaSearch(APIView):
         author = params.get("author", "").strip()
         upload_date = params.get('upload_date', '').strip()
 
+        # text searches without a sort option are ordered by relevance
+        rank_results = not sort_by
+
         # Handle combined sort options (e.g., title_asc, views_desc)
         parsed_combined = False
         if sort_by and '_' in sort_by:
@@ -1165,6 +1253,10 @@ class MediaSearch(APIView):
             ret = {}
             return Response(ret, status=status.HTTP_200_OK)
 
+        if params.get("show", "").strip() == "titles" and not (category or tag or media_type or author or upload_date):
+            # predictions as the query is typed, see SearchAutocomplete
+            return Response(get_autocomplete_suggestions(request, query), status=status.HTTP_200_OK)
+
         if request.user.is_authenticated:
             if is_mediacms_editor(self.request.user):
                 media = Media.objects.prefetch_related("user", "tags")
@@ -1193,6 +1285,8 @@ class MediaSearch(APIView):
                 query = None
         if query:
             media = media.filter(search=query)
+        else:
+            rank_results = False
 
         if tag:
             media = media.filter(tags__title=tag)
@@ -1222,25 +1316,123 @@ class MediaSearch(APIView):
             if gte:
                 media = media.filter(add_date__gte=gte)
 
-        media = media.order_by(f"{ordering}{sort_by}")
+        if rank_results:
+            # cover density ranking favours media where the query terms
+            # appear close together, weighted by title, tags etc. The rank
+            # is a float4, cast so that cursor pages compare it exactly
+            rank = Cast(SearchRank(F("search"), query, cover_density=True), FloatField())
+            media = media.annotate(rank=rank).order_by("-rank", "-add_date")
+        else:
+            media = media.order_by(f"{ordering}{sort_by}")
 
         if self.request.query_params.get("show", "").strip() == "titles":
             media = media.values("title")[:40]
             return Response(media, status=status.HTTP_200_OK)
         else:
-            media = media.prefetch_related("user")[:1000]  # limit to 1000 results
+            media = media.prefetch_related("user")
 
-            if category or tag:
-                pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-            else:
-                # pagination_class = FastPaginationWithoutCount
-                pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+            pagination_class = get_pagination_class(request)
+            if pagination_class is not KeysetPagination:
+                media = media[:1000]  # limit to 1000 results
             paginator = pagination_class()
             page = paginator.paginate_queryset(media, request)
             serializer = MediaSearchSerializer(page, many=True, context={"request": request})
             return paginator.get_paginated_response(serializer.data)
 
 
+class SearchAutocomplete(APIView):
+    """
+    Suggestions to complete a search query, as it is typed
+    Only GET is implemented here
+    """
+
+    parser_classes = (JSONParser,)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(name='q', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='Search query typed so far', required=True),
+        ],
+        tags=['Search'],
+        operation_summary='Search autocomplete',
+        operation_description='Lists media and tag titles that contain the query, media titles that start with it first',
+    )
+    def get(self, request, format=None):
+        query = self.request.query_params.get("q", "")
+        return Response(get_autocomplete_suggestions(request, query), status=status.HTTP_200_OK)
+
+
+class TranscriptSearch(APIView):
+    """
+    Search the subtitles of media
+    Returns the matching media, each with the times where
+    the text is said
+    """
+
+    parser_classes = (JSONParser,)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(name='q', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='Search query', required=True),
+            openapi.Parameter(name='timestamps', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY, description='Number of timestamps per media'),
+            openapi.Parameter(name='cursor', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='Cursor of the page'),
+        ],
+        tags=['Search'],
+        operation_summary='Search subtitles',
+        operation_description='Lists media whose subtitles match the query, newest first, with the best matching timestamps of each',
+    )
+    def get(self, request, format=None):
+        query = self.request.query_params.get("q", "").strip().lower()
+        try:
+            timestamps = int(self.request.query_params.get("timestamps", settings.TRANSCRIPT_SEARCH_TIMESTAMPS))
+        except ValueError:
+            timestamps = settings.TRANSCRIPT_SEARCH_TIMESTAMPS
+        timestamps = max(1, min(timestamps, TRANSCRIPT_SEARCH_MAX_TIMESTAMPS))
+
+        query = helpers.clean_query(query)
+        q_parts = [q_part.rstrip("y") for q_part in query.split() if q_part not in STOP_WORDS]
+        if not q_parts:
+            return Response({}, status=status.HTTP_200_OK)
+        query = SearchQuery(q_parts[0] + ":*", search_type="raw")
+        for part in q_parts[1:]:
+            query &= SearchQuery(part + ":*", search_type="raw")
+
+        if is_mediacms_editor(request.user):
+            basic_query = Q()
+        elif request.user.is_authenticated:
+            basic_query = Q(listable=True) | Q(permissions__user=request.user) | Q(user=request.user)
+            if getattr(settings, 'USE_RBAC', False):
+                rbac_categories = request.user.get_rbac_categories_as_member()
+                basic_query |= Q(category__in=rbac_categories)
+        else:
+            basic_query = Q(listable=True)
+
+        # the cue index is searched, subtitle files are not read
+        matching_cues = SubtitleCue.objects.filter(media=OuterRef("pk"), search=query)
+        media = Media.objects.filter(basic_query).filter(Exists(matching_cues)).distinct().order_by("-add_date").prefetch_related("user")
+
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(media, request, view=self)
+
+        # best matching cues of each media in the page
+        cues = (
+            SubtitleCue.objects.filter(media__in=[m.id for m in page], search=query)
+            .annotate(rank=SearchRank(F("search"), query, cover_density=True))
+            .annotate(row_number=Window(RowNumber(), partition_by=F("media_id"), order_by=[F("rank").desc(), F("start").asc()]))
+            .filter(row_number__lte=timestamps)
+            .values("media_id", "start", "end", "text")
+        )
+        media_timestamps = {}
+        for cue in cues:
+            media_timestamps.setdefault(cue.pop("media_id"), []).append(cue)
+
+        serializer = MediaSearchSerializer(page, many=True, context={"request": request})
+        results = []
+        for m, data in zip(page, serializer.data):
+            data["timestamps"] = sorted(media_timestamps.get(m.id, []), key=lambda cue: cue["start"])
+            results.append(data)
+        return paginator.get_paginated_response(results)
+
+
 @csrf_exempt
 @require_POST
 def media_share(request, friendly_token):
@@ -34,9 +34,10 @@ from ..methods import (
     handle_video_chapters,
     is_media_allowed_type,
     is_mediacms_editor,
+    record_user_action,
 )
 from ..models import Category, Media, Page, Playlist, Subtitle, Tag, VideoTrimRequest
-from ..tasks import save_user_action, video_trim_task
+from ..tasks import video_trim_task
 
 
 def get_page(request, slug):
@@ -180,6 +181,8 @@ def edit_subtitle(request):
         subtitle_text = form.data["subtitle"]
         with open(subtitle.subtitle_file.path, "w") as ff:
             ff.write(subtitle_text)
+        # stores the new text and updates the search vector of the media
+        subtitle.save()
 
         messages.add_message(request, messages.INFO, "Caption was edited")
         return HttpResponseRedirect(subtitle.media.get_absolute_url())
@@ -454,9 +457,15 @@ def replace_media(request):
             if media.sprites:
                 helpers.rm_file(media.sprites.path)
                 media.sprites = None
+            if media.sprites_vtt:
+                helpers.rm_file(media.sprites_vtt.path)
+                media.sprites_vtt = None
             if media.preview_file_path:
                 helpers.rm_file(media.preview_file_path)
                 media.preview_file_path = ""
+            if media.fast_preview_file_path:
+                helpers.rm_file(media.fast_preview_file_path)
+                media.fast_preview_file_path = ""
 
             if media.hls_file:
                 hls_dir = os.path.dirname(media.hls_file)
@@ -747,7 +756,7 @@ def view_media(request):
         return render(request, "cms/media.html", context)
 
     user_or_session = get_user_or_session(request)
-    save_user_action.delay(user_or_session, friendly_token=friendly_token, action="watch")
+    record_user_action(user_or_session, media, "watch")
     context = {}
     context["media"] = friendly_token
     context["media_object"] = media
@@ -11,9 +11,9 @@ from rest_framework.parsers import (
     MultiPartParser,
 )
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
+from cms.custom_pagination import get_pagination_class
 from cms.permissions import IsAuthorizedToAdd, IsUserOrEditor
 
 from ..models import Media, Playlist, PlaylistMedia
@@ -36,7 +36,7 @@ class PlaylistList(APIView):
         },
     )
     def get(self, request, format=None):
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+        pagination_class = get_pagination_class(request)
         paginator = pagination_class()
         playlists = Playlist.objects.filter().prefetch_related("user")
 
@@ -161,9 +161,15 @@ export function SearchField(props) {
     }
   }
 
-  function onPredictionSelect(val) {
+  function onPredictionSelect(prediction) {
     setPredictionItems([]);
-    setQueryVal(val);
+
+    if ('tag' === prediction.type) {
+      window.location.href = LinksContext._currentValue.search.tag + encodeURIComponent(prediction.title);
+      return;
+    }
+
+    setQueryVal(prediction.title);
 
     setTimeout(function () {
       formRef.current.submit();
@@ -187,8 +193,8 @@ export function SearchField(props) {
 
       i = 0;
       while (i < arr.length) {
-        itemTxt = arr[i];
-        pos = indexesOf(arr[i], val, false);
+        itemTxt = arr[i].title;
+        pos = indexesOf(arr[i].title, val, false);
 
         // NOTE: Disabled to allow display results that don't include the query string (eg. found by tag name).
         /*if( ! pos.length ){
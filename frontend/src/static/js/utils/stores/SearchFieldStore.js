@@ -43,7 +43,11 @@ class SearchFieldStore extends EventEmitter {
       SearchFieldStoreData[this.id].predictions = [];
 
       while (i < response.data.length) {
-        SearchFieldStoreData[this.id].predictions[i] = response.data[i].title;
+        // Suggestions of media titles and tags, as { title, type }.
+        SearchFieldStoreData[this.id].predictions[i] = {
+          title: response.data[i].title,
+          type: response.data[i].type || 'media',
+        };
         i += 1;
       }
 
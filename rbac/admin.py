@@ -4,6 +4,7 @@ from django.contrib import admin
 from django.db import transaction
 from django.utils.html import format_html
 
+from files.methods import get_encode_queue_depth
 from files.models import Category
 from users.models import User
 
@@ -115,6 +116,8 @@ class RBACGroupAdmin(admin.ModelAdmin):
         list_display = list(self.list_display)
         if getattr(settings, 'USE_IDENTITY_PROVIDERS', False):
             list_display.insert(-1, "identity_provider")
+        if settings.ENCODE_FAIR_SHARE_BY == "rbac_group":
+            list_display.append("get_encode_queue_depth")
 
         return list_display
 
@@ -133,6 +136,11 @@ class RBACGroupAdmin(admin.ModelAdmin):
 
     get_manager_count.short_description = 'Managers'
 
+    def get_encode_queue_depth(self, obj):
+        return get_encode_queue_depth(f"group:{obj.id}")
+
+    get_encode_queue_depth.short_description = 'Queued encodes'
+
     fieldsets = (
         (
             None,
@@ -1,6 +1,15 @@
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files import File
+from django.db.models import F
+from django.db.models.functions import Lower
 from django.test import Client, TestCase
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 
+from cms.custom_pagination import KeysetPagination
 from files.models import Media
 from files.tests import create_account
 
@@ -33,6 +42,64 @@ class TestMediaListings(TestCase):
         media_titles = [item['title'] for item in response.data['results']]
         self.assertIn(self.media.title, media_titles, "Test media should be in the results")
 
+    def test_media_list_cursor_pages(self):
+        """Test following the cursor pages of the media list"""
+        for i in range(4):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                Media.objects.create(title=f"Media {i}", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True, media_file=File(f))
+        # same add_date, pages are told apart by the id
+        Media.objects.update(add_date=timezone.now(), listable=True)
+
+        titles = []
+        url = '/api/v1/media?pagination=cursor'
+        with mock.patch.object(KeysetPagination, "page_size", 2):
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, "Cursor pages should return 200")
+                self.assertNotIn('count', response.data, "Cursor pages should not count the media")
+                titles += [item['title'] for item in response.data['results']]
+                url = response.data['next']
+        self.assertEqual(sorted(titles), sorted(Media.objects.values_list("title", flat=True)), "Each media should be listed once")
+
+        response = self.client.get('/api/v1/media?cursor=invalid')
+        self.assertEqual(response.status_code, 404, "Invalid cursors should return 404")
+
+    def cursor_pages(self, queryset):
+        ids = []
+        url = '/api/v1/media'
+        with mock.patch.object(KeysetPagination, "page_size", 2):
+            while url:
+                paginator = KeysetPagination()
+                ids += [media.id for media in paginator.paginate_queryset(queryset, Request(APIRequestFactory().get(url)))]
+                url = paginator.get_next_link()
+        return ids
+
+    def test_cursor_pages_with_nulls(self):
+        """Test cursor pages of a nullable sort field with NULL values"""
+        for i in range(4):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                Media.objects.create(title=f"Media {i}", user=self.user, media_file=File(f))
+        Media.objects.filter(title__in=["Media 1", "Media 2", "Media 3"]).update(add_date=None)
+
+        expected = list(Media.objects.exclude(add_date=None).order_by("-add_date", "-id").values_list("id", flat=True))
+        expected += list(Media.objects.filter(add_date=None).order_by("-id").values_list("id", flat=True))
+        self.assertEqual(self.cursor_pages(Media.objects.order_by("-add_date")), expected, "NULLs should go last")
+
+        ordering = F("add_date").asc(nulls_first=True)
+        expected = list(Media.objects.order_by(ordering, "id").values_list("id", flat=True))
+        self.assertEqual(self.cursor_pages(Media.objects.order_by(ordering)), expected, "NULLs should go first if asked")
+
+    def test_cursor_pages_with_expression_ordering(self):
+        """Test cursor pages of querysets ordered by expressions"""
+        for i in range(4):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                Media.objects.create(title=f"Media {i}", user=self.user, media_file=File(f))
+
+        expected = list(Media.objects.order_by("-title", "-id").values_list("id", flat=True))
+        self.assertEqual(self.cursor_pages(Media.objects.order_by(F("title").desc())), expected)
+        with self.assertRaises(ImproperlyConfigured):
+            self.cursor_pages(Media.objects.order_by(Lower("title")))
+
     def test_featured_media_listing(self):
         """Test the featured media listing"""
         # Mark our test media as featured
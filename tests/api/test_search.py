@@ -1,7 +1,11 @@
+import tempfile
+from unittest import mock
+
 from django.core.files import File
 from django.test import Client, TestCase
 
-from files.models import Category, Media, Tag
+from cms.custom_pagination import KeysetPagination
+from files.models import Category, Language, Media, Subtitle, Tag
 from files.tests import create_account
 
 
@@ -112,3 +116,51 @@ class TestSearch(TestCase):
 
         media_titles = [item['title'] for item in response.data['results']]
         self.assertNotIn(image_media.title, media_titles, "Image media should not be in results")
+
+    def test_search_transcripts(self):
+        """Test searching subtitles, with the times where the text is said"""
+        language = Language.objects.create(code="en", title="English")
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".vtt") as f:
+            f.write("WEBVTT\n\n00:00:01.000 --> 00:00:04.000\nWelcome\n\n00:01:05.000 --> 00:01:08.000\nDecorators wrap functions\n")
+            f.flush()
+            with open(f.name, "rb") as subtitle_file:
+                Subtitle.objects.create(media=self.media1, user=self.user, language=language, subtitle_file=File(subtitle_file, name="python.vtt"))
+
+        response = self.client.get('/api/v1/search/transcripts?q=decorators')
+        self.assertEqual(response.status_code, 200, "Transcripts search endpoint should return 200")
+        results = response.data['results']
+        self.assertEqual([item['title'] for item in results], [self.media1.title])
+        self.assertEqual([cue['start'] for cue in results[0]['timestamps']], [65.0], "Should point to the matching cue")
+
+    def test_search_cursor_pages_with_tied_rank(self):
+        """Test following cursor pages of media that rank the same"""
+        for i in range(4):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                media = Media.objects.create(title="Thermodynamics", description="Lecture", user=self.user, media_file=File(f))
+            media.update_search_vector()
+
+        titles = []
+        url = '/api/v1/search?q=thermodynamics&pagination=cursor'
+        with mock.patch.object(KeysetPagination, "page_size", 2):
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, "Cursor pages should return 200")
+                titles += [item['title'] for item in response.data['results']]
+                url = response.data['next']
+        self.assertEqual(titles, ["Thermodynamics"] * 4, "Each media should be listed once")
+
+    def test_search_autocomplete(self):
+        """Test title suggestions as the query is typed"""
+        response = self.client.get('/api/v1/search/autocomplete?q=Pyth')
+        self.assertEqual(response.status_code, 200, "Autocomplete endpoint should return 200")
+        self.assertEqual(response.data, [{"title": self.media1.title, "type": "media"}])
+
+        response = self.client.get('/api/v1/search/autocomplete?q=basics')
+        self.assertEqual(response.data, [{"title": self.media3.title, "type": "media"}], "Titles that contain the query should be suggested")
+
+        Tag.objects.filter(id=self.tag.id).update(media_count=2)
+        response = self.client.get('/api/v1/search/autocomplete?q=progr')
+        self.assertEqual(response.data, [{"title": self.tag.title, "type": "tag"}], "Tags with media should be suggested")
+
+        response = self.client.get('/api/v1/search/autocomplete?q=py')
+        self.assertEqual(response.data, [], "Should not suggest for very short queries")
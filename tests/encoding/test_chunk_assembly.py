@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+
+from files import tasks
+from files.models import EncodeProfile, Encoding, Media
+from files.tests import create_account
+
+
+class ChunksMixin:
+    def create_chunks(self):
+        self.user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            media = Media.objects.create(title="lecture", user=self.user, media_file=File(f))
+        Media.objects.filter(id=media.id).update(media_type="video", encoding_status="pending")
+        self.media = Media.objects.get(id=media.id)
+        self.profile = EncodeProfile.objects.get(name="vp9-240")
+
+        self.chunks_dir = tempfile.mkdtemp(dir=settings.MEDIA_ROOT)
+        orig_chunks = [os.path.join(self.chunks_dir, f"{i}_source.mkv") for i in range(2)]
+        chunks_info = json.dumps({orig_chunk: {} for orig_chunk in orig_chunks})
+        chunks = []
+        for i, orig_chunk in enumerate(orig_chunks):
+            path = os.path.join(self.chunks_dir, f"{i}_encoded.webm")
+            with open(path, "wb") as f:
+                f.write(b"chunk")
+            chunks.append(
+                Encoding(
+                    media=self.media,
+                    profile=self.profile,
+                    status="success",
+                    chunk=True,
+                    chunks_info=chunks_info,
+                    chunk_file_path=orig_chunk,
+                    media_file=os.path.relpath(path, settings.MEDIA_ROOT),
+                    worker="worker",
+                )
+            )
+        # without signals, that would schedule the assembly
+        return Encoding.objects.bulk_create(chunks)
+
+    def remove_chunks(self):
+        for encoding in Encoding.objects.filter(media=self.media):
+            encoding.delete()
+        shutil.rmtree(self.chunks_dir, ignore_errors=True)
+
+    def concat(self, cmd, cwd=None):
+        # ffmpeg concat, the output is the last argument
+        shutil.copy(Encoding.objects.filter(chunk=True).first().media_file.path, cmd[-1])
+        return "concatenated"
+
+
+class TestChunkAssembly(ChunksMixin, TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.chunks = self.create_chunks()
+
+    def tearDown(self):
+        self.remove_chunks()
+
+    def test_assemble_chunks(self):
+        with mock.patch("files.tasks.run_command", side_effect=self.concat) as run_command:
+            self.assertTrue(tasks.assemble_encoding_chunks(self.chunks[1].id))
+            # called for another chunk of the same profile, when done already
+            self.assertFalse(tasks.assemble_encoding_chunks(self.chunks[0].id))
+        self.assertEqual(run_command.call_count, 1)
+
+        encodings = list(Encoding.objects.filter(media=self.media, profile=self.profile))
+        self.assertEqual(len(encodings), 1, "Chunks should be replaced by the final encoding")
+        encoding = encodings[0]
+        self.assertFalse(encoding.chunk)
+        self.assertEqual((encoding.status, encoding.progress), ("success", 100))
+        with open(encoding.media_file.path, "rb") as f:
+            self.assertEqual(f.read(), b"chunk")
+
+        # post encode actions run, even though the encoding was bulk created
+        self.media.refresh_from_db()
+        self.assertEqual(self.media.encoding_status, "success")
+
+    def test_assembly_scheduled_once(self):
+        Encoding.objects.filter(id=self.chunks[1].id).update(status="running")
+        chunk = Encoding.objects.get(id=self.chunks[1].id)
+        with mock.patch.object(tasks.assemble_encoding_chunks, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                chunk.status = "success"
+                chunk.save()
+            delay.assert_called_once_with(chunk.id)
+
+            # other saves of a ready chunk don't schedule it again
+            with self.captureOnCommitCallbacks(execute=True):
+                chunk.logs = "done"
+                chunk.save(update_fields=["logs"])
+                chunk.save()
+            delay.assert_called_once()
+
+    def test_failed_concat_gives_back_chunks(self):
+        with mock.patch("files.tasks.run_command", side_effect=OSError("ffmpeg not found")):
+            with self.assertRaises(OSError):
+                tasks.assemble_encoding_chunks(self.chunks[1].id)
+        self.assertEqual(list(Encoding.objects.filter(media=self.media, chunk=True).values_list("status", flat=True)), ["success", "success"])
+
+    def test_incomplete_chunks(self):
+        Encoding.objects.filter(id=self.chunks[0].id).update(status="running")
+        with mock.patch("files.tasks.run_command", side_effect=self.concat) as run_command:
+            self.assertFalse(tasks.assemble_encoding_chunks(self.chunks[1].id))
+        run_command.assert_not_called()
+        self.assertEqual(Encoding.objects.filter(media=self.media, chunk=True).count(), 2)
+
+
+@unittest.skipUnless(connection.features.has_select_for_update, "needs row locks")
+class TestConcurrentChunkAssembly(ChunksMixin, TransactionTestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.chunks = self.create_chunks()
+
+    def tearDown(self):
+        self.remove_chunks()
+
+    def test_assembled_once(self):
+        concatenating = threading.Event()
+        release = threading.Event()
+
+        def slow_concat(cmd, cwd=None):
+            concatenating.set()
+            release.wait(10)
+            return self.concat(cmd, cwd)
+
+        results = {}
+
+        def assemble(chunk):
+            try:
+                results[chunk.id] = tasks.assemble_encoding_chunks(chunk.id)
+            finally:
+                connections.close_all()
+
+        with mock.patch("files.tasks.run_command", side_effect=slow_concat) as run_command:
+            first = threading.Thread(target=assemble, args=(self.chunks[0],))
+            first.start()
+            self.assertTrue(concatenating.wait(10))
+            # the chunks are claimed, their rows are not locked during the concatenation
+            with transaction.atomic():
+                self.assertEqual(len(Encoding.objects.select_for_update(nowait=True).filter(id__in=[chunk.id for chunk in self.chunks])), 2)
+            second = threading.Thread(target=assemble, args=(self.chunks[1],))
+            second.start()
+            second.join(10)
+            release.set()
+            first.join(10)
+
+        self.assertEqual(run_command.call_count, 1)
+        self.assertEqual(sorted(results.values()), [False, True])
+        self.assertEqual(Encoding.objects.filter(media=self.media, profile=self.profile).count(), 1)
+        self.assertEqual(Encoding.objects.filter(media=self.media, chunk=True).count(), 0)
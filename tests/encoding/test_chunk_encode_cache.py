@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files import File
+from django.test import TestCase, override_settings
+
+from files import helpers, tasks
+from files.models import EncodeProfile, Encoding, Media
+from files.tests import create_account
+
+
+class TestChunkEncodeCache(TestCase):
+    def test_fingerprint_ignores_temporary_paths(self):
+        cmds_a = [["ffmpeg", "-y", "-i", "/tmp/a/01_chunk.mkv", "-crf", "23", "/tmp/a/out.mp4"]]
+        cmds_b = [["ffmpeg", "-y", "-i", "/tmp/b/01_chunk.mkv", "-crf", "23", "/tmp/b/out.mp4"]]
+        fingerprint_a = helpers.get_ffmpeg_commands_fingerprint(cmds_a, "/tmp/a/01_chunk.mkv", "/tmp/a/out.mp4", "/tmp/a/pass")
+        fingerprint_b = helpers.get_ffmpeg_commands_fingerprint(cmds_b, "/tmp/b/01_chunk.mkv", "/tmp/b/out.mp4", "/tmp/b/pass")
+        self.assertEqual(fingerprint_a, fingerprint_b, "Fingerprint should not depend on temporary paths")
+
+    def test_fingerprint_ignores_threads(self):
+        cmds_a = [["ffmpeg", "-i", "in", "-threads", "2", "-crf", "23", "out"]]
+        cmds_b = [["ffmpeg", "-i", "in", "-threads", "4", "-crf", "23", "out"]]
+        self.assertEqual(
+            helpers.get_ffmpeg_commands_fingerprint(cmds_a, "in", "out", "pass"),
+            helpers.get_ffmpeg_commands_fingerprint(cmds_b, "in", "out", "pass"),
+            "Fingerprint should not depend on the CPUs the encode got",
+        )
+
+    def test_fingerprint_depends_on_options(self):
+        cmds_a = [["ffmpeg", "-i", "in", "-crf", "23", "out"]]
+        cmds_b = [["ffmpeg", "-i", "in", "-crf", "28", "out"]]
+        self.assertNotEqual(
+            helpers.get_ffmpeg_commands_fingerprint(cmds_a, "in", "out", "pass"),
+            helpers.get_ffmpeg_commands_fingerprint(cmds_b, "in", "out", "pass"),
+            "Fingerprint should change when ffmpeg options change",
+        )
+
+    def test_store_and_lookup(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(USE_CHUNK_ENCODE_CACHE=True, CHUNK_ENCODE_CACHE_DIR=cache_dir):
+                cache_path = helpers.get_chunk_encode_cache_path("abc", 1, "def", "mp4")
+                self.assertTrue(cache_path.startswith(cache_dir))
+
+                with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+                    f.write(b"encoded")
+                self.assertTrue(helpers.store_in_chunk_encode_cache(f.name, cache_path))
+                with open(cache_path, "rb") as f:
+                    self.assertEqual(f.read(), b"encoded")
+
+            with override_settings(USE_CHUNK_ENCODE_CACHE=False):
+                self.assertIsNone(helpers.get_chunk_encode_cache_path("abc", 1, "def", "mp4"))
+            self.assertTrue(os.path.exists(cache_path))
+
+
+class FakeFFmpegBackend:
+    calls = 0
+
+    def encode(self, cmd, cpus=None, on_process=None):
+        FakeFFmpegBackend.calls += 1
+        with open(cmd[-1], "wb") as f:
+            f.write(b"encoded chunk")
+        yield "ffmpeg output"
+
+
+@override_settings(USE_CHUNK_ENCODE_CACHE=True)
+class TestChunkEncodeCacheReuse(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.chunk_path = os.path.join(self.temp_dir, "01_chunk.mkv")
+        with open(self.chunk_path, "wb") as f:
+            f.write(b"chunk")
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            media = Media.objects.create(title="lecture", user=create_account(), media_file=File(f))
+        media_info = {"video_height": 720, "video_frame_rate_n": 30, "video_frame_rate_d": 1, "video_duration": 600, "has_audio": False}
+        Media.objects.filter(id=media.id).update(media_type="video", duration=600, media_info=json.dumps(media_info))
+        self.media = Media.objects.get(id=media.id)
+        self.profile = EncodeProfile.objects.get(name="h264-240")
+
+    def tearDown(self):
+        for encoding in Encoding.objects.filter(media=self.media):
+            encoding.delete()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def encode_chunk(self, cpus):
+        encoding = Encoding.objects.create(media=self.media, profile=self.profile, chunk=True, chunk_file_path=self.chunk_path, chunks_info=json.dumps({self.chunk_path: {}}))
+        with mock.patch("files.tasks.admit_encode", return_value=cpus), mock.patch("files.tasks.FFmpegBackend", FakeFFmpegBackend), mock.patch(
+            "files.tasks.media_file_info", return_value={"is_video": True, "video_duration": 600}
+        ):
+            tasks.encode_media.apply(args=[self.media.friendly_token, self.profile.id, encoding.id], kwargs={"chunk": True, "chunk_file_path": self.chunk_path})
+        return Encoding.objects.get(id=encoding.id)
+
+    def test_encoded_chunk_is_reused(self):
+        FakeFFmpegBackend.calls = 0
+        with override_settings(CHUNK_ENCODE_CACHE_DIR=os.path.join(self.temp_dir, "cache")):
+            first = self.encode_chunk(cpus=[0, 1])
+            self.assertEqual(first.status, "success")
+            self.assertEqual(FakeFFmpegBackend.calls, 1)
+
+            # same chunk, admitted with a different number of CPUs
+            second = self.encode_chunk(cpus=[0, 1, 2, 3])
+        self.assertEqual(second.status, "success")
+        self.assertEqual(FakeFFmpegBackend.calls, 1, "ffmpeg should not run for a cached chunk")
+        self.assertIn("Reused encoded chunk from cache", second.logs)
+        with open(second.media_file.path, "rb") as f:
+            self.assertEqual(f.read(), b"encoded chunk")
@@ -0,0 +1,27 @@
+from django.test import TestCase
+
+from files import helpers
+
+
+class TestChunkPlanner(TestCase):
+    def setUp(self):
+        # 20 minutes at 25fps, keyframe every 2 seconds
+        self.keyframes = [(t, t * 25) for t in range(0, 1200, 2)]
+        self.total_frames = 1200 * 25
+
+    def test_splits_on_keyframes(self):
+        split_times = helpers.plan_video_chunks(self.keyframes, self.total_frames, 1200, workers=4, chunk_duration=240, min_chunk_duration=30)
+        keyframe_times = [k[0] for k in self.keyframes]
+        self.assertTrue(all(t in keyframe_times for t in split_times), "Splits should be on keyframes")
+        self.assertEqual(len(split_times) + 1, 8, "Chunks should be a multiple of workers, no longer than chunk_duration")
+        self.assertEqual(split_times, sorted(split_times))
+
+    def test_equal_cost_chunks(self):
+        split_times = helpers.plan_video_chunks(self.keyframes, self.total_frames, 1200, workers=4, chunk_duration=240, min_chunk_duration=30)
+        bounds = [0, *split_times, 1200]
+        durations = [end - start for start, end in zip(bounds, bounds[1:])]
+        self.assertLessEqual(max(durations) - min(durations), 2, "Chunks should have roughly equal frames")
+
+    def test_short_video_not_split(self):
+        keyframes = [(t, t * 25) for t in range(0, 40, 2)]
+        self.assertEqual(helpers.plan_video_chunks(keyframes, 40 * 25, 40, workers=4, chunk_duration=240, min_chunk_duration=30), [])
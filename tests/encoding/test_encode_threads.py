@@ -0,0 +1,35 @@
+import json
+
+from django.test import TestCase
+
+from files import helpers
+
+MEDIA_INFO = json.dumps(
+    {
+        "video_frame_rate_n": 30,
+        "video_frame_rate_d": 1,
+        "video_height": 2160,
+        "video_duration": 600,
+        "has_audio": True,
+        "interlaced": False,
+    }
+)
+
+
+class TestEncodeThreads(TestCase):
+    def test_threads_scale_with_cost(self):
+        self.assertEqual(helpers.get_encode_threads(MEDIA_INFO, 240, "h264"), 1)
+        self.assertEqual(helpers.get_encode_threads(MEDIA_INFO, 720, "h264"), 2)
+        self.assertGreater(helpers.get_encode_threads(MEDIA_INFO, 720, "vp9"), 2)
+        self.assertGreater(helpers.get_encode_threads(MEDIA_INFO, 2160, "h264"), helpers.get_encode_threads(MEDIA_INFO, 1080, "h264"))
+
+    def test_threads_option(self):
+        cmds = helpers.produce_ffmpeg_commands("/tmp/input.mp4", MEDIA_INFO, 720, "h264", "/tmp/720.mp4", "/tmp/pass", threads=3)
+        self.assertEqual(cmds[-1][cmds[-1].index("-threads") + 1], "3")
+
+        renditions = [
+            {"resolution": 240, "codec": "h264", "output_filename": "/tmp/240.mp4", "threads": 1},
+            {"resolution": 720, "codec": "h264", "output_filename": "/tmp/720.mp4", "threads": 2},
+        ]
+        cmd = helpers.produce_ladder_ffmpeg_command("/tmp/input.mp4", MEDIA_INFO, renditions)
+        self.assertEqual([cmd[i + 1] for i, option in enumerate(cmd) if option == "-threads"], ["1", "2"], "Each output should get its own threads")
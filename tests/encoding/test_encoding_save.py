@@ -0,0 +1,34 @@
+import hashlib
+import tempfile
+from unittest import mock
+
+from django.db import models
+from django.test import TestCase
+
+from files import helpers
+from files.models import Encoding
+
+
+class TestEncodingSave(TestCase):
+    def test_file_md5sum(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"chunk")
+            f.flush()
+            self.assertEqual(helpers.get_file_md5sum(f.name), hashlib.md5(b"chunk").hexdigest())
+            with mock.patch("files.helpers.md5sum_file") as md5sum_file:
+                helpers.get_file_md5sum(f.name)
+                md5sum_file.assert_not_called()
+        self.assertIsNone(helpers.get_file_md5sum(f.name), "File does not exist")
+
+    def test_skip_file_work_on_partial_saves(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"chunk")
+            f.flush()
+            encoding = Encoding(chunk_file_path=f.name)
+            with mock.patch.object(models.Model, "save") as model_save:
+                encoding.save(update_fields=["status", "progress"])
+                self.assertIsNone(encoding.md5sum, "Should not hash the chunk when it is not saved")
+
+                encoding.save(update_fields=["chunk_file_path"])
+                self.assertEqual(encoding.md5sum, hashlib.md5(b"chunk").hexdigest())
+                self.assertEqual(model_save.call_args.kwargs["update_fields"], {"chunk_file_path", "md5sum"})
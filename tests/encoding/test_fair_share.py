@@ -0,0 +1,104 @@
+from unittest import mock
+
+from django.core.files import File
+from django.test import TestCase, override_settings
+from django_redis import get_redis_connection
+
+from files import methods, tasks
+from files.models import EncodeProfile, Encoding, Media
+from files.tasks import is_first_playable
+from files.tests import create_account
+
+
+@override_settings(MINIMUM_RESOLUTIONS_TO_ENCODE=[144, 240])
+class TestFairShare(TestCase):
+    def test_first_playable(self):
+        low = EncodeProfile(name="h264-240", extension="mp4", resolution=240, codec="h264")
+        high = EncodeProfile(name="h264-720", extension="mp4", resolution=720, codec="h264")
+        preview = EncodeProfile(name="preview", extension="gif", resolution=None, codec="")
+
+        self.assertTrue(is_first_playable([low]))
+        self.assertTrue(is_first_playable([preview]))
+        self.assertFalse(is_first_playable([high, low]), "A ladder with higher resolutions should not go first")
+        self.assertFalse(is_first_playable([high]))
+
+    @override_settings(USE_LADDER_ENCODING=True, LADDER_ENCODING_CODECS=["h264"])
+    def test_minimum_resolutions_out_of_ladder(self):
+        low = EncodeProfile(name="h264-240", extension="mp4", resolution=240, codec="h264")
+        high = EncodeProfile(name="h264-720", extension="mp4", resolution=720, codec="h264")
+        higher = EncodeProfile(name="h264-1080", extension="mp4", resolution=1080, codec="h264")
+
+        self.assertEqual(tasks.split_ladder_profiles([low, high, higher]), ([high, higher], [low]))
+
+
+class TestDispatchEncodes(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.clear_redis()
+        user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            self.media = Media.objects.create(title="lecture", user=user, media_file=File(f))
+        self.profile = EncodeProfile.objects.get(name="h264-720")
+
+    def tearDown(self):
+        self.clear_redis()
+
+    def clear_redis(self):
+        keys = list(self.redis.scan_iter(f"{methods.ENCODE_QUEUE_KEY_PREFIX}:*"))
+        if keys:
+            self.redis.delete(*keys)
+
+    def push(self, owner, name, first_playable=False):
+        encoding = Encoding.objects.create(media=self.media, profile=self.profile, status="pending")
+        job = {"task": tasks.encode_media.name, "args": [name], "kwargs": {}, "encoding_ids": [encoding.id], "priority": 0 if first_playable else 9}
+        methods.push_encode_job(owner, job, first_playable=first_playable)
+        return encoding
+
+    def dispatch(self):
+        with mock.patch.object(tasks.encode_media, "apply_async") as apply_async:
+            tasks.dispatch_encodes()
+        return [call.kwargs["args"][0] for call in apply_async.call_args_list]
+
+    @override_settings(ENCODE_DISPATCH_MAX_IN_FLIGHT=10)
+    def test_round_robin(self):
+        for name in ["a1", "a2", "a3"]:
+            self.push("user:a", name)
+        for name in ["b1", "b2"]:
+            self.push("user:b", name)
+        self.push("user:c", "c1")
+
+        self.assertEqual(self.dispatch(), ["a1", "b1", "c1", "a2", "b2", "a3"])
+        self.assertEqual(self.redis.lrange(methods.ENCODE_QUEUE_RING_KEY, 0, -1), [], "Owners without jobs should leave the ring")
+
+    @override_settings(ENCODE_DISPATCH_MAX_IN_FLIGHT=10)
+    def test_first_playable_first(self):
+        self.push("user:a", "a-720")
+        self.push("user:a", "a-1080")
+        self.push("user:b", "b-720")
+        self.push("user:a", "a-240", first_playable=True)
+        self.push("user:b", "b-240", first_playable=True)
+
+        self.assertEqual(self.dispatch(), ["a-240", "b-240", "a-720", "b-720", "a-1080"])
+
+    @override_settings(ENCODE_DISPATCH_MAX_IN_FLIGHT=2)
+    def test_max_in_flight(self):
+        encodings = [self.push("user:a", name) for name in ["a1", "a2", "a3"]]
+        self.push("user:b", "b1")
+
+        self.assertEqual(self.dispatch(), ["a1", "b1"])
+        self.assertEqual(self.dispatch(), [], "No slots while the dispatched encodes run")
+
+        Encoding.objects.filter(id=encodings[0].id).update(status="success")
+        self.assertEqual(self.dispatch(), ["a2"])
+        self.assertEqual(self.redis.zcard(methods.get_encode_queue_key("user:a")), 1)
+
+    @override_settings(ENCODE_DISPATCH_MAX_IN_FLIGHT=None)
+    def test_no_max_in_flight(self):
+        for name in ["a1", "a2"]:
+            self.push("user:a", name)
+        self.push("user:b", "b1")
+
+        self.assertEqual(self.dispatch(), ["a1", "b1", "a2"])
+        self.assertEqual(self.redis.hlen(methods.ENCODE_QUEUE_IN_FLIGHT_KEY), 0)
@@ -0,0 +1,87 @@
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from django.test import TestCase
+
+from files.backends import FFmpegBackend, VideoEncodingError
+from files.methods import kill_ffmpeg_process
+
+# a worker that dies without killing its ffmpeg
+DYING_WORKER = """
+import os, signal
+from files.backends import FFmpegBackend
+process = FFmpegBackend()._spawn(["sleep", "60"])
+print(process.pid, flush=True)
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+FAKE_FFMPEG = """#!/bin/sh
+echo "ffmpeg version n7.0" >&2
+printf "frame=10\\nout_time_us=N/A\\nprogress=continue\\n"
+printf "frame=20\\nout_time_us=2500000\\nprogress=continue\\n"
+printf "frame=30\\nout_time_us=5000000\\nprogress=end\\n"
+exit $EXIT_CODE
+"""
+
+
+class TestFFmpegBackend(TestCase):
+    def setUp(self):
+        fd, self.command = tempfile.mkstemp(suffix=".sh")
+        with os.fdopen(fd, "w") as f:
+            f.write(FAKE_FFMPEG)
+        os.chmod(self.command, os.stat(self.command).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        os.remove(self.command)
+
+    def test_progress_blocks(self):
+        os.environ["EXIT_CODE"] = "0"
+        results = list(FFmpegBackend().encode([self.command, "-i", "input.mp4", "output.mp4"]))
+        self.assertEqual(results[:-1], [2.5, 5.0], "Should yield processed seconds once per progress block")
+        self.assertIn("ffmpeg version", results[-1], "Should yield the ffmpeg output last")
+
+    def test_failure(self):
+        os.environ["EXIT_CODE"] = "1"
+        with self.assertRaises(VideoEncodingError):
+            list(FFmpegBackend().encode([self.command, "-i", "input.mp4", "output.mp4"]))
+
+    def test_process_pid(self):
+        os.environ["EXIT_CODE"] = "0"
+        pids = []
+        list(FFmpegBackend().encode([self.command, "-i", "input.mp4", "output.mp4"], on_process=pids.append))
+        self.assertEqual(len(pids), 2)
+        self.assertTrue(pids[0], "Should be called with the pid once ffmpeg is started")
+        self.assertIsNone(pids[1], "Should be called with None once ffmpeg has exited")
+
+    def test_kill_by_pid(self):
+        process = FFmpegBackend()._spawn(["sleep", "60"])
+        encoding = SimpleNamespace(id=1, ffmpeg_pid=process.pid, ffmpeg_host=socket.gethostname())
+        self.assertTrue(kill_ffmpeg_process(encoding))
+        process.communicate()
+        self.assertEqual(process.returncode, -9)
+        self.assertFalse(kill_ffmpeg_process(encoding), "Process has exited")
+        self.assertFalse(kill_ffmpeg_process(SimpleNamespace(id=1, ffmpeg_pid=None, ffmpeg_host="")))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs prctl")
+    def test_killed_with_worker(self):
+        worker = subprocess.run([sys.executable, "-c", DYING_WORKER], stdout=subprocess.PIPE, check=False)
+        pid = int(worker.stdout)
+        for _ in range(50):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # not reaped if the new parent doesn't wait
+                    if f.read().rpartition(")")[2].split()[0] == "Z":
+                        break
+            except FileNotFoundError:
+                break
+            time.sleep(0.1)
+        else:
+            os.kill(pid, 9)
+            self.fail("ffmpeg should be killed when the worker dies")
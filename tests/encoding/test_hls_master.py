@@ -0,0 +1,52 @@
+import m3u8
+from django.test import TestCase
+
+from files import helpers
+
+RENDITION_MASTER = """#EXTM3U
+# Created with Bento4 mp4-hls.py version 1.2.0r637
+
+#EXT-X-VERSION:4
+
+# Media Playlists
+#EXT-X-STREAM-INF:AVERAGE-BANDWIDTH={bandwidth},BANDWIDTH={bandwidth},CODECS="avc1.42C01E,mp4a.40.2",RESOLUTION={resolution}
+media-1/stream.m3u8
+
+# I-Frame Playlists
+#EXT-X-I-FRAME-STREAM-INF:AVERAGE-BANDWIDTH=10000,BANDWIDTH=20000,CODECS="avc1.42C01E",RESOLUTION={resolution},URI="media-1/iframes.m3u8"
+"""
+
+RENDITION_MASTER_WITH_AUDIO = """#EXTM3U
+#EXT-X-VERSION:4
+
+# Media Playlists
+#EXT-X-STREAM-INF:AVERAGE-BANDWIDTH={bandwidth},BANDWIDTH={bandwidth},CODECS="avc1.42C01E,mp4a.40.2",RESOLUTION={resolution},AUDIO="audio_aac"
+media-1/stream.m3u8
+
+# Audio
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio_aac",NAME="en",LANGUAGE="en",AUTOSELECT=YES,DEFAULT=YES,URI="audio-en-mp4a.40.2/stream.m3u8"
+"""
+
+
+class TestHLSMaster(TestCase):
+    def test_merge_renditions(self):
+        renditions = [
+            ("240p_2", RENDITION_MASTER.format(bandwidth=300000, resolution="426x240")),
+            ("720p_5", RENDITION_MASTER.format(bandwidth=2000000, resolution="1280x720")),
+        ]
+        content = helpers.merge_hls_master_playlists(renditions)
+        self.assertEqual(content.count("#EXT-X-VERSION"), 1)
+
+        master = m3u8.loads(content)
+        self.assertEqual([p.uri for p in master.playlists], ["240p_2/media-1/stream.m3u8", "720p_5/media-1/stream.m3u8"])
+        self.assertEqual([p.uri for p in master.iframe_playlists], ["240p_2/media-1/iframes.m3u8", "720p_5/media-1/iframes.m3u8"])
+        self.assertEqual(master.playlists[1].stream_info.resolution, (1280, 720))
+
+    def test_merge_renditions_with_audio(self):
+        renditions = [
+            ("240p_2", RENDITION_MASTER_WITH_AUDIO.format(bandwidth=300000, resolution="426x240")),
+            ("720p_5", RENDITION_MASTER_WITH_AUDIO.format(bandwidth=2000000, resolution="1280x720")),
+        ]
+        master = m3u8.loads(helpers.merge_hls_master_playlists(renditions))
+        self.assertEqual([(m.type, m.group_id, m.name, m.uri) for m in master.media], [("AUDIO", "audio_aac", "en", "240p_2/audio-en-mp4a.40.2/stream.m3u8")])
+        self.assertEqual([p.media[0].uri for p in master.playlists], ["240p_2/audio-en-mp4a.40.2/stream.m3u8"] * 2)
@@ -0,0 +1,38 @@
+import json
+
+from django.test import TestCase
+
+from files import helpers
+
+MEDIA_INFO = json.dumps(
+    {
+        "video_frame_rate_n": 30,
+        "video_frame_rate_d": 1,
+        "video_height": 1080,
+        "video_duration": 600,
+        "has_audio": True,
+        "interlaced": False,
+    }
+)
+
+
+class TestLadderEncoding(TestCase):
+    def test_single_decode_command(self):
+        renditions = [
+            {"resolution": 240, "codec": "h264", "output_filename": "/tmp/240.mp4"},
+            {"resolution": 720, "codec": "h264", "output_filename": "/tmp/720.mp4"},
+        ]
+        cmd = helpers.produce_ladder_ffmpeg_command("/tmp/input.mp4", MEDIA_INFO, renditions)
+
+        self.assertEqual(cmd.count("-i"), 1, "Input should be decoded once")
+        self.assertIn("-filter_complex", cmd)
+        self.assertNotIn("-filter:v", cmd)
+        filter_graph = cmd[cmd.index("-filter_complex") + 1]
+        self.assertTrue(filter_graph.startswith("[0:v]split=2[s0][s1]"))
+        self.assertIn("/tmp/240.mp4", cmd)
+        self.assertIn("/tmp/720.mp4", cmd)
+        self.assertEqual(cmd.count("-map"), 4, "Each output maps its video branch and the audio")
+
+    def test_unsupported_rendition(self):
+        renditions = [{"resolution": 240, "codec": "unknown", "output_filename": "/tmp/240.mp4"}]
+        self.assertFalse(helpers.produce_ladder_ffmpeg_command("/tmp/input.mp4", MEDIA_INFO, renditions))
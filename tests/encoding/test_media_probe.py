@@ -0,0 +1,89 @@
+import copy
+import json
+import os
+import stat
+import tempfile
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from files import helpers
+
+FFPROBE_OUTPUT = {
+    "streams": [
+        {"codec_type": "video", "codec_name": "h264", "width": 1280, "height": 720, "r_frame_rate": "25/1", "duration": "10.0", "bit_rate": "1024000"},
+        {"codec_type": "audio", "codec_name": "aac", "sample_rate": "48000", "channels": 2, "duration": "10.0", "bit_rate": "131072"},
+    ],
+    "format": {"format_name": "mov,mp4,m4a,3gp,3g2,mj2", "duration": "10.0"},
+}
+
+FAKE_FFPROBE = """#!/bin/sh
+echo run >> {calls}
+case "$*" in
+  *packet=size*) printf "64000|\\n64000|\\n" ;;
+  *) cat {output} ;;
+esac
+"""
+
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class TestMediaProbe(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.calls = os.path.join(self.temp_dir.name, "calls")
+        output = os.path.join(self.temp_dir.name, "output.json")
+        with open(output, "w") as f:
+            json.dump(FFPROBE_OUTPUT, f)
+        self.ffprobe = os.path.join(self.temp_dir.name, "ffprobe")
+        with open(self.ffprobe, "w") as f:
+            f.write(FAKE_FFPROBE.format(calls=self.calls, output=output))
+        os.chmod(self.ffprobe, os.stat(self.ffprobe).st_mode | stat.S_IEXEC)
+        self.media = os.path.join(self.temp_dir.name, "media.mp4")
+        with open(self.media, "wb") as f:
+            f.write(b"media content")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def ffprobe_calls(self):
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def test_single_probe(self):
+        with override_settings(FFPROBE_COMMAND=self.ffprobe, CACHES=LOCMEM_CACHES):
+            cache.clear()
+            ret = helpers.media_file_info(self.media)
+        self.assertEqual(self.ffprobe_calls(), 1, "Should run ffprobe once")
+        self.assertEqual(ret["md5sum"], helpers.md5sum_file(self.media))
+        self.assertEqual(ret["file_size"], len(b"media content"))
+        self.assertEqual(ret["video_height"], 720)
+        self.assertEqual(ret["audio_bitrate"], 128.0)
+
+    def test_cached_until_file_changes(self):
+        with override_settings(FFPROBE_COMMAND=self.ffprobe, CACHES=LOCMEM_CACHES):
+            cache.clear()
+            helpers.media_file_info(self.media)
+            helpers.media_file_info(self.media)
+            self.assertEqual(self.ffprobe_calls(), 1, "Should use the cached result")
+
+            with open(self.media, "ab") as f:
+                f.write(b" changed")
+            ret = helpers.media_file_info(self.media)
+            self.assertEqual(self.ffprobe_calls(), 2, "Should probe again a changed file")
+            self.assertEqual(ret["file_size"], len(b"media content changed"))
+
+    def test_bitrate_from_packets(self):
+        # eg webm, without bit_rate or BPS tag on the stream
+        output = copy.deepcopy(FFPROBE_OUTPUT)
+        del output["streams"][0]["bit_rate"]
+        with open(os.path.join(self.temp_dir.name, "output.json"), "w") as f:
+            json.dump(output, f)
+
+        with override_settings(FFPROBE_COMMAND=self.ffprobe, CACHES=LOCMEM_CACHES):
+            cache.clear()
+            ret = helpers.media_file_info(self.media)
+        self.assertEqual(self.ffprobe_calls(), 2, "Should read the packets of the stream")
+        self.assertEqual(ret["video_bitrate"], round(128000 * 8 / 1024.0 / 10, 2))
+        self.assertEqual(ret["audio_bitrate"], 128.0)
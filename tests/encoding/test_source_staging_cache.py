@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+from django.test import TestCase, override_settings
+
+from files import helpers
+
+
+class TestSourceStagingCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def create_source(self, name, size):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_disabled(self):
+        source = self.create_source("a.mp4", 10)
+        with override_settings(USE_SOURCE_STAGING_CACHE=False):
+            self.assertEqual(helpers.stage_source_file(source, "uid", "md5"), source)
+
+    def test_stage_and_evict(self):
+        source_a = self.create_source("a.mp4", 60)
+        source_b = self.create_source("b.mp4", 60)
+        with override_settings(USE_SOURCE_STAGING_CACHE=True, SOURCE_STAGING_CACHE_DIR=self.cache_dir, SOURCE_STAGING_CACHE_SIZE=100):
+            staged_a = helpers.stage_source_file(source_a, "uida", "md5a")
+            self.assertNotEqual(staged_a, source_a)
+            self.assertEqual(os.path.basename(staged_a), "uida_md5a.mp4")
+            self.assertEqual(helpers.stage_source_file(source_a, "uida", "md5a"), staged_a, "Should reuse the staged file")
+
+            staged_b = helpers.stage_source_file(source_b, "uidb", "md5b")
+            self.assertTrue(os.path.exists(staged_b))
+            self.assertFalse(os.path.exists(staged_a), "Least recently used entry should be evicted")
+
+    def test_larger_than_cache(self):
+        source = self.create_source("a.mp4", 200)
+        with override_settings(USE_SOURCE_STAGING_CACHE=True, SOURCE_STAGING_CACHE_DIR=self.cache_dir, SOURCE_STAGING_CACHE_SIZE=100):
+            self.assertEqual(helpers.stage_source_file(source, "uid", "md5"), source)
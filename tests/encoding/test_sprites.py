@@ -0,0 +1,35 @@
+from unittest import mock
+
+from django.core.files import File
+from django.test import TestCase
+
+from files import helpers, tasks
+from files.models import Media
+from files.tests import create_account
+
+
+class TestSprites(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def test_single_ffmpeg_command(self):
+        cmd, frames = helpers.produce_sprites_command("/tmp/input.mp4", "/tmp/sprites.jpg", duration=95, interval=10)
+        self.assertEqual(frames, 10)
+        self.assertEqual(cmd[cmd.index("-skip_frame") + 1], "nokey", "Should decode only keyframes")
+        self.assertEqual(cmd[cmd.index("-vf") + 1], "fps=1/10,scale=160:90,tile=1x10")
+        self.assertEqual(cmd[-1], "/tmp/sprites.jpg")
+
+    def test_vtt(self):
+        vtt = helpers.produce_sprites_vtt("/media/sprites.jpg", frames=10, duration=95, interval=10)
+        lines = vtt.splitlines()
+        self.assertEqual(lines[0], "WEBVTT")
+        self.assertEqual(lines[2:4], ["00:00:00.000 --> 00:00:10.000", "/media/sprites.jpg#xywh=0,0,160,90"])
+        self.assertIn("00:01:30.000 --> 00:01:35.000", lines)
+        self.assertIn("/media/sprites.jpg#xywh=0,810,160,90", lines)
+
+    def test_failure_is_logged(self):
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            media = Media.objects.create(title="lecture", user=create_account(), media_file=File(f))
+        with mock.patch("files.tasks.run_command", side_effect=OSError("ffmpeg not found")):
+            with self.assertLogs("files.tasks", level="ERROR") as logs:
+                self.assertTrue(tasks.produce_sprite_from_video(media.friendly_token))
+        self.assertIn("ffmpeg not found", logs.output[0], "Should log the traceback")
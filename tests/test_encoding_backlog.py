@@ -0,0 +1,44 @@
+from django.core.cache import cache
+from django.core.files import File
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from files.methods import get_encoding_backlog, get_throughput_model
+from files.models import EncodeProfile, Encoding, Media, ProcessingTiming
+from files.tests import create_account
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class TestEncodingBacklog(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            self.media = Media.objects.create(title="lecture", user=self.user, media_file=File(f))
+        Media.objects.filter(id=self.media.id).update(duration=600)
+        self.profile = EncodeProfile.objects.get(name="vp9-720")
+
+    def test_throughput_model(self):
+        with override_settings(CACHES=LOCMEM_CACHES):
+            cache.clear()
+            ProcessingTiming.objects.create(stage="encode", profile=self.profile, media_duration=100, run_time=40)
+            ProcessingTiming.objects.create(stage="encode", profile=self.profile, media_duration=100, run_time=60)
+            model = get_throughput_model()
+            self.assertEqual(model[("encode", self.profile.id)], 2, "Should be seconds of media per second")
+            self.assertEqual(model[("encode", None)], 2, "Should keep the average of the stage")
+
+    def test_expected_ready(self):
+        with override_settings(CACHES=LOCMEM_CACHES, ENCODE_DISPATCH_MAX_IN_FLIGHT=2):
+            cache.clear()
+            ProcessingTiming.objects.create(stage="encode", profile=self.profile, media_duration=100, run_time=50)
+            Encoding.objects.create(media=self.media, profile=self.profile, status="pending")
+
+            backlog = get_encoding_backlog()
+            self.assertEqual(backlog["backlog_media_hours"], round(600 / 3600, 2))
+            self.assertEqual(backlog["backlog_encode_hours"], round(300 / 3600, 2))
+            self.assertEqual(backlog["parallel_encodes"], 2)
+            self.assertEqual(backlog["media"][0]["friendly_token"], self.media.friendly_token)
+            ready_in = (backlog["media"][0]["expected_ready"] - timezone.now()).total_seconds()
+            self.assertAlmostEqual(ready_in, 300, delta=5)
@@ -0,0 +1,59 @@
+import os
+import tempfile
+
+from django.core.files import File
+from django.test import TestCase, override_settings
+
+from files import helpers
+from files.models import EncodeProfile, Encoding, Media
+from files.tests import create_account
+
+
+@override_settings(FAST_PREVIEW_RESOLUTION=360)
+class TestFastPreview(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            media = Media.objects.create(title="lecture", user=self.user, media_file=File(f))
+        Media.objects.filter(id=media.id).update(media_type="video", video_height=720, encoding_status="pending")
+        self.media = Media.objects.get(id=media.id)
+        fd, self.preview = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+
+    def tearDown(self):
+        helpers.rm_file(self.preview)
+
+    def test_command(self):
+        cmd = helpers.produce_fast_preview_command("/tmp/input.mp4", "/tmp/preview.mp4", 360)
+        self.assertEqual(cmd[cmd.index("-preset") + 1], "ultrafast")
+        self.assertEqual(cmd[cmd.index("-c:v") + 1], "libx264")
+        self.assertEqual(cmd[-1], "/tmp/preview.mp4")
+
+    def test_playable_until_replaced(self):
+        Encoding.objects.create(media=self.media, profile=EncodeProfile.objects.get(name="h264-720"), status="pending")
+        Media.objects.filter(id=self.media.id).update(fast_preview_file_path=self.preview)
+        self.media.refresh_from_db()
+        self.media.set_encoding_status()
+        self.assertEqual(self.media.encoding_status, "success", "Should be playable through the fast preview")
+        self.assertEqual(self.media.encodings_info[360]["h264"]["status"], "success")
+
+        # a lower resolution encoding does not replace it
+        Encoding.objects.create(media=self.media, profile=EncodeProfile.objects.get(name="h264-240"), status="success")
+        self.media.post_encode_actions()
+        self.assertEqual(self.media.fast_preview_file_path, self.preview)
+
+        Encoding.objects.filter(media=self.media, profile__name="h264-720").update(status="success")
+        self.media.post_encode_actions()
+        self.assertEqual(self.media.fast_preview_file_path, "")
+        self.assertFalse(os.path.exists(self.preview))
+
+    def test_preview_stored_after_load_is_kept(self):
+        Encoding.objects.create(media=self.media, profile=EncodeProfile.objects.get(name="h264-720"), status="pending")
+        # the fast preview task finishes after self.media was loaded
+        Media.objects.filter(id=self.media.id).update(fast_preview_file_path=self.preview)
+
+        self.media.post_encode_actions()
+        self.assertEqual(Media.objects.get(id=self.media.id).fast_preview_file_path, self.preview)
+        self.assertEqual(self.media.encoding_status, "success", "Should be playable through the fast preview")
@@ -0,0 +1,35 @@
+from django.core.files import File
+from django.test import TestCase
+
+from files.models import Category, Media
+from files.tasks import get_listings_thumbnails, update_listings_thumbnails
+from files.tests import create_account
+
+
+class TestListingsThumbnails(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.user = create_account()
+        self.first = Category.objects.create(title="aaa first")
+        self.second = Category.objects.create(title="bbb second")
+        self.popular = self.create_media("popular", views=10, categories=[self.first, self.second])
+        self.other = self.create_media("other", views=5, categories=[self.second])
+
+    def create_media(self, title, views, categories):
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            media = Media.objects.create(title=title, user=self.user, state="public", encoding_status="success", is_reviewed=True, media_file=File(f))
+        media.category.add(*categories)
+        Media.objects.filter(id=media.id).update(views=views)
+        return media
+
+    def test_most_viewed_unused_media(self):
+        picked = get_listings_thumbnails(Category, "category")
+        self.assertEqual(picked[self.first.id], self.popular.id, "Should pick the most viewed media")
+        self.assertEqual(picked[self.second.id], self.other.id, "Should not pick media already picked")
+
+    def test_update(self):
+        update_listings_thumbnails()
+        self.second.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.second.listings_thumbnail, self.other.thumbnail_url)
@@ -0,0 +1,50 @@
+from django.core.files import File
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from files.models import Category, Media, Tag
+from files.tests import create_account
+
+
+class TestMediaCounts(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.user = create_account()
+        self.category = Category.objects.create(title="lectures", user=self.user)
+        self.tag = Tag.objects.create(title="physics", user=self.user)
+        self.media = []
+        for i in range(3):
+            with open("fixtures/test_image2.jpg", "rb") as f:
+                media = Media.objects.create(title=f"lecture {i}", user=self.user, media_file=File(f))
+            self.media.append(media)
+
+    def test_counts_updated_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for media in self.media:
+                media.category.add(self.category)
+                media.tags.add(self.tag)
+                media.state = "public"
+                media.is_reviewed = True
+                media.listable = True
+                media.save(update_fields=["state", "is_reviewed", "listable"])
+
+        self.user.refresh_from_db()
+        self.category.refresh_from_db()
+        self.tag.refresh_from_db()
+        self.assertEqual(self.user.media_count, 3)
+        self.assertEqual(self.category.media_count, 3)
+        self.assertEqual(self.tag.media_count, 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.media[0].category.remove(self.category)
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.media_count, 2, "Should count removals too")
+
+    def test_one_field_saves_skip_counts(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with CaptureQueriesContext(connection) as queries:
+                self.media[0].save(update_fields=["encoding_status"])
+        self.assertEqual(len(callbacks), 0)
+        self.assertEqual(len(queries), 1, "Should only update the media")
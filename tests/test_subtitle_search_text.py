@@ -0,0 +1,75 @@
+import importlib
+import tempfile
+from unittest import mock
+
+from django.apps import apps
+from django.contrib.postgres.search import SearchQuery
+from django.core.files import File
+from django.test import TestCase
+
+from files.models import Language, Media, Subtitle, SubtitleCue
+from files.tests import create_account
+
+VTT = """WEBVTT
+
+00:00:01.000 --> 00:00:04.000
+Entropy always increases
+
+00:00:05.000 --> 00:00:08.000
+in an isolated system
+"""
+
+
+class TestSubtitleSearchText(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            self.media = Media.objects.create(title="lecture", user=self.user, media_file=File(f))
+        self.language = Language.objects.create(code="en", title="English")
+
+    def test_text_stored_on_save(self):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".vtt") as f:
+            f.write(VTT)
+            f.flush()
+            with open(f.name, "rb") as subtitle_file:
+                subtitle = Subtitle.objects.create(media=self.media, user=self.user, language=self.language, subtitle_file=File(subtitle_file, name="lecture.vtt"))
+        self.assertEqual(Subtitle.objects.get(id=subtitle.id).text, "Entropy always increases in an isolated system")
+        cues = list(SubtitleCue.objects.filter(subtitle=subtitle).values_list("media_id", "start", "text"))
+        self.assertEqual(cues, [(self.media.id, 1.0, "Entropy always increases"), (self.media.id, 5.0, "in an isolated system")])
+
+        with mock.patch("files.models.subtitle.pysubs2.load") as load:
+            self.media.update_search_vector()
+            load.assert_not_called()
+
+    def test_cues_replaced_when_file_changes(self):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".vtt") as f:
+            f.write(VTT)
+            f.flush()
+            with open(f.name, "rb") as subtitle_file:
+                subtitle = Subtitle.objects.create(media=self.media, user=self.user, language=self.language, subtitle_file=File(subtitle_file, name="lecture.vtt"))
+
+        with open(subtitle.subtitle_file.path, "w") as f:
+            f.write("WEBVTT\n\n00:00:02.000 --> 00:00:03.000\nHeat flows\n")
+        subtitle.save()
+
+        self.assertEqual(Subtitle.objects.get(id=subtitle.id).text, "Heat flows")
+        self.assertEqual(list(subtitle.cues.values_list("start", "text")), [(2.0, "Heat flows")])
+
+    def test_backfill_existing_subtitles(self):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".vtt") as f:
+            f.write(VTT)
+            f.flush()
+            with open(f.name, "rb") as subtitle_file:
+                subtitle = Subtitle.objects.create(media=self.media, user=self.user, language=self.language, subtitle_file=File(subtitle_file, name="lecture.vtt"))
+        # as uploaded before the text and the cues were stored
+        Subtitle.objects.filter(id=subtitle.id).update(text="")
+        SubtitleCue.objects.filter(subtitle=subtitle).delete()
+
+        migration = importlib.import_module("files.migrations.0027_backfill_subtitles")
+        migration.backfill_subtitles(apps, None)
+        self.assertEqual(Subtitle.objects.get(id=subtitle.id).text, "Entropy always increases in an isolated system")
+        cues = list(SubtitleCue.objects.filter(subtitle=subtitle).values_list("media_id", "start", "text"))
+        self.assertEqual(cues, [(self.media.id, 1.0, "Entropy always increases"), (self.media.id, 5.0, "in an isolated system")])
+        self.assertTrue(SubtitleCue.objects.filter(subtitle=subtitle, search=SearchQuery("entropy", config="simple")).exists(), "Cues should be searchable")
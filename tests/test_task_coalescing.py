@@ -0,0 +1,24 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from files import tasks
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class TestTaskCoalescing(TestCase):
+    def test_duplicates_are_suppressed(self):
+        with override_settings(CACHES=LOCMEM_CACHES):
+            cache.clear()
+            task_name = tasks.update_search_vector.name
+            # a run is pending for the media
+            cache.add(tasks.get_coalesce_key(task_name, "abc"), 1)
+
+            self.assertFalse(tasks.enqueue_coalesced(tasks.update_search_vector, "abc"))
+            self.assertFalse(tasks.enqueue_coalesced(tasks.update_search_vector, "abc"))
+            self.assertEqual(tasks.get_coalesce_suppressed_count(task_name), 2)
+
+            # the pending run starts, triggers from now on schedule a new one
+            tasks.clear_coalesced(tasks.update_search_vector, "abc")
+            self.assertTrue(tasks.enqueue_coalesced(tasks.update_search_vector, "abc"))
+            self.assertEqual(tasks.get_coalesce_suppressed_count(task_name), 2)
@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+from django.test import TestCase
+from PIL import Image
+
+from files import helpers
+from files.models import Media
+
+
+class TestThumbnailDerivatives(TestCase):
+    def test_renditions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.png")
+            Image.new("RGBA", (800, 600), (255, 0, 0, 255)).save(source)
+
+            derivatives = helpers.produce_image_derivatives(source, os.path.join(temp_dir, "thumb"), [160, 344, 1280])
+            self.assertEqual(list(derivatives["jpeg"].keys()), [160, 344], "Should not upscale")
+            self.assertEqual(list(derivatives["webp"].keys()), [160, 344])
+            with Image.open(derivatives["webp"][344]) as im:
+                self.assertEqual(im.format, "WEBP")
+                self.assertEqual(im.size, (344, 258))
+            with Image.open(derivatives["jpeg"][160]) as im:
+                self.assertEqual(im.format, "JPEG")
+
+    def test_srcset(self):
+        media = Media(thumbnail_derivatives={"jpeg": {"344": "thumbs/a_344w.jpg", "160": "thumbs/a_160w.jpg"}})
+        self.assertEqual(media.thumbnail_srcset, {"jpeg": "/media/thumbs/a_160w.jpg 160w, /media/thumbs/a_344w.jpg 344w"})
+
+    def test_srcset_quotes_paths(self):
+        media = Media(thumbnail_derivatives={"jpeg": {"160": "thumbs/my video, part 1_160w.jpg"}})
+        self.assertEqual(media.thumbnail_renditions, {"jpeg": {160: "/media/thumbs/my%20video%2C%20part%201_160w.jpg"}})
+        self.assertEqual(media.get_thumbnail_srcset(build_url=lambda url: f"http://localhost{url}"), {"jpeg": "http://localhost/media/thumbs/my%20video%2C%20part%201_160w.jpg 160w"})
@@ -0,0 +1,67 @@
+import time
+
+from django.conf import settings
+from django.core.files import File
+from django.test import TestCase
+from django_redis import get_redis_connection
+
+from actions.models import MediaAction
+from files import methods, tasks
+from files.models import Media
+from files.tests import create_account
+
+
+class TestTrendingScores(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.redis.delete(methods.TRENDING_SCORES_KEY, methods.TRENDING_EPOCH_KEY)
+        self.user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            self.media = Media.objects.create(title="lecture", user=self.user, media_file=File(f))
+
+    def tearDown(self):
+        self.redis.delete(methods.TRENDING_SCORES_KEY, methods.TRENDING_EPOCH_KEY)
+
+    def score(self, media_id):
+        return self.redis.zscore(methods.TRENDING_SCORES_KEY, media_id)
+
+    def test_decay(self):
+        # an action a half life after the epoch counts twice as much as one
+        # at the epoch, relative to the epoch
+        self.redis.set(methods.TRENDING_EPOCH_KEY, time.time() - settings.TRENDING_SCORE_HALF_LIFE)
+        methods.add_trending_scores({1: {"watch": 1}, 2: {"like": 1, "watch": 2}, 3: {"dislike": 1}})
+        self.assertAlmostEqual(self.score(1), 2, places=3)
+        self.assertAlmostEqual(self.score(2), 2 * (settings.TRENDING_SCORE_WEIGHTS["like"] + 2 * settings.TRENDING_SCORE_WEIGHTS["watch"]), places=3)
+        self.assertIsNone(self.score(3), "Actions without a weight should not add a score")
+        self.assertEqual(methods.get_trending_media_ids(2), [2, 1])
+
+    def test_rebase(self):
+        epoch = time.time() - settings.TRENDING_SCORE_HALF_LIFE
+        self.redis.set(methods.TRENDING_EPOCH_KEY, epoch)
+        self.redis.zadd(methods.TRENDING_SCORES_KEY, {1: 4, 2: 0.015})
+
+        methods.rebase_trending_scores(0.01)
+        self.assertAlmostEqual(self.score(1), 2, places=3)
+        self.assertIsNone(self.score(2), "Negligible scores should be removed")
+        self.assertGreater(float(self.redis.get(methods.TRENDING_EPOCH_KEY)), epoch + settings.TRENDING_SCORE_HALF_LIFE - 60)
+
+        # increments after the rebase are relative to the new epoch
+        methods.add_trending_scores({1: {"watch": 1}})
+        self.assertAlmostEqual(self.score(1), 3, places=3)
+
+    def test_seed_from_actions(self):
+        other = create_account(username="other", email="other@example.com")
+        MediaAction.objects.create(user=self.user, media=self.media, action="watch")
+        MediaAction.objects.create(user=other, media=self.media, action="watch")
+        MediaAction.objects.create(user=other, media=self.media, action="like")
+
+        tasks.get_list_of_popular_media()
+        self.assertAlmostEqual(self.score(self.media.id), 2 * settings.TRENDING_SCORE_WEIGHTS["watch"] + settings.TRENDING_SCORE_WEIGHTS["like"], places=3)
+        self.assertEqual(methods.get_trending_media_ids(50), [self.media.id])
+
+        # scores are kept up to date by the flusher, not seeded again
+        MediaAction.objects.create(user=self.user, media=self.media, action="like")
+        tasks.get_list_of_popular_media()
+        self.assertAlmostEqual(self.score(self.media.id), 2 * settings.TRENDING_SCORE_WEIGHTS["watch"] + settings.TRENDING_SCORE_WEIGHTS["like"], places=3)
@@ -0,0 +1,75 @@
+from django.core.files import File
+from django.test import Client, TestCase
+from django_redis import get_redis_connection
+
+from actions.models import MediaAction
+from files import methods, tasks
+from files.models import Media
+from files.tests import create_account
+
+
+class TestUserActionsBuffer(TestCase):
+    fixtures = ["fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.clear_redis()
+        self.user = create_account()
+        with open("fixtures/test_image2.jpg", "rb") as f:
+            self.media = Media.objects.create(
+                title="lecture", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True, media_file=File(f)
+            )
+
+    def tearDown(self):
+        self.clear_redis()
+
+    def clear_redis(self):
+        keys = list(self.redis.scan_iter(f"{methods.USER_ACTIONS_KEY_PREFIX}:*")) + [methods.TRENDING_SCORES_KEY, methods.TRENDING_EPOCH_KEY]
+        self.redis.delete(*keys)
+
+    def pending_counters(self):
+        return {field.decode(): int(value) for field, value in self.redis.hgetall(methods.USER_ACTIONS_COUNTERS_KEY).items()}
+
+    def test_record_user_action(self):
+        user_or_session = {"user_id": self.user.id, "user_session": None, "remote_ip_addr": "127.0.0.1"}
+        self.assertTrue(methods.record_user_action(user_or_session, self.media, "like"))
+        self.assertEqual(self.pending_counters(), {f"{self.media.id}:like": 1})
+        self.assertEqual(self.redis.xlen(methods.USER_ACTIONS_STREAM_KEY), 1)
+
+        # once per user, until flushed
+        self.assertFalse(methods.record_user_action(user_or_session, self.media, "like"))
+        self.assertEqual(self.pending_counters(), {f"{self.media.id}:like": 1})
+
+        # anonymous actions are throttled by ip too
+        self.assertTrue(methods.record_user_action({"user_id": None, "user_session": "a", "remote_ip_addr": "10.0.0.1"}, self.media, "watch"))
+        self.assertFalse(methods.record_user_action({"user_id": None, "user_session": "b", "remote_ip_addr": "10.0.0.1"}, self.media, "watch"))
+        self.assertFalse(methods.record_user_action({"user_id": None, "user_session": None, "remote_ip_addr": "10.0.0.2"}, self.media, "watch"))
+        self.assertEqual(self.redis.xlen(methods.USER_ACTIONS_STREAM_KEY), 2)
+
+    def test_pending_counts_are_served(self):
+        methods.record_user_action({"user_id": self.user.id, "user_session": None, "remote_ip_addr": None}, self.media, "watch")
+        methods.record_user_action({"user_id": self.user.id, "user_session": None, "remote_ip_addr": None}, self.media, "like")
+        self.assertEqual(methods.get_pending_user_action_counts(self.media), {"views": 1, "likes": 1})
+
+        response = Client().get(f"/api/v1/media/{self.media.friendly_token}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["views"], response.data["likes"]), (self.media.views + 1, self.media.likes + 1))
+
+    def test_flush_user_actions(self):
+        views, likes = self.media.views, self.media.likes
+        other = create_account(username="other", email="other@example.com")
+        for user in [self.user, other]:
+            methods.record_user_action({"user_id": user.id, "user_session": None, "remote_ip_addr": None}, self.media, "watch")
+            methods.record_user_action({"user_id": user.id, "user_session": None, "remote_ip_addr": None}, self.media, "like")
+        # the like of a user that is already in the db is not counted again
+        MediaAction.objects.create(user=other, media=self.media, action="like")
+
+        self.assertTrue(tasks.flush_user_actions())
+
+        self.media.refresh_from_db()
+        self.assertEqual((self.media.views, self.media.likes), (views + 2, likes + 1))
+        self.assertEqual(MediaAction.objects.filter(media=self.media, action="watch").count(), 2)
+        self.assertEqual(MediaAction.objects.filter(media=self.media, action="like").count(), 2)
+        self.assertEqual(self.redis.xlen(methods.USER_ACTIONS_STREAM_KEY), 0)
+        self.assertEqual(self.pending_counters(), {}, "Flushed counters should be removed")
+        self.assertEqual(methods.get_pending_user_action_counts(self.media), {})
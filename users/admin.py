@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.contrib import admin
 
+from files.methods import get_encode_queue_depth
+
 from .models import User
 
 
@@ -26,5 +28,13 @@ class UserAdmin(admin.ModelAdmin):
         list_filter.append("is_approved")
         exclude.remove("is_approved")
 
+    if settings.ENCODE_FAIR_SHARE_BY == "user":
+        list_display.append("get_encode_queue_depth")
+
+    def get_encode_queue_depth(self, obj):
+        return get_encode_queue_depth(f"user:{obj.id}")
+
+    get_encode_queue_depth.short_description = "Queued encodes"
+
 
 admin.site.register(User, UserAdmin)